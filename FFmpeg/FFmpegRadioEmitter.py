@@ -0,0 +1,503 @@
+import array
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple, Union
+
+from prometheus_client import Gauge
+
+from core.AbstractRadioEmitter import AbstractRadioEmitter
+from core.GrowingFile import open_growing_media
+from core.Loudness import get_loudness_analyzer
+from core.Transcoder import get_transcoder
+from core.models import Song
+from utils import parse_mp3_frame_header
+from web.StreamRelay import FrameSplitter, get_relay, get_renditions
+
+
+class _DecodedTrack:
+    """
+    Track decoded to PCM by an ffmpeg process
+    """
+
+    def __init__(self, streamer, track: Song):
+        self.streamer = streamer
+        self.track = track
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.media_fd = None
+        self.preparing: Optional[asyncio.Future] = None
+        # First PCM read ahead by prepare()
+        self.head = b""
+        self.samples = 0
+        self.ended = False
+
+    def prepare(self) -> asyncio.Future:
+        """
+        Starts the decoder and decodes the first chunk, can be called any number of times
+        """
+        if self.preparing is None:
+            self.preparing = asyncio.ensure_future(self._prepare())
+        return self.preparing
+
+    async def _prepare(self):
+        streamer = self.streamer
+        source = self.track.media
+        stdin = asyncio.subprocess.DEVNULL
+        filters = []
+        self.media_fd = open_growing_media(self.track.media)
+        if self.media_fd is not None:
+            # Track is still being downloaded
+            source, stdin = "pipe:0", self.media_fd
+        else:
+            gain = get_loudness_analyzer(streamer.config).get_gain(self.track.media)
+            if gain is not None:
+                filters = ["-af", "volume=%.2fdB" % gain]
+        self.process = await asyncio.create_subprocess_exec(
+            streamer.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-i", source, "-vn", *filters,
+            "-f", "s16le", "-ar", str(streamer.sample_rate), "-ac", str(streamer.channels), "pipe:1",
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self.head = await self._read(streamer.chunk_samples * streamer.bytes_per_sample)
+
+    async def _read(self, size) -> bytes:
+        try:
+            return await self.process.stdout.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def read(self, size) -> bytes:
+        """
+        :return: PCM, empty at the end of the track
+        """
+        await asyncio.shield(self.prepare())
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += await self._read(size - len(data))
+        return data
+
+    def close(self):
+        if self.preparing is not None:
+            self.preparing.cancel()
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        if self.media_fd is not None:
+            os.close(self.media_fd)
+            self.media_fd = None
+
+
+class _EncodedTrack:
+    """
+    Copy of a track already encoded in the output format, its frames are sent as they are
+    """
+
+    _read_size = 16384  # bytes
+
+    def __init__(self, track: Song, file_path):
+        self.track = track
+        self.file = open(file_path, "rb")
+        self.splitter = FrameSplitter("mp3")
+        self.frames: List[Tuple[bytes, int]] = []
+        self.samples = 0
+        self.ended = False
+
+    def sample_rate(self) -> Optional[int]:
+        head = self.file.read(self._read_size)
+        self.file.seek(0)
+        frames = FrameSplitter("mp3").feed(head)
+        if not frames:
+            return None
+        return parse_mp3_frame_header(frames[0], 0)["sample_rate"]
+
+    def read(self, max_samples) -> List[Tuple[bytes, int]]:
+        """
+        :return: frames with their numbers of samples, empty at the end of the track
+        """
+        result = []
+        samples = 0
+        while samples < max_samples:
+            if not self.frames:
+                data = self.file.read(self._read_size)
+                if not data:
+                    break
+                self.frames = [(frame, parse_mp3_frame_header(frame, 0)["samples"])
+                               for frame in self.splitter.feed(data)]
+                continue
+            frame = self.frames.pop(0)
+            result.append(frame)
+            samples += frame[1]
+        self.samples += samples
+        return result
+
+    def close(self):
+        self.file.close()
+
+
+_Source = Union[_DecodedTrack, _EncodedTrack]
+
+
+# noinspection PyMissingConstructor
+class FFmpegStreamer(AbstractRadioEmitter):
+    """
+    Radio emitter with a single long-lived ffmpeg encoder which output is published to the stream relay
+    of the web server. Tracks are decoded to PCM and fed to the encoder at real-time speed; copies already
+    in the output format (see Transcoder) are passed through frame by frame. Silence is streamed between
+    tracks, so listeners are never disconnected.
+    The next track is preloaded and follows the current one without a gap, optionally with a crossfade
+    """
+
+    _default_format = "mp3"
+    _default_codec = "libmp3lame"
+    _default_bitrate = "320k"
+    _default_sample_rate = 44100
+    _default_channels = 2
+    _default_lead = 0.5  # seconds
+    _default_crossfade = 0.0  # seconds
+    _chunk_duration = 0.1  # seconds
+    _output_read_size = 65536  # bytes
+
+    def __init__(self, config):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.streamer.ffmpeg")
+        self.logger.setLevel(self.config.get("streamer_ffmpeg", "verbosity", fallback="warning").upper())
+
+        self.ffmpeg = self.config.get("streamer_ffmpeg", "ffmpeg", fallback="ffmpeg")
+        self.format = self.config.get("streamer_ffmpeg", "format", fallback=self._default_format)
+        self.sample_rate = self.config.getint("streamer_ffmpeg", "samplerate", fallback=self._default_sample_rate)
+        self.channels = self.config.getint("streamer_ffmpeg", "channels", fallback=self._default_channels)
+        self.lead = self.config.getfloat("streamer_ffmpeg", "lead", fallback=self._default_lead)
+        self.mount = self.config.get("streamer_ffmpeg", "relay_mount", fallback="/stream")
+        self.chunk_samples = int(self.sample_rate * self._chunk_duration)
+        self.crossfade_samples = int(self.sample_rate * self.config.getfloat(
+            "streamer_ffmpeg", "crossfade", fallback=self._default_crossfade))
+        # Frames can be spliced into the encoder's output only if both are plain MPEG audio;
+        # crossfades need PCM of both tracks
+        transcoder = get_transcoder(config)
+        self.passthrough = self.config.getboolean("streamer_ffmpeg", "passthrough", fallback=True) \
+            and self.format == "mp3" and transcoder.stream_format == "mp3" and self.crossfade_samples == 0
+
+        self.is_playing = False
+        self.now_playing: Optional[Song] = None
+        self.song_start_time = 0
+        self.core = None
+
+        # noinspection PyArgumentList
+        self.mon_is_playing = Gauge('dj_is_playing', 'Is something paying now')
+        self.mon_is_playing.set_function(lambda: 1 if self.is_playing else 0)
+
+        self.encoder: Optional[asyncio.subprocess.Process] = None
+        self.tasks: List[asyncio.Future] = []
+        # Readers of the running encoder's outputs
+        self.output_tasks: List[asyncio.Future] = []
+        self.source: Optional[_Source] = None
+        # Preloaded next track
+        self.next_source: Optional[_Source] = None
+        # Source was switched to next_source by the feeder, Core has not switched the track yet
+        self.advanced = False
+        # Previous track which is being faded out
+        self.fading: Optional[_DecodedTrack] = None
+        self.fade_position = 0
+        # Output clock: samples sent since clock_start
+        self.clock_start = 0.0
+        self.samples_sent = 0
+        self.track_start_sample = 0
+        self.track_ended: Optional[asyncio.Future] = None
+
+    def bind_core(self, core):
+        self.core = core
+        self.tasks.append(core.loop.create_task(self._feed()))
+
+    def get_name(self):
+        return "ffmpeg"
+
+    @property
+    def bytes_per_sample(self):
+        return 2 * self.channels
+
+    def cleanup(self):
+        self.stop()
+        for task in self.tasks:
+            task.cancel()
+        if self.encoder is not None and self.encoder.returncode is None:
+            self.encoder.kill()
+
+    def stop(self):
+        self._close_source()
+        self._close_next_source()
+        self.is_playing = False
+        self.now_playing = None
+
+    def preload(self, track: Optional[Song]):
+        if self.next_source is not None and track is not None and self.next_source.track.id == track.id \
+                and self.next_source.track.media == track.media:
+            return
+        self._close_next_source()
+        if track is None or track.media is None:
+            return
+        self.next_source = self._open_source(track)
+        if isinstance(self.next_source, _DecodedTrack):
+            self.next_source.prepare()
+        self.logger.debug("Preloaded %s", track)
+
+    def switch_track(self, track: Song):
+        if self.advanced and self.source is not None and self.source.track.id == track.id:
+            # Feeder has already moved on to this track
+            self.advanced = False
+            self._set_track(track)
+            if self.source.ended:
+                self.track_ended.set_result(None)
+            return
+        self._close_source()
+        if self.next_source is not None and self.next_source.track.id == track.id:
+            self.source, self.next_source = self.next_source, None
+        else:
+            self.source = self._open_source(track)
+        self.track_start_sample = self.samples_sent
+        self._set_track(track)
+
+    def _set_track(self, track: Song):
+        self.track_ended = asyncio.get_event_loop().create_future()
+        self.is_playing = True
+        self.now_playing = track
+        self.song_start_time = time.time()
+
+    def _open_source(self, track: Song) -> _Source:
+        # Renditions are encoded from PCM, so every track has to be decoded
+        passthrough = self.passthrough and not get_renditions(self.mount)
+        stream_media = get_transcoder(self.config).get_stream_media(track.media) if passthrough else None
+        if stream_media is not None:
+            try:
+                source = _EncodedTrack(track, stream_media)
+            except OSError as e:
+                self.logger.warning("Unable to open %s: %s", stream_media, e)
+            else:
+                if source.sample_rate() == self.sample_rate:
+                    return source
+                source.close()
+        return _DecodedTrack(self, track)
+
+    def _close_source(self):
+        self.advanced = False
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+        if self.fading is not None:
+            self.fading.close()
+            self.fading = None
+        if self.track_ended is not None and not self.track_ended.done():
+            self.track_ended.cancel()
+
+    def _close_next_source(self):
+        if self.next_source is not None:
+            self.next_source.close()
+            self.next_source = None
+
+    def get_position(self) -> Optional[float]:
+        if not self.is_playing:
+            return None
+        # Audio fed ahead of the clock has not been heard yet
+        played = min(self.samples_sent, self._clock_samples()) - self.track_start_sample
+        return max(0.0, played / self.sample_rate)
+
+    def track_end(self) -> Optional[asyncio.Future]:
+        return self.track_ended
+
+    def _clock_samples(self) -> int:
+        return int((time.monotonic() - self.clock_start) * self.sample_rate)
+
+    def _end_source(self, offset) -> bool:
+        """
+        Current source has been fed out, the feeder moves on to the preloaded track if there is one
+        :param offset: samples of the current chunk which belong to the ended source
+        :return: True if the source was switched
+        """
+        self.source.ended = True
+        self.logger.debug("End of %s", self.source.track)
+        if self.track_ended is not None and not self.track_ended.done():
+            self.track_ended.set_result(None)
+        if self.next_source is None or self.advanced:
+            return False
+        if self.fading is None:
+            self.source.close()
+        self.source, self.next_source = self.next_source, None
+        self.advanced = True
+        self.track_start_sample = self.samples_sent + offset
+        return True
+
+    def _should_crossfade(self) -> bool:
+        source = self.source
+        return self.crossfade_samples > 0 and self.fading is None and not self.advanced \
+            and isinstance(source, _DecodedTrack) and isinstance(self.next_source, _DecodedTrack) \
+            and source.track.duration is not None \
+            and source.samples >= source.track.duration * self.sample_rate - self.crossfade_samples
+
+    async def _start_encoder(self):
+        relay = get_relay(self.mount)
+        if relay is None:
+            self.logger.error("No stream relay at %s, enable relay_enabled in [web_server]", self.mount)
+        codec = self.config.get("streamer_ffmpeg", "codec", fallback=self._default_codec)
+        outputs = ["-c:a", codec,
+                   "-b:a", self.config.get("streamer_ffmpeg", "bitrate", fallback=self._default_bitrate),
+                   "-f", self.format, "pipe:1"]
+        # Renditions are encoded by the same process from the same PCM, each to its own pipe
+        pipes = []
+        for rendition in get_renditions(self.mount):
+            read_fd, write_fd = os.pipe()
+            pipes.append((read_fd, write_fd, rendition))
+            outputs += ["-c:a", codec, "-b:a", rendition.rendition, "-f", self.format, "pipe:%d" % write_fd]
+        try:
+            self.encoder = await asyncio.create_subprocess_exec(
+                self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+                "-f", "s16le", "-ar", str(self.sample_rate), "-ac", str(self.channels), "-i", "pipe:0", *outputs,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                pass_fds=[write_fd for _read_fd, write_fd, _rendition in pipes],
+            )
+        except OSError:
+            for read_fd, _write_fd, _rendition in pipes:
+                os.close(read_fd)
+            raise
+        finally:
+            for _read_fd, write_fd, _rendition in pipes:
+                os.close(write_fd)
+        self.output_tasks = [asyncio.ensure_future(self._read_output(self.encoder.stdout, relay))]
+        loop = asyncio.get_event_loop()
+        for read_fd, _write_fd, rendition in pipes:
+            reader = asyncio.StreamReader()
+            await loop.connect_read_pipe(lambda _reader=reader: asyncio.StreamReaderProtocol(_reader),
+                                         os.fdopen(read_fd, "rb", 0))
+            self.output_tasks.append(asyncio.ensure_future(self._read_output(reader, rendition)))
+        # Readers of previous encoders have finished
+        self.tasks = [task for task in self.tasks if not task.done()] + self.output_tasks
+
+    async def _encoder_input(self) -> asyncio.StreamWriter:
+        if self.encoder is None or self.encoder.returncode is not None:
+            await self._start_encoder()
+        return self.encoder.stdin
+
+    async def _flush_encoder(self):
+        """
+        Stops the encoder once it has written out the audio it still holds, so that passed through frames
+        follow the end of the previous track. It is started again for the next PCM
+        """
+        if self.encoder is None:
+            return
+        encoder, self.encoder = self.encoder, None
+        if encoder.returncode is None:
+            encoder.stdin.close()
+            await asyncio.wait(self.output_tasks)
+            await encoder.wait()
+
+    async def _read_output(self, output: asyncio.StreamReader, relay):
+        while True:
+            data = await output.read(self._output_read_size)
+            if not data:
+                break
+            if relay is not None:
+                relay.feed(data)
+        if relay is not None:
+            relay.reset()
+
+    async def _feed(self):
+        """
+        Feeds the encoder (or the relay, for passed through frames) at real-time speed
+        """
+        silence = bytes(self.chunk_samples * self.bytes_per_sample)
+        self.clock_start = time.monotonic()
+        while True:
+            try:
+                samples = await self._feed_source()
+                if samples == 0:
+                    (await self._encoder_input()).write(silence)
+                    samples = self.chunk_samples
+                if self.encoder is not None:
+                    await self.encoder.stdin.drain()
+            except OSError as e:
+                self.logger.error("Encoder failed: %s", e)
+                if self.encoder is not None and self.encoder.returncode is None:
+                    self.encoder.kill()
+                await asyncio.sleep(1)
+                continue
+            self.samples_sent += samples
+
+            ahead = (self.samples_sent - self._clock_samples()) / self.sample_rate
+            if ahead > self.lead:
+                await asyncio.sleep(ahead - self.lead)
+            elif ahead < -1:
+                self.logger.warning("Stream is %.1f seconds late, clock is reset", -ahead)
+                self.clock_start = time.monotonic() - self.samples_sent / self.sample_rate
+
+    async def _feed_source(self) -> int:
+        """
+        Sends a chunk of the current track, the next one continues in the same chunk
+        :return: samples sent, 0 if there is nothing to send
+        """
+        if self.source is None or self.source.ended:
+            return 0
+        if self._should_crossfade():
+            self.fading, self.fade_position = self.source, 0
+            self._end_source(0)
+
+        source = self.source
+        if isinstance(source, _EncodedTrack):
+            await self._flush_encoder()
+            if source is not self.source:
+                # Switched while flushing
+                return 0
+            frames = source.read(self.chunk_samples)
+            relay = get_relay(self.mount)
+            if relay is not None:
+                relay.publish([frame for frame, _samples in frames])
+            samples = sum(s for _frame, s in frames)
+            if samples < self.chunk_samples:
+                # Different kinds of sources can't share a chunk, the next track starts with the next one
+                self._end_source(samples)
+            return samples
+
+        data = await self._read_pcm(source, self.chunk_samples)
+        if source is not self.source:
+            # Switched while reading
+            return 0
+        samples = len(data) // self.bytes_per_sample
+        if samples < self.chunk_samples and self._end_source(samples) and isinstance(self.source, _DecodedTrack):
+            data += await self._read_pcm(self.source, self.chunk_samples - samples)
+            samples = len(data) // self.bytes_per_sample
+        if self.fading is not None:
+            data = await self._crossfade(data)
+        (await self._encoder_input()).write(data)
+        return samples
+
+    async def _read_pcm(self, source: _DecodedTrack, samples) -> bytes:
+        try:
+            data = await source.read(samples * self.bytes_per_sample)
+        except OSError as e:
+            self.logger.error("Unable to play %s: %s", source.track, e)
+            data = b""
+        # Only whole samples go to the encoder
+        data = data[:len(data) - len(data) % self.bytes_per_sample]
+        source.samples += len(data) // self.bytes_per_sample
+        return data
+
+    async def _crossfade(self, data) -> bytes:
+        """
+        Mixes the fading track into the PCM of the current one
+        """
+        fading = self.fading
+        outgoing = await self._read_pcm(fading, len(data) // self.bytes_per_sample)
+        if fading is not self.fading:
+            return data
+        incoming = array.array("h", data)
+        mixed = array.array("h", outgoing.ljust(len(data), b"\0"))
+        for i in range(len(incoming)):
+            weight = min(1.0, (self.fade_position + i // self.channels) / self.crossfade_samples)
+            mixed[i] = int(incoming[i] * weight + mixed[i] * (1 - weight))
+        self.fade_position += len(data) // self.bytes_per_sample
+        if self.fade_position >= self.crossfade_samples or len(outgoing) < len(data):
+            self.fading.close()
+            self.fading = None
+        return mixed.tobytes()
@@ -1,7 +1,13 @@
+import os
 import time
+from typing import Optional, Tuple
+
 import vlc
 from prometheus_client import Gauge
 
+from core.GrowingFile import is_growing_file, open_growing_media
+from core.Loudness import get_loudness_analyzer
+from core.Transcoder import get_transcoder
 from core.models import Song
 from core.AbstractRadioEmitter import AbstractRadioEmitter
 
@@ -22,6 +28,10 @@ class VLCStreamer(AbstractRadioEmitter):
 
         self.vlc_instance = vlc.Instance()
         self.player = self.vlc_instance.media_player_new()
+        # Pipe of a track which is still being downloaded
+        self.media_fd = None
+        # Next track and its media prepared ahead
+        self.next_media: Optional[Tuple[Song, vlc.Media]] = None
 
     def bind_core(self, core):
         self.core = core
@@ -31,18 +41,68 @@ class VLCStreamer(AbstractRadioEmitter):
 
     def cleanup(self):
         self.player.stop()
+        self._close_media_fd()
 
     def stop(self):
         self.player.stop()
+        self._close_media_fd()
         self.is_playing = False
         self.now_playing = None
 
-    def switch_track(self, track: Song):
+    def _close_media_fd(self):
+        if self.media_fd is not None:
+            os.close(self.media_fd)
+            self.media_fd = None
+
+    def preload(self, track: Optional[Song]):
+        if self.next_media is not None and track is not None and self.next_media[0].id == track.id \
+                and self.next_media[0].media == track.media:
+            return
+        self.next_media = None
+        if track is None or track.media is None or is_growing_file(track.media):
+            # A pipe of a track which is still being downloaded can be read only once
+            return
+        media, _media_fd = self._make_media(track)
+        # Opens the file and probes its streams in the background
+        media.parse_with_options(vlc.MediaParseFlag.local, 0)
+        self.next_media = (track, media)
+
+    def _make_media(self, track: Song) -> Tuple[vlc.Media, Optional[int]]:
         uri = track.media
         vlc_options = self.config.get("streamer_vlc", "vlc_options")
+        gain = None
+        media_fd = open_growing_media(track.media)
+        if media_fd is not None:
+            uri = "fd://%d" % media_fd
+        else:
+            stream_media = get_transcoder(self.config).get_stream_media(track.media)
+            if stream_media is not None:
+                # Already in the stream format and normalized
+                uri = stream_media
+                vlc_options = self.config.get("streamer_vlc", "vlc_passthrough_options", fallback=vlc_options)
+            else:
+                gain = get_loudness_analyzer(self.config).get_gain(track.media)
+        # Output chain is kept open between tracks as long as their options are the same
         media = self.vlc_instance.media_new(uri, vlc_options, "sout-keep")
+        if gain is not None:
+            # Applied by the transcoding which is done anyway
+            media.add_option(":audio-filter=gain")
+            media.add_option(":sout-transcode-afilter=gain")
+            media.add_option(":gain-value=%.3f" % 10 ** (gain / 20))
+        return media, media_fd
+
+    def switch_track(self, track: Song):
+        previous_fd, self.media_fd = self.media_fd, None
+        if self.next_media is not None and self.next_media[0].id == track.id:
+            media = self.next_media[1]
+        else:
+            media, self.media_fd = self._make_media(track)
+        self.next_media = None
+        # Replacing the media keeps the output chain, stopping the player would tear it down
         self.player.set_media(media)
         self.player.play()
+        if previous_fd is not None:
+            os.close(previous_fd)
         self.is_playing = True
         self.now_playing = track
         self.song_start_time = time.time()
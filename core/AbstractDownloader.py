@@ -1,10 +1,84 @@
 # Abstract Download
+import asyncio
 import os
+import threading
 import time
-import requests
 import logging
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
 from core.AbstractComponent import AbstractComponent, ShouldNotBeCalled
+from core.GrowingFile import GrowingFile, register_growing_file, unregister_growing_file
+from core.HttpClient import get_http_client, get_async_http_client, get_host_guard, is_host_failure, NETWORK_ERRORS
+from utils import probe_duration
+
+# Downloads in progress are written next to their final path with this suffix
+PARTIAL_SUFFIX = ".part"
+
+
+def is_partial_file(file_name):
+    # pytube may append the extension after the suffix
+    return file_name.endswith(PARTIAL_SUFFIX) or PARTIAL_SUFFIX + "." in file_name
+
+
+class CancellationToken:
+    """
+    Cancellation flag with an optional deadline, shared between the event loop and downloader threads
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        # File being downloaded under this token, if it can be played before it is complete
+        self.media: Optional[GrowingFile] = None
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for fn in callbacks:
+            fn()
+
+    def add_callback(self, fn):
+        """
+        Calls fn (possibly from another thread) once the token is cancelled
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def remove_callback(self, fn):
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        """
+        Raises DownloadCancelled or DeadlineExceeded, called by downloaders between chunks
+        """
+        if self.cancelled:
+            raise DownloadCancelled()
+        if self.expired:
+            raise DeadlineExceeded()
 
 
 class AbstractDownloader(AbstractComponent):
@@ -20,6 +94,8 @@ class AbstractDownloader(AbstractComponent):
         self.config = config
         self.logger = logging.getLogger("tg_dj.downloader.abstract")
         self.logger.setLevel(getattr(logging, self.config.get("downloader", "verbosity", fallback="warning").upper()))
+        self.http = get_http_client(config)
+        self.host_guard = get_host_guard(config)
 
     def is_acceptable(self, kind, query):
         raise ShouldNotBeCalled("this method should not be called from abstract class")
@@ -30,43 +106,358 @@ class AbstractDownloader(AbstractComponent):
         except OSError:
             self.logger.warning("Touched nonexistent path")
 
-    def search(self, task, user_message=lambda text: True, limit=1000):
+    def search(self, task, user_message=lambda text: True, limit=1000, token=None):
         raise ShouldNotBeCalled("this method should not be called from abstract class")
 
-    def download(self, task, user_message=lambda text: True):
+    def download(self, task, user_message=lambda text: True, token=None):
         raise ShouldNotBeCalled("this method should not be called from abstract class")
 
     def is_in_cache(self, file_path):
         return os.path.exists(file_path) and os.path.getsize(file_path) > 0
 
-    def get_file(self, url, file_path, percent_callback=lambda x: True, file_size=None, headers=None):
+    def describe(self, kind, query) -> Optional[Tuple[str, str, int]]:
+        """
+        Title, artist and duration of an accepted query if they are known without downloading
+        """
+        return None
+
+    def is_playlist(self, kind, query) -> bool:
+        """
+        True if the query is a list of tracks which expand turns into separate queries
+        """
+        return False
+
+    def expand(self, query, token=None) -> List[str]:
+        """
+        :return: text queries of the tracks of a playlist, in their order
+        """
+        raise ShouldNotBeCalled("this method should not be called from abstract class")
+
+    def guard_sync(self, host):
+        """
+        Waits for the rate limit of the host, fails fast if the host is known to be failing.
+        Caller must report the outcome to self.host_guard
+        """
+        if not self.host_guard.acquire_sync(host):
+            raise SourceUnavailable(host, self.host_guard.breaker(host).retry_after())
+
+
+class AbstractAsyncDownloader(AbstractDownloader):
+    """Downloader running natively on the event loop; MasterDownloader awaits it instead of using a thread"""
+
+    _default_resume_attempts = 3
+    _default_segments = 4
+    _default_segment_min_size = 2  # megabytes
+    _default_segments_per_host = 8
+    _chunk_size = 100000  # bytes
+
+    # Shared by all downloaders, keyed by host name
+    _host_segments: Dict[str, asyncio.Semaphore] = {}
+
+    def __init__(self, config):
+        """
+        :param configparser.ConfigParser config:
+        """
+        super().__init__(config)
+        self.async_http = get_async_http_client(config)
+
+    async def search(self, task, user_message=lambda text: True, limit=1000, token=None):
+        raise ShouldNotBeCalled("this method should not be called from abstract class")
+
+    async def download(self, task, user_message=lambda text: True, token=None):
+        raise ShouldNotBeCalled("this method should not be called from abstract class")
+
+    async def expand(self, query, token=None) -> List[str]:
+        raise ShouldNotBeCalled("this method should not be called from abstract class")
+
+    async def get_file(self, url, file_path, percent_callback=lambda x: True, file_size=None, headers=None,
+                       max_duration=None, token=None):
+        """
+        Downloads into a temporary file which is renamed to file_path only after its length is verified.
+        Broken transfers are resumed with Range requests if the server supports them. Large files from such
+        servers are fetched as several byte ranges in parallel.
+        Files over max_file_size and, if max_duration is given, media which first frames show to be longer
+        are rejected while streaming. A cancelled or expired token stops the download after the current chunk
+        :param CancellationToken token:
+        """
+        part_path = file_path + PARTIAL_SUFFIX
+        growing = None
+        host = urlparse(url).hostname
+        max_size = 1000000 * self.config.getint("downloader", "max_file_size", fallback=self._default_max_size)
+
+        try:
+            async with self._host_slot(host):
+                response = await self._open_stream(url, headers)
+                try:
+                    content_length = None if file_size is None else int(file_size)
+                    if content_length is None and "content-length" in response.headers:
+                        content_length = int(response.headers["content-length"])
+                    if content_length is not None and content_length > max_size:
+                        raise MediaIsTooBig(content_length)
+                    resumable = content_length is not None and response.headers.get("accept-ranges") == "bytes"
+
+                    segments = self._plan_segments(content_length if resumable else None)
+                    self.logger.info("Downloading file \"%s\" of size \"%s\" in %d segment(s)"
+                                     % (file_path, content_length, len(segments)))
+
+                    with open(part_path, 'wb') as f:
+                        if len(segments) > 1:
+                            # Sparse preallocation, segments are written in place
+                            f.truncate(content_length)
+
+                    probe = MediaProbe(max_duration, content_length)
+                    if content_length is not None:
+                        growing = GrowingFile(file_path, part_path, content_length, probe)
+                        register_growing_file(growing)
+                        if token is not None:
+                            token.media = growing
+                    progress = DownloadProgress(percent_callback, content_length, max_size=max_size,
+                                                growing=growing)
+                    if len(segments) == 1:
+                        # Host slot is already held here, so no host for resumes
+                        done = [await self._fetch_segment(url, headers, part_path, 0, content_length, progress,
+                                                          resumable=resumable, host=None, response=response,
+                                                          probe=probe, token=token)]
+                        response = None
+                finally:
+                    if response is not None:
+                        response.close()
+
+            if len(segments) > 1:
+                tasks = [asyncio.ensure_future(self._fetch_segment(url, headers, part_path, start, end, progress,
+                                                                   resumable=True, host=host,
+                                                                   probe=probe if start == 0 else None,
+                                                                   token=token))
+                         for start, end in segments]
+                try:
+                    done = await asyncio.gather(*tasks)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+
+            if content_length is not None and sum(done) != content_length:
+                raise UrlOrNetworkProblem("Incomplete download: %d of %d bytes" % (sum(done), content_length))
+
+            os.replace(part_path, file_path)
+            if growing is not None:
+                growing.finish()
+        except BaseException:
+            if growing is not None:
+                growing.fail()
+            try:
+                os.unlink(part_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            if growing is not None:
+                unregister_growing_file(growing)
+
+    def _plan_segments(self, content_length) -> List[Tuple[int, Optional[int]]]:
+        """
+        Returns [start, end) byte ranges; one open range when the length is unknown or ranges are unsupported
+        """
+        if content_length is None:
+            return [(0, None)]
+
+        max_segments = self.config.getint("downloader", "segments", fallback=self._default_segments)
+        min_size = 1000000 * self.config.getfloat("downloader", "segment_min_size",
+                                                  fallback=self._default_segment_min_size)
+        count = max(1, min(max_segments, int(content_length // max(min_size, 1))))
+
+        bounds = [content_length * i // count for i in range(count + 1)]
+        return [(bounds[i], bounds[i + 1]) for i in range(count)]
+
+    async def _fetch_segment(self, url, headers, part_path, start, end, progress, resumable, host,
+                             response=None, probe=None, token=None) -> int:
+        """
+        Writes bytes [start, end) of the resource at their offset in part_path, resuming on network errors
+        :param host: host slot to take for each request, None if the caller already holds it
+        :param response: already opened response to read first
+        :param MediaProbe probe: gets the bytes of the segment which starts the file
+        :return: number of bytes written
+        """
+        resume_attempts = self.config.getint("downloader", "resume_attempts", fallback=self._default_resume_attempts)
+        length = None if end is None else end - start
+        done = 0
+        attempt = 0
+
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            while True:
+                try:
+                    if response is None and host is not None:
+                        async with self._host_slot(host):
+                            response = await self._open_stream(url, headers, start + done, end)
+                            done = self._check_range_response(response, f, start, done)
+                            done = await self._read_segment(response, f, done, length, progress, probe, token)
+                    elif response is None:
+                        response = await self._open_stream(url, headers, start + done, end)
+                        done = self._check_range_response(response, f, start, done)
+                        done = await self._read_segment(response, f, done, length, progress, probe, token)
+                    else:
+                        done = await self._read_segment(response, f, done, length, progress, probe, token)
+                except NETWORK_ERRORS as e:
+                    # Failed requests are already counted by _request, a transfer broken later is just resumed
+                    if not resumable or attempt >= resume_attempts:
+                        raise UrlOrNetworkProblem(e)
+                    done = f.tell() - start
+                    attempt += 1
+                    self.logger.warning("Download of \"%s\" broken at byte %d, resuming (%d/%d): %s"
+                                        % (part_path, start + done, attempt, resume_attempts, e))
+                    continue
+                finally:
+                    if response is not None:
+                        response.close()
+                        response = None
+
+                if length is not None and done < length and resumable and attempt < resume_attempts:
+                    attempt += 1
+                    self.logger.warning("Download of \"%s\" ended early at byte %d, resuming (%d/%d)"
+                                        % (part_path, start + done, attempt, resume_attempts))
+                    continue
+                return done
+
+    def _check_range_response(self, response, f, start, done) -> int:
+        if start + done == 0 or response.status == 206:
+            return done
+        if start > 0:
+            raise UrlOrNetworkProblem("Server ignored range request")
+        self.logger.info("Server ignored range request, restarting \"%s\"" % f.name)
+        f.seek(0)
+        f.truncate()
+        return 0
+
+    async def _read_segment(self, response, f, done, length, progress, probe, token) -> int:
+        async for buf in response.content.iter_chunked(self._chunk_size):
+            if token is not None:
+                token.check()
+            if length is not None:
+                # Never write past the segment, even if the server sends more than asked
+                buf = buf[:length - done]
+            f.write(buf)
+            done += len(buf)
+            if probe is not None:
+                probe.feed(buf)
+            progress.add(len(buf))
+            progress.written(f, done)
+            if length is not None and done >= length:
+                break
+        return done
+
+    async def _request(self, method, url, **kwargs):
+        """
+        Request through the host guard: rate limited, skipped while the host is failing,
+        network errors and 5xx responses are counted as host failures. Caller must release the response
+        """
+        host = urlparse(url).hostname
+        if not await self.host_guard.acquire(host):
+            raise SourceUnavailable(host, self.host_guard.breaker(host).retry_after())
         try:
-            response = requests.get(url, allow_redirects=True, stream=True, headers=headers)
-        except requests.exceptions.ConnectionError as e:
-            raise UrlOrNetworkProblem(e)
-        if response.status_code != 200:
-            raise BadReturnStatus(response.status_code)
-
-        if file_size is None:
-            file_size = response.headers.get('content-length')
-
-        self.logger.info("Downloading file \"%s\" of size \"%s\"" % (file_path, file_size))
-
-        last_update = time.time()
-        with open(file_path, 'wb') as f:
-            if file_size is None:
-                f.write(response.content)
-            else:
-                done = 0
-                content_length = int(file_size)
-                for buf in response.iter_content(chunk_size=100000):
-                    done += len(buf)
-                    f.write(buf)
-
-                    new_time = time.time()
-                    if new_time > last_update + 3:
-                        last_update = new_time
-                        percent_callback(100 * done / content_length)
+            response = await self.async_http.request(method, url, **kwargs)
+        except NETWORK_ERRORS:
+            self.host_guard.failure(host)
+            raise
+        except BaseException:
+            self.host_guard.release(host)
+            raise
+        if is_host_failure(response.status):
+            self.host_guard.failure(host)
+        else:
+            self.host_guard.success(host)
+        return response
+
+    async def _open_stream(self, url, headers, offset=0, end=None):
+        request_headers = dict(headers or {})
+        # Byte counts must match the content-length, so no transparent decompression
+        request_headers["Accept-Encoding"] = "identity"
+        if offset > 0 or end is not None:
+            request_headers["Range"] = "bytes=%d-%s" % (offset, "" if end is None else end - 1)
+
+        response = await self._request("GET", url, allow_redirects=True, headers=request_headers)
+        if response.status not in (200, 206):
+            response.release()
+            raise BadReturnStatus(response.status)
+        return response
+
+    def _host_slot(self, host):
+        """
+        Limits parallel connections (segments of all downloads) to one host
+        """
+        if host not in self._host_segments:
+            limit = self.config.getint("downloader", "segments_per_host", fallback=self._default_segments_per_host)
+            self._host_segments[host] = asyncio.Semaphore(limit)
+        return self._host_segments[host]
+
+
+class DownloadProgress:
+    """
+    Aggregates downloaded bytes and reports percents to the user at most once per interval.
+    Raises MediaIsTooBig as soon as more than max_size bytes are received
+    """
+
+    def __init__(self, percent_callback, total, interval=3, max_size=None, growing=None):
+        """
+        :param GrowingFile growing: gets written ranges, so the file can be played while it is downloaded
+        """
+        self.percent_callback = percent_callback
+        self.total = total
+        self.interval = interval
+        self.max_size = max_size
+        self.growing = growing
+        self.done = 0
+        self.last_update = time.time()
+
+    def add(self, size):
+        self.update(self.done + size)
+
+    def written(self, f, done):
+        """
+        :param f: file of a segment, positioned right after its written bytes
+        :param int done: bytes written to the segment
+        """
+        if self.growing is not None:
+            # Readers of the growing file use their own descriptors
+            f.flush()
+            self.growing.update(f.tell() - done, done)
+
+    def update(self, done):
+        self.done = done
+        if self.max_size is not None and self.done > self.max_size:
+            raise MediaIsTooBig(self.done)
+        new_time = time.time()
+        if self.total and new_time > self.last_update + self.interval:
+            self.last_update = new_time
+            self.percent_callback(100 * self.done / self.total)
+
+
+class MediaProbe:
+    """
+    Collects the first bytes of a download to estimate its duration.
+    Rejects media longer than max_duration as soon as they tell
+    """
+
+    _head_limit = 256000  # bytes
+
+    def __init__(self, max_duration, total_size):
+        self.max_duration = max_duration
+        self.total_size = total_size
+        self.head = bytearray()
+        self.duration = None
+        self.finished = False
+
+    def feed(self, buf):
+        if self.finished:
+            return
+        self.head += buf[:self._head_limit - len(self.head)]
+        self.duration = probe_duration(self.head, self.total_size)
+        if self.duration is not None or len(self.head) >= self._head_limit:
+            self.finished = True
+            self.head = None
+        if self.duration is not None and self.max_duration is not None and self.duration > self.max_duration:
+            raise MediaIsTooLong(int(self.duration))
 
 
 class DownloaderException(Exception):
@@ -81,6 +472,13 @@ class UrlProblem(DownloaderException):
     pass
 
 
+class SourceUnavailable(DownloaderException):
+    """
+    Host failed too many times recently and is not contacted until args[1] seconds pass
+    """
+    pass
+
+
 class MediaIsTooLong(DownloaderException):
     pass
 
@@ -115,3 +513,11 @@ class ApiError(DownloaderException):
 
 class NotAccepted(DownloaderException):
     pass
+
+
+class DownloadCancelled(DownloaderException):
+    pass
+
+
+class DeadlineExceeded(DownloaderException):
+    pass
@@ -1,3 +1,6 @@
+import asyncio
+from typing import Optional
+
 from core.AbstractComponent import AbstractComponent, ShouldNotBeCalled
 from core.models import Song
 
@@ -8,3 +11,22 @@ class AbstractRadioEmitter(AbstractComponent):
 
     def switch_track(self, track: Song):
         raise ShouldNotBeCalled()
+
+    def preload(self, track: Optional[Song]):
+        """
+        Prepares the track which is going to be played next, so that switching to it is immediate
+        :param track: None if there is no next track
+        """
+        pass
+
+    def get_position(self) -> Optional[float]:
+        """
+        :return: seconds of the current track played so far, None if the emitter does not know
+        """
+        return None
+
+    def track_end(self) -> Optional[asyncio.Future]:
+        """
+        :return: future which is resolved when the current track ends, None if the emitter does not report it
+        """
+        return None
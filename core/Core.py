@@ -2,12 +2,13 @@
 # -*- coding: UTF-8 -*-
 import asyncio
 import datetime
+import functools
 import logging
 import platform
 import time
 import traceback
 from itertools import chain
-from typing import Optional, Callable, List, Tuple, NoReturn, Union
+from typing import Optional, Callable, Dict, List, Set, Tuple, NoReturn, Union
 
 import peewee
 from prometheus_client import Gauge
@@ -16,7 +17,8 @@ from core.AbstractFrontend import AbstractFrontend, FrontendUserInfo
 from core.AbstractRadioEmitter import AbstractRadioEmitter
 from downloaders.MasterDownloader import MasterDownloader
 from .AbstractComponent import AbstractComponent
-from .AbstractDownloader import AbstractDownloader
+from .AbstractDownloader import AbstractDownloader, CancellationToken, NotAccepted
+from .Loudness import get_loudness_analyzer
 from .QueueManager import QueueManager
 from .models import User, Request, Song, UserInfoMinimal, UserInfo
 
@@ -42,6 +44,12 @@ class DownloadFailed(Exception):
 
 
 class Core:
+    _default_download_timeout = 300  # seconds
+    _default_search_timeout = 30  # seconds
+    _default_prefetch_distance = 3  # tracks
+    _default_progressive_min_buffer = 5  # seconds
+    _default_progressive_safety = 1.5
+    _default_bulk_parallel = 3  # downloads
 
     def __init__(self, config, components: List[Union[AbstractComponent]], downloader: MasterDownloader, loop=asyncio.get_event_loop()):
         """
@@ -70,6 +78,16 @@ class Core:
 
         self.queueManager = QueueManager(config)
         self.song_start_time = time.time()
+        # Downloads and searches in flight by user id
+        self.download_tokens: Dict[int, Set[CancellationToken]] = {}
+        # Pending tracks are accepted at once and downloaded when they get close to playback
+        self.lazy_downloads = self.config.getboolean("core", "lazy_downloads", fallback=False)
+        # Downloads of pending tracks by track id
+        self.prefetch_tokens: Dict[int, CancellationToken] = {}
+        # Downloads of tracks which are played before they are complete, by track id
+        self.progressive_tokens: Dict[int, CancellationToken] = {}
+        # Queue ran out of playable tracks
+        self.playback_idle = False
         for component in components:
             component_added = False
             if issubclass(type(component), AbstractFrontend):
@@ -95,6 +113,10 @@ class Core:
         if self.downloader is None:
             raise ValueError("MasterDownloader was not passed in")
 
+        # Fallback tracks are analyzed in the background, in the order they are played
+        self.loop.call_soon(get_loudness_analyzer(config).schedule_library,
+                            [track.media for track in self.queueManager.backlog])
+
         self.wait_task = None
         self.play_next_track()
         self.queue_rating_check_task = self.loop.create_task(self.watch_queue_rating())
@@ -168,15 +190,15 @@ class Core:
         returns: true -> user has quota
                  true -> user does not have quota
         """
+        return self.get_requests_left(user) > 0
+
+    def get_requests_left(self, user: User) -> int:
         interval = self.config.getint("core", "user_requests_limit_interval", fallback=600)
         limit = self.config.getint("core", "user_requests_limit", fallback=10)
         check_interval_start = datetime.datetime.now() - datetime.timedelta(
             seconds=interval)
         count = Request.select().where(Request.user == user, Request.time >= check_interval_start).count()
-        if count >= limit:
-            return False
-        else:
-            return True
+        return max(0, limit - count)
 
     def check_song_rating(self, song: Song) -> bool:
         active_users_cnt = self.get_active_users_cnt()
@@ -208,19 +230,38 @@ class Core:
             self.logger.debug("Request quota reached by user#%d (%s)" % (user.id, user.name))
             raise UserRequestQuotaReached
 
+        if self.lazy_downloads and (text or result):
+            kind, query = ("text", text) if text else ("search_result", result)
+            return self._enqueue_pending(user, kind, query)
+
         if text:
             self.logger.debug("New download (%s) from user#%d (%s)" % (text, user.id, user.name))
-            response = await self.downloader.download("text", text, progress_callback)
+            kind, query = "text", text
         elif result:
             self.logger.debug("New download (%s) from user#%d (%s)" % (str(result), user.id, user.name))
-            response = await self.downloader.download("search_result", result, progress_callback)
+            kind, query = "search_result", result
         elif file:
             self.logger.debug("New file #%s from user#%d (%s)" % (file["id"], user.id, user.name))
-            response = await self.downloader.download("file", file, progress_callback)
+            kind, query = "file", file
         else:
             self.logger.debug("No data for downloader (%s)" % (str(locals())))
             raise ValueError("No data for downloader")
 
+        token = self._start_task(user.id, self._get_download_timeout())
+        download = asyncio.ensure_future(self.downloader.download(kind, query, progress_callback, token))
+        handed_over = False
+        try:
+            if self.config.getboolean("core", "progressive_playback", fallback=False) and self._is_queue_idle():
+                started = await self._start_progressively(user, kind, query, download, token)
+                if started is not None:
+                    handed_over = True
+                    return started
+            response = await download
+        finally:
+            if not handed_over:
+                download.cancel()
+                self._finish_task(user.id, token)
+
         self.logger.debug("Response from downloader: (%s)" % str(response))
         if response is None:
             raise DownloadFailed()
@@ -229,34 +270,334 @@ class Core:
         if self.isWindows:
             file_path = file_path[2:]
 
-        author = User.get(id=int(user_id))
+        return self._add_track(user, file_path, title, artist, duration)
+
+    async def bulk_download_action(self, user_id: int, text: str, progress_callback=None) \
+            -> Optional[Tuple[List[Tuple[Song, int, int]], List[Tuple[str, str]]]]:
+        """
+        Downloads every track of a playlist or of a message with several links, bulk_parallel at a time.
+        Tracks are enqueued in their original order, each one as soon as the previous ones are finished.
+        Superusers fill the admin playlist unless bulk_admin_playlist is off
+        :return: added tracks and (query, reason) of failed ones; None if the text is not a bulk request
+        """
+        if not self.downloader.is_bulk(text):
+            return None
+
+        user = self.get_user(user_id)
+        progress_callback = progress_callback or (lambda _state: None)
+        report = self.downloader.off_loop(progress_callback)
+
+        if not self.check_requests_quota(user) and not user.superuser:
+            self.logger.debug("Request quota reached by user#%d (%s)" % (user.id, user.name))
+            raise UserRequestQuotaReached
+
+        owner_id = user.id
+        if user.superuser and self.config.getboolean("core", "bulk_admin_playlist", fallback=True):
+            owner_id = -1
+
+        token = self._start_task(user.id, self.config.getfloat("downloader", "search_timeout",
+                                                               fallback=self._default_search_timeout))
+        try:
+            queries = await self.downloader.expand(text, progress_callback, token)
+        finally:
+            self._finish_task(user.id, token)
+        if not user.superuser:
+            queries = queries[:self.get_requests_left(user)]
+        if not queries:
+            raise DownloadFailed()
+        self.logger.debug("New bulk download (%d tracks) from user#%d (%s)" % (len(queries), user.id, user.name))
+
+        if self.lazy_downloads:
+            added, failed = [], []
+            for query in queries:
+                try:
+                    added.append(self._enqueue_pending(user, "text", query, owner_id))
+                except NotAccepted:
+                    failed.append((query, "Ссылка не поддерживается"))
+            return added, failed
+
+        # Cancels the tracks which are still waiting for their turn
+        batch = self._start_task(user.id, 0)
+        parallel = asyncio.Semaphore(max(1, self.config.getint("downloader", "bulk_parallel",
+                                                               fallback=self._default_bulk_parallel)))
+        messages = [""] * len(queries)
+        finished = []
+
+        def report_progress(_job=None):
+            if _job is not None:
+                finished.append(_job)
+            report("Загружено треков: %d из %d" % (len(finished), len(queries)))
+
+        async def fetch(i):
+            async with parallel:
+                if batch.cancelled:
+                    return None
+                job_token = self._start_task(user.id, self._get_download_timeout())
+                try:
+                    return await self.downloader.download("text", queries[i],
+                                                          functools.partial(messages.__setitem__, i), job_token)
+                except NotAccepted:
+                    messages[i] = "Ссылка не поддерживается"
+                except Exception as e:
+                    self.logger.error("Download of %s failed: %s" % (queries[i], e))
+                finally:
+                    self._finish_task(user.id, job_token)
+                return None
+
+        report_progress()
+        added = []
+        jobs = [asyncio.ensure_future(fetch(i)) for i in range(len(queries))]
+        for job in jobs:
+            job.add_done_callback(report_progress)
+        failed_indices = []
+        try:
+            for i, job in enumerate(jobs):
+                response = await job
+                if response is None:
+                    failed_indices.append(i)
+                    continue
+                file_path, title, artist, duration = response
+                if self.isWindows:
+                    file_path = file_path[2:]
+                try:
+                    added.append(self._add_track(user, file_path, title, artist, duration, owner_id=owner_id))
+                except UserRequestQuotaReached:
+                    for j in range(i, len(queries)):
+                        messages[j] = "Превышен лимит запросов"
+                    failed_indices += range(i, len(queries))
+                    break
+        finally:
+            batch.cancel()
+            self._finish_task(user.id, batch)
+            for job in jobs:
+                job.cancel()
+
+        # Reasons of failures come through the callbacks
+        await self.downloader.flush_callbacks()
+        failed = [(queries[i], messages[i]) for i in failed_indices]
+        return added, failed
+
+    def _is_queue_idle(self) -> bool:
+        next_track = self.queueManager.get_first_track()
+        return next_track is None or next_track.user_id == -1
+
+    def _is_playing_fallback(self) -> bool:
+        """
+        Nothing or only a fallback track is playing, so a user's track which becomes playable may start at once
+        """
+        return self.playback_idle or self.current_track is None or self.current_track.user_id == -1
+
+    async def _start_progressively(self, user: User, kind: str, query, download: asyncio.Future,
+                                   token: CancellationToken) -> Optional[Tuple[Song, int, int]]:
+        """
+        Waits until the file is complete or enough of it is downloaded to be played while the rest arrives.
+        In the latter case the track is enqueued at once and started if nothing is playing
+        :return: same as download_action if the track was enqueued before its download completed
+        """
+        min_buffer = self.config.getfloat("core", "progressive_min_buffer",
+                                          fallback=self._default_progressive_min_buffer)
+        safety = self.config.getfloat("core", "progressive_safety", fallback=self._default_progressive_safety)
+        while not download.done():
+            growing = token.media
+            if growing is not None and growing.is_ready(min_buffer, safety):
+                break
+            await asyncio.wait([download], timeout=0.5)
+        else:
+            return None
+
+        description = self.downloader.describe(kind, query)
+        if description is None:
+            description = (query if kind == "text" else "", "", 0)
+        title, artist, duration = description
+        duration = duration or int(growing.duration)
+
+        self.logger.info("Track will be played before its download is complete: %s" % growing.file_path)
+        added = self._add_track(user, growing.file_path, title, artist, duration)
+        self.progressive_tokens[added[0].id] = token
+        download.add_done_callback(functools.partial(self._progressive_download_done, added[0], token))
+
+        if self._is_playing_fallback():
+            self.play_next_track()
+        return added
+
+    def _progressive_download_done(self, track: Song, token: CancellationToken, download: asyncio.Future):
+        self._finish_task(track.user_id, token)
+        self.progressive_tokens.pop(track.id, None)
+        if not download.cancelled() and download.exception() is None and download.result() is not None:
+            _file_path, title, artist, duration = download.result()
+            # Placeholders are kept if the file has no tags
+            track.title = title or track.title
+            track.artist = artist or track.artist
+            track.duration = duration or track.duration
+            return
+
+        if token.cancelled and not token.expired and self.queueManager.get_track(track.id) is None \
+                and self.current_track is not track:
+            # Track was deleted from the queue
+            self.logger.info("Download of deleted track #%d cancelled" % track.id)
+            return
+
+        self.logger.warning("Download of track #%d failed after it was enqueued" % track.id)
+        self._notify_user(track.user_id, "⚠️ Не удалось загрузить трек:\n%s" % track.full_title())
+        if self.current_track is track:
+            self.play_next_track()
+        else:
+            self.queueManager.remove_track(track.id)
+
+    def _enqueue_pending(self, user: User, kind: str, query, owner_id: Optional[int] = None) \
+            -> Tuple[Song, int, int]:
+        if not self.downloader.is_acceptable(kind, query):
+            raise NotAccepted()
+
+        self.logger.debug("New pending download (%s) from user#%d (%s)" % (str(query), user.id, user.name))
+        description = self.downloader.describe(kind, query)
+        if description is None:
+            description = (query if kind == "text" else "", "", 0)
+        title, artist, duration = description
+
+        return self._add_track(user, None, title, artist, duration, source={"kind": kind, "query": query},
+                               owner_id=owner_id)
+
+    def _add_track(self, user: User, file_path: Optional[str], title: str, artist: str, duration: int,
+                   source=None, owner_id: Optional[int] = None) -> Tuple[Song, int, int]:
+        """
+        :param owner_id: playlist to add the track to, the user's own by default
+        """
+        author = User.get(id=user.id)
         Request.create(user=author, text=(artist or "") + " - " + (title or ""))
         if not author.superuser and not self.check_requests_quota(author):
             raise UserRequestQuotaReached
 
-        track = self.queueManager.add_track(file_path, title, artist, duration, user_id)
+        owner_id = user.id if owner_id is None else owner_id
+        track = self.queueManager.add_track(file_path, title, artist, duration, owner_id, source=source)
         self.store_user_activity(user)
 
-        if not self.queueManager.is_in_queue(user_id):
-            self.queueManager.add_to_queue(user_id)
+        if not self.queueManager.is_in_queue(owner_id):
+            self.queueManager.add_to_queue(owner_id)
 
         local_position, global_position = self.queueManager.get_track_position(track)
 
+        self.schedule_prefetch()
+
         return track, local_position, global_position
 
+    def _get_download_timeout(self) -> float:
+        return self.config.getfloat("downloader", "download_timeout", fallback=self._default_download_timeout)
+
+    def schedule_prefetch(self):
+        """
+        Starts downloads of pending tracks which are within prefetch_distance positions of playback
+        and lets the emitter preload the next track
+        """
+        self.preload_next_track()
+        if not self.lazy_downloads:
+            return
+        distance = self.config.getint("core", "prefetch_distance", fallback=self._default_prefetch_distance)
+        for track in self.queueManager.get_queue_tracks(0, distance):
+            if not track.is_pending or track.id in self.prefetch_tokens:
+                continue
+            token = self._start_task(track.user_id, self._get_download_timeout())
+            self.prefetch_tokens[track.id] = token
+            asyncio.run_coroutine_threadsafe(self._prefetch(track, token), self.loop)
+
+    def preload_next_track(self):
+        # Queue may be changed from other threads, emitters are only touched on the loop
+        self.loop.call_soon_threadsafe(self.backend.preload, self.queueManager.get_first_track())
+
+    async def _prefetch(self, track: Song, token: CancellationToken):
+        self.logger.info("Downloading pending track #%d (%s)" % (track.id, track.full_title()))
+        messages = []
+        response = None
+        try:
+            response = await self.downloader.download(track.source["kind"], track.source["query"],
+                                                      messages.append, token)
+        except Exception as e:
+            self.logger.error("Download of pending track #%d failed: %s" % (track.id, e))
+        finally:
+            self.prefetch_tokens.pop(track.id, None)
+            self._finish_task(track.user_id, token)
+
+        if response is None:
+            if token.cancelled and not token.expired:
+                # Track was deleted or playback stopped, it stays pending if still queued
+                return
+            await self.downloader.flush_callbacks()
+            self.queueManager.remove_track(track.id)
+            self.logger.info("Pending track #%d have been skipped" % track.id)
+            self._notify_user(
+                track.user_id,
+                "⚠️ Не удалось загрузить трек, он удалён из очереди:\n%s%s"
+                % (track.full_title(), "\n\n" + messages[-1] if messages else ""),
+            )
+            return
+
+        file_path, title, artist, duration = response
+        if self.isWindows:
+            file_path = file_path[2:]
+        track.title, track.artist, track.duration = title, artist, duration
+        track.media = file_path
+        self.logger.info("Pending track #%d is ready" % track.id)
+        self.preload_next_track()
+
+        if self._is_playing_fallback():
+            # Nothing but fallback tracks was ready to play before
+            self.play_next_track()
+
     async def search_action(self, user_id: int, query: str, message_callback: Optional[Callable[[str], NoReturn]]=None, limit: int=1000):
         user = self.get_user(user_id)
         message_callback = message_callback or (lambda _state: None)
 
         self.logger.debug("New search query \"%s\" from user#%d (%s)" % (query, user.id, user.name))
-        return await self.downloader.search(query, message_callback, limit)
+        token = self._start_task(user.id, self.config.getfloat("downloader", "search_timeout",
+                                                               fallback=self._default_search_timeout))
+        try:
+            return await self.downloader.search(query, message_callback, limit, token)
+        finally:
+            self._finish_task(user.id, token)
+
+    def _start_task(self, user_id: int, timeout: float) -> CancellationToken:
+        token = CancellationToken(timeout if timeout > 0 else None)
+        self.download_tokens.setdefault(user_id, set()).add(token)
+        return token
+
+    def _finish_task(self, user_id: int, token: CancellationToken):
+        tokens = self.download_tokens.get(user_id, set())
+        tokens.discard(token)
+        if not tokens:
+            self.download_tokens.pop(user_id, None)
+
+    def cancel_downloads(self) -> int:
+        """
+        Cancels downloads of queued tracks: prefetches of pending tracks and the rest of tracks played
+        before they are complete. Downloads and searches users are waiting for go on
+        :return: number of cancelled tasks
+        """
+        tokens = list(chain(self.prefetch_tokens.values(), self.progressive_tokens.values()))
+        for token in tokens:
+            token.cancel()
+        if tokens:
+            self.logger.info("Cancelled %d download(s)" % len(tokens))
+        return len(tokens)
 
     async def wait_until_track_end(self, track: Song):
-        # fixme: magic number?!
-        await asyncio.sleep(track.duration - 0.3)
+        track_end = self.backend.track_end()
+        if track_end is not None:
+            try:
+                await asyncio.shield(track_end)
+            except asyncio.CancelledError:
+                if not track_end.cancelled():
+                    raise
+                # Track was stopped by the emitter
+                return
+        else:
+            # fixme: magic number?!
+            await asyncio.sleep(track.duration - 0.3)
         self.play_next_track()
 
     def get_song_progress(self) -> int:
+        position = self.backend.get_position()
+        if position is not None:
+            return int(position)
         return int(time.time() - self.song_start_time)
 
     def get_current_song(self) -> Song:
@@ -273,6 +614,8 @@ class Core:
             track = self.queueManager.pop_first_track()
             if track is None:
                 self.backend.stop()
+                self.playback_idle = True
+                self.schedule_prefetch()
                 return
 
             active_haters_cnt = active_users.filter(User.id << track.haters).count()
@@ -294,6 +637,8 @@ class Core:
 
         self.current_track = track
         self.song_start_time = time.time()
+        self.playback_idle = False
+        self.schedule_prefetch()
 
         user_curr_id = track.user_id
         if user_curr_id == -1:
@@ -349,6 +694,11 @@ class Core:
 
         position = self.queueManager.remove_track(song_id)
 
+        token = self.prefetch_tokens.get(song_id) or self.progressive_tokens.get(song_id)
+        if token is not None:
+            token.cancel()
+        self.schedule_prefetch()
+
         return position
 
     def raise_track(self, user_id, track_id):
@@ -360,6 +710,7 @@ class Core:
                 raise PermissionDenied()
 
         self.queueManager.raise_track(track_id)
+        self.schedule_prefetch()
 
     def raise_user(self, user_id: int, handled_user_id: int):
         user = self.get_user(user_id)
@@ -368,6 +719,7 @@ class Core:
             raise PermissionDenied()
 
         self.queueManager.raise_user_in_queue(handled_user_id)
+        self.schedule_prefetch()
 
     def stop_playback(self, user_id):
         user = self.get_user(user_id)
@@ -377,6 +729,7 @@ class Core:
 
         self.queueManager.play_next(self.current_track)
         self.backend.stop()
+        self.cancel_downloads()
 
         for fn in self.state_update_callbacks:
             fn(None)
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger("tg_dj.growing_file")
+
+
+class GrowingFile:
+    """
+    Download in progress which may be played before it is complete. Downloaders report written byte ranges,
+    players read the contiguous beginning of the file through a pipe which follows the download
+    """
+
+    _read_size = 65536  # bytes
+
+    def __init__(self, file_path, part_path, total_size, probe=None):
+        """
+        :param str file_path: final path of the file
+        :param str part_path: path the file is written to until it is complete
+        :param int total_size: size of the complete file
+        :param probe: MediaProbe of the download, tells the duration from the first frames
+        """
+        self.file_path = file_path
+        self.part_path = part_path
+        self.total_size = total_size
+        self.probe = probe
+        self.written: Dict[int, int] = {}  # segment start -> bytes written
+        self.started = time.monotonic()
+        self.complete = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.probe is None else self.probe.duration
+
+    def update(self, start, done):
+        with self.condition:
+            self.written[start] = done
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.complete = True
+            self.condition.notify_all()
+
+    def fail(self):
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+    def available(self) -> int:
+        """
+        Bytes at the beginning of the file which are already written
+        """
+        if self.complete:
+            return self.total_size
+        position = 0
+        for start in sorted(self.written):
+            if start > position:
+                break
+            position = max(position, start + self.written[start])
+        return position
+
+    def rate(self) -> float:
+        """
+        Average download speed in bytes per second
+        """
+        return sum(self.written.values()) / max(time.monotonic() - self.started, 0.001)
+
+    def is_ready(self, min_buffer, safety=1.0) -> bool:
+        """
+        True if playback started now will not catch up with the download: at least min_buffer seconds are
+        written and, at the current speed, the rest arrives before the track could be played to its end
+        """
+        if self.complete:
+            return True
+        if self.failed or self.duration is None or not self.total_size:
+            return False
+        byte_rate = self.total_size / self.duration
+        if self.available() < min_buffer * byte_rate:
+            return False
+        rate = self.rate()
+        if rate <= 0:
+            return False
+        remaining = self.total_size - sum(self.written.values())
+        return remaining / rate * safety <= self.duration
+
+    def open_reader(self) -> int:
+        """
+        :return: read end of a pipe which gets the file as it grows and is closed at its end
+        """
+        try:
+            f = open(self.part_path, "rb")
+        except FileNotFoundError:
+            # Completed in the meantime
+            f = open(self.file_path, "rb")
+        read_fd, write_fd = os.pipe()
+        threading.Thread(target=self._pump, args=(f, write_fd), daemon=True,
+                         name="growing-file-%s" % os.path.basename(self.file_path)).start()
+        return read_fd
+
+    def _pump(self, f, write_fd):
+        position = 0
+        try:
+            while True:
+                with self.condition:
+                    while self.available() <= position and not self.complete and not self.failed:
+                        self.condition.wait(1)
+                    if self.failed:
+                        logger.warning("Download of %s failed while it was played", self.file_path)
+                        return
+                    limit = self.available()
+                    complete = self.complete
+                if position >= limit and complete:
+                    return
+                data = f.read(min(self._read_size, limit - position))
+                if not data:
+                    if complete:
+                        return
+                    continue
+                position += len(data)
+                while data:
+                    data = data[os.write(write_fd, data):]
+        except OSError as e:
+            # Player stopped reading
+            logger.debug("Stopped feeding %s: %s", self.file_path, e)
+        finally:
+            f.close()
+            os.close(write_fd)
+
+
+_growing_files: Dict[str, GrowingFile] = {}
+_growing_files_lock = threading.Lock()
+
+
+def register_growing_file(growing: GrowingFile):
+    with _growing_files_lock:
+        _growing_files[growing.file_path] = growing
+
+
+def unregister_growing_file(growing: GrowingFile):
+    with _growing_files_lock:
+        if _growing_files.get(growing.file_path) is growing:
+            del _growing_files[growing.file_path]
+
+
+def is_growing_file(file_path) -> bool:
+    with _growing_files_lock:
+        return file_path in _growing_files
+
+
+def open_growing_media(file_path) -> Optional[int]:
+    """
+    :return: fd to read a file which is still being downloaded or None if the file is complete
+    """
+    with _growing_files_lock:
+        growing = _growing_files.get(file_path)
+    if growing is None or growing.complete:
+        return None
+    return growing.open_reader()
@@ -0,0 +1,412 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import aiohttp
+import requests
+from prometheus_client import Gauge
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _http_option(config, key, fallback):
+    if config is None:
+        return fallback
+    return config.get("http", key, fallback=fallback)
+
+
+class HttpClient:
+    """Shared HTTP client: keep-alive connection pools per host, default timeouts and retries with backoff"""
+
+    _default_connect_timeout = 5  # seconds
+    _default_read_timeout = 30  # seconds
+    _default_retries = 3
+    _default_backoff = 0.5  # seconds
+    _default_pool_hosts = 10
+    _default_pool_size = 10  # connections per host
+
+    def __init__(self, config=None):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.http")
+        self.logger.setLevel(self._get("verbosity", "warning").upper())
+
+        self.timeout = (
+            float(self._get("connect_timeout", self._default_connect_timeout)),
+            float(self._get("read_timeout", self._default_read_timeout)),
+        )
+
+        retries = int(self._get("retries", self._default_retries))
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=float(self._get("retry_backoff", self._default_backoff)),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["HEAD", "GET"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=int(self._get("pool_hosts", self._default_pool_hosts)),
+            pool_maxsize=int(self._get("pool_size", self._default_pool_size)),
+            max_retries=retry,
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _get(self, key, fallback):
+        return _http_option(self.config, key, fallback)
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        self.logger.debug("%s %s", method, url)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def is_host_failure(status) -> bool:
+    """
+    Statuses meaning that the host itself is in trouble, not the request
+    """
+    return status >= 500 or status == 429
+
+
+class AsyncHttpClient:
+    """asyncio counterpart of HttpClient, configured from the same [http] section"""
+
+    _idempotent_methods = ("HEAD", "GET")
+    _retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, config=None):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.http.async")
+        self.logger.setLevel(self._get("verbosity", "warning").upper())
+
+        self.timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=float(self._get("connect_timeout", HttpClient._default_connect_timeout)),
+            sock_read=float(self._get("read_timeout", HttpClient._default_read_timeout)),
+        )
+        self.retries = int(self._get("retries", HttpClient._default_retries))
+        self.backoff = float(self._get("retry_backoff", HttpClient._default_backoff))
+        self.pool_hosts = int(self._get("pool_hosts", HttpClient._default_pool_hosts))
+        self.pool_size = int(self._get("pool_size", HttpClient._default_pool_size))
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get(self, key, fallback):
+        return _http_option(self.config, key, fallback)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Session must be created inside the running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_hosts * self.pool_size,
+                limit_per_host=self.pool_size,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def request(self, method, url, **kwargs) -> aiohttp.ClientResponse:
+        """
+        Connection errors and 5xx responses of idempotent requests are retried with exponential backoff.
+        Caller must release the returned response
+        """
+        retriable = method in self._idempotent_methods
+        attempt = 0
+        while True:
+            self.logger.debug("%s %s", method, url)
+            try:
+                response = await self._get_session().request(method, url, **kwargs)
+            except NETWORK_ERRORS:
+                if not retriable or attempt >= self.retries:
+                    raise
+            else:
+                if not retriable or attempt >= self.retries or response.status not in self._retry_statuses:
+                    return response
+                response.release()
+
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def get(self, url, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def head(self, url, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("HEAD", url, **kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average with bursts of up to `burst` requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token
+        :return: seconds to wait before the token may be used
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HostRateLimiter:
+    """Token bucket per host, usable from coroutines and from threads"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def configure(self, host, rate, burst):
+        """
+        Sets a limit for one host instead of the default one
+        """
+        with self.lock:
+            self.buckets[host] = TokenBucket(rate, burst)
+
+    def reserve(self, host) -> float:
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            bucket = self.buckets[host]
+        return bucket.reserve()
+
+    async def wait(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def wait_sync(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# noinspection PyArgumentList
+mon_breaker_state = Gauge('dj_http_breaker_state', 'Circuit breaker state by host: 0 closed, 1 half-open, 2 open',
+                          ['host'])
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after `failures` failures in a row. After `reset_timeout` seconds one probe
+    request is let through (half-open): its success closes the breaker, its failure opens it again
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, host, failures, reset_timeout):
+        self.host = host
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+        mon_breaker_state.labels(host).set(self.state)
+
+    def _set_state(self, state):
+        self.state = state
+        mon_breaker_state.labels(self.host).set(state)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                if self.state != self.OPEN:
+                    self.opened_at = time.monotonic()
+                    self._set_state(self.OPEN)
+
+    def release(self):
+        """
+        Request finished without telling anything about the host (e.g. it was cancelled)
+        """
+        with self.lock:
+            self.probing = False
+
+
+class HostGuard:
+    """
+    Rate limiter and circuit breaker for every host the downloaders talk to, configured from the [http] section
+    """
+
+    _default_host_rate = 0  # requests per second, 0 for unlimited
+    _default_host_burst = 5
+    _default_breaker_failures = 5
+    _default_breaker_reset = 30  # seconds
+
+    def __init__(self, config=None):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.http")
+        self.limiter = HostRateLimiter(
+            float(_http_option(config, "host_rate", self._default_host_rate)),
+            int(_http_option(config, "host_burst", self._default_host_burst)),
+        )
+        self.breaker_failures = int(_http_option(config, "breaker_failures", self._default_breaker_failures))
+        self.breaker_reset = float(_http_option(config, "breaker_reset", self._default_breaker_reset))
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host) -> CircuitBreaker:
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.breaker_failures, self.breaker_reset)
+            return self.breakers[host]
+
+    def allow(self, host) -> bool:
+        allowed = self.breaker(host).allow()
+        if not allowed:
+            self.logger.info("Circuit for %s is open, request skipped", host)
+        return allowed
+
+    async def acquire(self, host) -> bool:
+        """
+        Waits for the rate limit of the host
+        :return: False if the host is failing and must not be contacted now
+        """
+        if not self.allow(host):
+            return False
+        try:
+            await self.limiter.wait(host)
+        except BaseException:
+            # Cancelled while waiting, a half-open probe slot must not stay taken
+            self.release(host)
+            raise
+        return True
+
+    def acquire_sync(self, host) -> bool:
+        """
+        Same as acquire, for threads
+        """
+        if not self.allow(host):
+            return False
+        try:
+            self.limiter.wait_sync(host)
+        except BaseException:
+            self.release(host)
+            raise
+        return True
+
+    def success(self, host):
+        self.breaker(host).success()
+
+    def failure(self, host):
+        breaker = self.breaker(host)
+        breaker.failure()
+        if breaker.state == CircuitBreaker.OPEN:
+            self.logger.warning("Circuit for %s is open for %.1f seconds", host, breaker.retry_after())
+
+    def release(self, host):
+        self.breaker(host).release()
+
+
+_shared_client: Optional[HttpClient] = None
+_shared_async_client: Optional[AsyncHttpClient] = None
+_shared_host_guard: Optional[HostGuard] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_http_client(config=None) -> HttpClient:
+    """
+    Returns the process-wide client. Callers without a config get one with default settings, which is
+    replaced by a client with the settings of the first config passed in. Clients already handed out
+    keep working with their settings
+    :param configparser.ConfigParser config:
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None or config is not None and _shared_client.config is None:
+            _shared_client = HttpClient(config)
+        return _shared_client
+
+
+def get_async_http_client(config=None) -> AsyncHttpClient:
+    """
+    Same as get_http_client, for coroutines
+    :param configparser.ConfigParser config:
+    """
+    global _shared_async_client
+    with _shared_client_lock:
+        if _shared_async_client is None or config is not None and _shared_async_client.config is None:
+            _shared_async_client = AsyncHttpClient(config)
+        return _shared_async_client
+
+
+def get_host_guard(config=None) -> HostGuard:
+    """
+    Same as get_http_client, for the host guard shared by all downloaders
+    :param configparser.ConfigParser config:
+    """
+    global _shared_host_guard
+    with _shared_client_lock:
+        if _shared_host_guard is None or config is not None and _shared_host_guard.config is None:
+            _shared_host_guard = HostGuard(config)
+        return _shared_host_guard
@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Summary
+
+from core.models import MediaLoudness
+
+# noinspection PyArgumentList
+mon_analyses_in_progress = Gauge('dj_loudness_analyses_in_progress', 'Loudness analyses in progress')
+# noinspection PyArgumentList
+mon_analysis_duration = Summary('dj_loudness_analysis_duration', 'Time spent in loudness analysis')
+# noinspection PyArgumentList
+mon_analysis_failures = Counter('dj_loudness_analysis_failures', 'Loudness analyses which failed')
+
+
+class LoudnessAnalyzer:
+    """
+    Measures integrated loudness and true peak of media files (EBU R128) with ffmpeg in the background
+    and keeps them in the database, so that emitters only apply a precomputed gain at playback.
+    Configured from the [loudness] section, runs at most `workers` ffmpeg processes at a time
+    """
+
+    _default_workers = 1
+    _default_nice = 10
+    _default_target = -16.0  # LUFS
+    _default_max_peak = -1.0  # dBTP
+    _default_max_gain = 10.0  # dB
+
+    _summary_loudness = re.compile(r"^\s*I:\s+(-?[\d.]+|-inf) LUFS", flags=re.MULTILINE)
+    _summary_peak = re.compile(r"^\s*Peak:\s+(-?[\d.]+|-inf) dBFS", flags=re.MULTILINE)
+
+    def __init__(self, config):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.loudness")
+        self.logger.setLevel(self.config.get("loudness", "verbosity", fallback="warning").upper())
+
+        self.enabled = self.config.getboolean("loudness", "enabled", fallback=False)
+        self.ffmpeg = self.config.get("loudness", "ffmpeg", fallback="ffmpeg")
+        self.nice = self.config.getint("loudness", "nice", fallback=self._default_nice)
+        self.target = self.config.getfloat("loudness", "target", fallback=self._default_target)
+        self.max_peak = self.config.getfloat("loudness", "max_peak", fallback=self._default_max_peak)
+        self.max_gain = self.config.getfloat("loudness", "max_gain", fallback=self._default_max_gain)
+
+        self.workers: Optional[asyncio.Semaphore] = None
+        # File path -> analysis in flight
+        self.in_progress: Dict[str, asyncio.Future] = {}
+        self.library_task: Optional[asyncio.Future] = None
+
+    def get_measurement(self, file_path) -> Optional[Tuple[float, float]]:
+        """
+        :return: loudness (LUFS) and true peak (dBTP) of the file if it has been analyzed
+        """
+        try:
+            row = MediaLoudness.get(MediaLoudness.file_path == os.path.abspath(file_path))
+        except MediaLoudness.DoesNotExist:
+            return None
+        try:
+            if row.file_size != os.path.getsize(file_path):
+                return None
+        except OSError:
+            return None
+        return row.loudness, row.peak
+
+    def get_gain(self, file_path) -> Optional[float]:
+        """
+        :return: gain in dB which brings the file to the target loudness without clipping,
+                 None if it is unknown
+        """
+        if not self.enabled or file_path is None:
+            return None
+        measurement = self.get_measurement(file_path)
+        if measurement is None:
+            return None
+        loudness, peak = measurement
+        gain = min(self.target - loudness, self.max_peak - peak, self.max_gain)
+        return round(gain, 2)
+
+    def schedule(self, file_path) -> Optional[asyncio.Future]:
+        """
+        Starts analysis of the file in the background unless it is known already,
+        must be called on the event loop
+        :return: future of the analysis, None if there is nothing to do
+        """
+        if not self.enabled or self.get_measurement(file_path) is not None:
+            return None
+        if file_path not in self.in_progress:
+            task = asyncio.ensure_future(self._analyze(file_path))
+            self.in_progress[file_path] = task
+            task.add_done_callback(lambda _task: self.in_progress.pop(file_path, None))
+        return self.in_progress[file_path]
+
+    async def analyze(self, file_path) -> Optional[float]:
+        """
+        Waits for the analysis of the file
+        :return: same as get_gain
+        """
+        analysis = self.schedule(file_path)
+        if analysis is not None:
+            await asyncio.shield(analysis)
+        return self.get_gain(file_path)
+
+    def schedule_library(self, file_paths: Iterable[str]):
+        """
+        Analyzes files one by one in the background, known ones are skipped
+        """
+        if not self.enabled:
+            return
+        if self.library_task is not None:
+            self.library_task.cancel()
+        self.library_task = asyncio.ensure_future(self._analyze_library(list(file_paths)))
+
+    async def _analyze_library(self, file_paths):
+        analyzed = 0
+        for file_path in file_paths:
+            analysis = self.schedule(file_path)
+            if analysis is None:
+                continue
+            await asyncio.shield(analysis)
+            analyzed += 1
+        if analyzed > 0:
+            self.logger.info("Loudness of %d fallback track(s) has been measured", analyzed)
+
+    def _lower_priority(self):
+        # Runs in the child process before ffmpeg starts
+        if self.nice > 0 and hasattr(os, "nice"):
+            os.nice(self.nice)
+
+    async def _analyze(self, file_path) -> bool:
+        if self.workers is None:
+            # Semaphore must be created inside the running loop
+            self.workers = asyncio.Semaphore(max(1, self.config.getint("loudness", "workers",
+                                                                       fallback=self._default_workers)))
+        async with self.workers:
+            self.logger.debug("Measuring loudness of %s", file_path)
+            start_time = time.time()
+            with mon_analyses_in_progress.track_inprogress():
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        self.ffmpeg, "-nostdin", "-hide_banner", "-nostats", "-i", file_path, "-vn",
+                        "-af", "ebur128=peak=true:framelog=verbose", "-f", "null", "-",
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.PIPE,
+                        preexec_fn=self._lower_priority,
+                    )
+                except OSError as e:
+                    self.logger.error("Unable to start ffmpeg: %s", e)
+                    mon_analysis_failures.inc()
+                    return False
+                try:
+                    _stdout, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    raise
+
+        output = stderr.decode(errors="replace")
+        loudness = self._summary_loudness.findall(output)
+        peak = self._summary_peak.findall(output)
+        if process.returncode != 0 or not loudness or not peak or "-inf" in (loudness[-1], peak[-1]):
+            self.logger.warning("Unable to measure loudness of %s: %s", file_path, output.strip()[-500:])
+            mon_analysis_failures.inc()
+            return False
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError:
+            # File was removed meanwhile
+            return False
+
+        MediaLoudness.insert(
+            file_path=os.path.abspath(file_path),
+            file_size=file_size,
+            loudness=float(loudness[-1]),
+            peak=float(peak[-1]),
+            updated=datetime.datetime.now(),
+        ).on_conflict_replace().execute()
+        mon_analysis_duration.observe(time.time() - start_time)
+        self.logger.info("Loudness of %s: %s LUFS, peak %s dBTP", file_path, loudness[-1], peak[-1])
+        return True
+
+    def cleanup(self):
+        if self.library_task is not None:
+            self.library_task.cancel()
+        for task in list(self.in_progress.values()):
+            task.cancel()
+
+
+_shared_analyzer: Optional[LoudnessAnalyzer] = None
+_shared_analyzer_lock = threading.Lock()
+
+
+def get_loudness_analyzer(config=None) -> LoudnessAnalyzer:
+    """
+    Returns the process-wide analyzer. The first caller decides its settings
+    :param configparser.ConfigParser config:
+    """
+    global _shared_analyzer
+    with _shared_analyzer_lock:
+        if _shared_analyzer is None:
+            _shared_analyzer = LoudnessAnalyzer(config)
+        return _shared_analyzer
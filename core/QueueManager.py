@@ -10,6 +10,7 @@ from mutagen.mp3 import HeaderNotFoundError
 from prometheus_client import Gauge
 
 from utils import get_mp3_info, remove_links
+from .GrowingFile import is_growing_file
 from .models import Song
 
 
@@ -116,9 +117,13 @@ class QueueManager:
 
     # Tracks manipulations
 
-    def add_track(self, path: str, title: str, artist: str, duration: int, user_id: int) -> Song:
+    def add_track(self, path: Optional[str], title: str, artist: str, duration: int, user_id: int,
+                  source: Optional[Dict] = None) -> Song:
+        """
+        :param path: None for a pending track which is downloaded from source later
+        """
         with self.lock:
-            track = Song(path, title, artist, duration, user_id)
+            track = Song(path, title, artist, duration, user_id, source=source)
 
             if user_id not in self.playlists:
                 self.playlists[user_id] = []
@@ -232,13 +237,16 @@ class QueueManager:
             for uid in self.queue:
                 if len(self.playlists[uid]) == 0:
                     continue
+                if self.playlists[uid][0].is_pending:
+                    # Not downloaded yet, the user keeps the place in the queue
+                    continue
 
                 track = self.playlists[uid].pop(0)
                 self.queue.remove(uid)
                 if len(self.playlists[uid]) != 0:
                     self.queue.append(uid)
 
-                if not os.path.isfile(track.media):
+                if not os.path.isfile(track.media) and not is_growing_file(track.media):
                     self.logger.warning("Media does not exist for track: %s", track.title)
                     track = None
                     continue
@@ -268,7 +276,7 @@ class QueueManager:
 
     def get_first_track(self) -> Optional[Song]:
         for uid in self.queue:
-            if len(self.playlists[uid]) > 0:
+            if len(self.playlists[uid]) > 0 and not self.playlists[uid][0].is_pending:
                 return self.playlists[uid][0]
         try:
             return self.backlog[0]
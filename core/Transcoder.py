@@ -0,0 +1,214 @@
+import asyncio
+import glob
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from prometheus_client import Counter, Gauge, Summary
+
+from core.AbstractDownloader import PARTIAL_SUFFIX
+from core.Loudness import get_loudness_analyzer
+
+# Transcoded copies are stored next to the original as <original><tag>.<format>
+STREAM_TAG = ".stream"
+OPUS_TAG = ".discord"
+
+# noinspection PyArgumentList
+mon_transcodes_in_progress = Gauge('dj_transcodes_in_progress', 'Transcodes in progress')
+mon_transcode_duration = Summary('dj_transcode_duration', 'Time spent in transcoding', ['output'])
+mon_transcode_failures = Counter('dj_transcode_failures', 'Transcodes which failed', ['output'])
+
+
+def is_derived_file(file_name) -> bool:
+    """
+    True for transcoded copies of media files
+    """
+    return any(tag + "." in os.path.basename(file_name) for tag in (STREAM_TAG, OPUS_TAG))
+
+
+def derived_files(file_path) -> List[str]:
+    """
+    Transcoded copies of the media file which exist on disk
+    """
+    pattern = glob.escape(file_path)
+    return [f for tag in (STREAM_TAG, OPUS_TAG) for f in glob.glob(pattern + tag + ".*")
+            if not f.endswith(PARTIAL_SUFFIX)]
+
+
+class Transcoder:
+    """
+    Converts downloaded tracks once to the format of the stream (and optionally to Opus for Discord),
+    so that emitters can pass them through instead of transcoding every track live.
+    Loudness gain, if it is enabled, is applied to the copies.
+    Configured from the [transcoder] section, runs at most `workers` ffmpeg processes at a time
+    """
+
+    _default_workers = 1
+    _default_nice = 10
+    _default_stream_codec = "libmp3lame"
+    _default_stream_format = "mp3"
+    _default_stream_bitrate = "320k"
+    _default_samplerate = 44100
+    _default_channels = 2
+    _default_opus_bitrate = "128k"
+
+    def __init__(self, config):
+        """
+        :param configparser.ConfigParser config:
+        """
+        self.config = config
+        self.logger = logging.getLogger("tg_dj.transcoder")
+        self.logger.setLevel(self.config.get("transcoder", "verbosity", fallback="warning").upper())
+
+        self.enabled = self.config.getboolean("transcoder", "enabled", fallback=False)
+        self.opus = self.config.getboolean("transcoder", "opus", fallback=False)
+        self.ffmpeg = self.config.get("transcoder", "ffmpeg", fallback="ffmpeg")
+        self.nice = self.config.getint("transcoder", "nice", fallback=self._default_nice)
+        self.stream_format = self.config.get("transcoder", "stream_format", fallback=self._default_stream_format)
+
+        self.workers: Optional[asyncio.Semaphore] = None
+        # Target path -> transcode in flight
+        self.in_progress: Dict[str, asyncio.Future] = {}
+
+    def stream_path(self, file_path) -> str:
+        return file_path + STREAM_TAG + "." + self.stream_format
+
+    @staticmethod
+    def opus_path(file_path) -> str:
+        return file_path + OPUS_TAG + ".opus"
+
+    def _stream_args(self):
+        return [
+            "-c:a", self.config.get("transcoder", "stream_codec", fallback=self._default_stream_codec),
+            "-b:a", self.config.get("transcoder", "stream_bitrate", fallback=self._default_stream_bitrate),
+            "-ar", str(self.config.getint("transcoder", "samplerate", fallback=self._default_samplerate)),
+            "-ac", str(self.config.getint("transcoder", "channels", fallback=self._default_channels)),
+            "-f", self.stream_format,
+        ]
+
+    def _opus_args(self):
+        return [
+            "-c:a", "libopus",
+            "-b:a", self.config.get("transcoder", "opus_bitrate", fallback=self._default_opus_bitrate),
+            # Discord plays 48 kHz stereo only
+            "-ar", "48000",
+            "-ac", "2",
+            "-f", "opus",
+        ]
+
+    @staticmethod
+    def _is_done(target) -> bool:
+        # Cache hits touch the original, so its mtime tells nothing; media files are never rewritten in place
+        return os.path.exists(target) and os.path.getsize(target) > 0
+
+    def get_stream_media(self, file_path) -> Optional[str]:
+        """
+        :return: copy of the track in the stream format or None if there is none yet
+        """
+        target = self.stream_path(file_path)
+        return target if self.enabled and self._is_done(target) else None
+
+    def get_opus_media(self, file_path) -> Optional[str]:
+        """
+        :return: Opus copy of the track for Discord or None if there is none yet
+        """
+        target = self.opus_path(file_path)
+        return target if self.enabled and self.opus and self._is_done(target) else None
+
+    def schedule(self, file_path):
+        """
+        Starts transcoding of a downloaded track in the background, must be called on the event loop
+        """
+        if not self.enabled:
+            return
+        outputs = [(self.stream_path(file_path), self._stream_args(), "stream")]
+        if self.opus:
+            outputs.append((self.opus_path(file_path), self._opus_args(), "opus"))
+        for target, args, output in outputs:
+            if target in self.in_progress or self._is_done(target):
+                continue
+            task = asyncio.ensure_future(self._transcode(file_path, target, args, output))
+            self.in_progress[target] = task
+            task.add_done_callback(lambda _task, _target=target: self.in_progress.pop(_target, None))
+
+    def _lower_priority(self):
+        # Runs in the child process before ffmpeg starts
+        if self.nice > 0 and hasattr(os, "nice"):
+            os.nice(self.nice)
+
+    async def _transcode(self, source, target, args, output) -> bool:
+        if self.workers is None:
+            # Semaphore must be created inside the running loop
+            self.workers = asyncio.Semaphore(max(1, self.config.getint("transcoder", "workers",
+                                                                       fallback=self._default_workers)))
+        part_path = target + PARTIAL_SUFFIX
+        # Copies are normalized once here, emitters play them as they are
+        gain = await get_loudness_analyzer(self.config).analyze(source)
+        if gain is not None:
+            args = ["-af", "volume=%.2fdB" % gain] + args
+        async with self.workers:
+            self.logger.debug("Transcoding %s to %s", source, target)
+            start_time = time.time()
+            with mon_transcodes_in_progress.track_inprogress():
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+                        "-i", source, "-vn", "-map", "0:a:0", *args, part_path,
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.PIPE,
+                        preexec_fn=self._lower_priority,
+                    )
+                except OSError as e:
+                    self.logger.error("Unable to start ffmpeg: %s", e)
+                    mon_transcode_failures.labels(output).inc()
+                    return False
+                try:
+                    _stdout, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    self._remove(part_path)
+                    raise
+
+            if process.returncode != 0:
+                self.logger.warning("Transcoding of %s failed: %s", source,
+                                    stderr.decode(errors="replace").strip()[-500:])
+                mon_transcode_failures.labels(output).inc()
+                self._remove(part_path)
+                return False
+            if not os.path.exists(source):
+                # Original was removed from the storage meanwhile
+                self._remove(part_path)
+                return False
+            os.replace(part_path, target)
+            mon_transcode_duration.labels(output).observe(time.time() - start_time)
+            self.logger.info("Transcoded %s in %.1f seconds", target, time.time() - start_time)
+            return True
+
+    def _remove(self, file_path):
+        try:
+            os.unlink(file_path)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        for task in list(self.in_progress.values()):
+            task.cancel()
+
+
+_shared_transcoder: Optional[Transcoder] = None
+_shared_transcoder_lock = threading.Lock()
+
+
+def get_transcoder(config=None) -> Transcoder:
+    """
+    Returns the process-wide transcoder. The first caller decides its settings
+    :param configparser.ConfigParser config:
+    """
+    global _shared_transcoder
+    with _shared_transcoder_lock:
+        if _shared_transcoder is None:
+            _shared_transcoder = Transcoder(config)
+        return _shared_transcoder
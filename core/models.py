@@ -6,6 +6,8 @@ import os
 import requests
 import lxml.html
 
+from core.HttpClient import get_http_client
+
 db = peewee.SqliteDatabase("db/dj_brain.db")
 
 
@@ -28,13 +30,28 @@ class Request(BaseModel):
     time = peewee.DateTimeField(default=datetime.datetime.now)
 
 
+class MediaLoudness(BaseModel):
+    file_path = peewee.TextField(unique=True)
+    file_size = peewee.IntegerField()
+    loudness = peewee.FloatField()  # LUFS, integrated
+    peak = peewee.FloatField()  # dBTP
+    updated = peewee.DateTimeField(default=datetime.datetime.now)
+
+
 db.connect()
+# Added after the first release, so existing databases get it here
+db.create_tables([MediaLoudness], safe=True)
 
 
 class Song:
     counter = 0
 
-    def __init__(self, media_path: str, title: str, artist: str, duration: int, user_id: int, forced_id: Optional[int]=None):
+    def __init__(self, media_path: Optional[str], title: str, artist: str, duration: int, user_id: int,
+                 forced_id: Optional[int]=None, source: Optional[Dict[str, Any]]=None):
+        """
+        :param media_path: None while the track is pending, i.e. not downloaded yet
+        :param source: what to pass to MasterDownloader.download for a pending track: {"kind": ..., "query": ...}
+        """
         if forced_id is None:
             self.__class__.counter += 1
             self.id = self.__class__.counter
@@ -46,11 +63,16 @@ class Song:
         self.duration = duration
         self.user_id = user_id
         self.media = media_path
+        self.source = source
 
         self.lyrics: Optional[str] = None
 
         self.haters = []
 
+    @property
+    def is_pending(self) -> bool:
+        return self.media is None
+
     def __repr__(self):
         return "Song(title: {}, artist: {}, id: {})".format(self.title, self.artist, self.id)
 
@@ -66,6 +88,7 @@ class Song:
                 "duration": self.duration,
                 "user_id": self.user_id,
                 "media": self.media,
+                "source": self.source,
                 "haters": self.haters,
             }
         else:
@@ -76,6 +99,7 @@ class Song:
                 "duration": 1,
                 "user_id": 0,
                 "media": "",
+                "source": None,
                 "haters": [],
             }
 
@@ -87,7 +111,7 @@ class Song:
         elif self.title is not None and len(self.title) > 0:
             return self.title
         else:
-            return os.path.splitext(os.path.basename(self.media))[0]
+            return os.path.splitext(os.path.basename(self.media or ""))[0]
 
     def add_hater(self, user_id: int):
         if user_id not in self.haters:
@@ -100,7 +124,8 @@ class Song:
     @classmethod
     def from_dict(cls, song_dict: Dict[str, Any]):
         obj = cls(song_dict["media"], song_dict["title"], song_dict["artist"],
-                  song_dict["duration"], song_dict["user_id"], forced_id=song_dict["id"])
+                  song_dict["duration"], song_dict["user_id"], forced_id=song_dict["id"],
+                  source=song_dict.get("source"))
         if "haters" in song_dict:
             obj.haters = song_dict["haters"]
         return obj
@@ -109,7 +134,11 @@ class Song:
     def fetch_lyrics(self):
         print("Loading lyrics...")
         url = "http://lyrics.wikia.com/wiki/{0}:{1}".format(self.artist, self.title)
-        lyrics_request = requests.get(url)
+        try:
+            lyrics_request = get_http_client().get(url)
+        except requests.exceptions.RequestException:
+            self.lyrics = ""
+            return
         if lyrics_request.status_code != 200:
             self.lyrics = ""
             return
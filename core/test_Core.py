@@ -0,0 +1,174 @@
+import asyncio
+import configparser
+import logging
+
+from core.Core import Core
+from core.models import Song
+
+
+class FakeQueue:
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.removed = []
+
+    def get_queue_tracks(self, offset, limit):
+        return self.tracks[offset:offset + limit]
+
+    def get_track(self, track_id):
+        return next((track for track in self.tracks if track.id == track_id), None)
+
+    def remove_track(self, track_id):
+        self.removed.append(track_id)
+        self.tracks = [track for track in self.tracks if track.id != track_id]
+
+
+class FakeDownloader:
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.queries = []
+
+    async def download(self, kind, query, user_message, token):
+        self.queries.append(query)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+    async def flush_callbacks(self):
+        pass
+
+
+def make_core(current_track, downloader, tracks=(), lazy_downloads=True):
+    config = configparser.ConfigParser()
+    config.read_dict({"core": {"prefetch_distance": "2"}})
+    core = Core.__new__(Core)
+    core.config = config
+    core.logger = logging.getLogger("tg_dj.core")
+    core.isWindows = False
+    core.frontends = []
+    core.downloader = downloader
+    core.queueManager = FakeQueue(list(tracks))
+    core.current_track = current_track
+    core.playback_idle = current_track is None
+    core.lazy_downloads = lazy_downloads
+    core.download_tokens = {}
+    core.prefetch_tokens = {}
+    core.progressive_tokens = {}
+    core.started = 0
+    core.preload_next_track = lambda: None
+
+    def play_next_track():
+        core.started += 1
+
+    core.play_next_track = play_next_track
+    return core
+
+
+def pending_track(user_id=1):
+    return Song(None, "query", "", 0, user_id, source={"kind": "text", "query": "query"})
+
+
+def prefetch(core, track):
+    token = core._start_task(track.user_id, 0)
+    core.prefetch_tokens[track.id] = token
+    asyncio.run(core._prefetch(track, token))
+
+
+def test_ready_pending_track_interrupts_fallback_track():
+    track = pending_track()
+    core = make_core(Song("fallback.mp3", "Fallback", "", 100, -1), FakeDownloader(("a.mp3", "Title", "Artist", 60)))
+    prefetch(core, track)
+    assert track.media == "a.mp3" and track.title == "Title"
+    assert core.started == 1
+    assert core.prefetch_tokens == {} and core.download_tokens == {}
+
+
+def test_ready_pending_track_starts_when_idle():
+    track = pending_track()
+    core = make_core(None, FakeDownloader(("a.mp3", "Title", "Artist", 60)))
+    prefetch(core, track)
+    assert core.started == 1
+
+
+def test_ready_pending_track_waits_for_user_track():
+    track = pending_track()
+    core = make_core(Song("b.mp3", "Other", "", 100, 2), FakeDownloader(("a.mp3", "Title", "Artist", 60)))
+    prefetch(core, track)
+    assert track.media == "a.mp3"
+    assert core.started == 0
+
+
+def test_failed_pending_track_is_removed():
+    track = pending_track()
+    core = make_core(None, FakeDownloader(error=RuntimeError("broken")))
+    prefetch(core, track)
+    assert core.queueManager.removed == [track.id]
+    assert core.started == 0
+
+
+def test_cancelled_pending_track_stays_queued():
+    track = pending_track()
+    core = make_core(None, FakeDownloader())
+    token = core._start_task(track.user_id, 0)
+    core.prefetch_tokens[track.id] = token
+    token.cancel()
+    asyncio.run(core._prefetch(track, token))
+    assert core.queueManager.removed == []
+    assert track.is_pending
+
+
+def test_schedule_prefetch_downloads_only_near_pending_tracks():
+    tracks = [Song("ready.mp3", "Ready", "", 60, 1), pending_track(), pending_track()]
+    downloader = FakeDownloader(("a.mp3", "Title", "Artist", 60))
+    core = make_core(Song("b.mp3", "Other", "", 100, 2), downloader, tracks)
+
+    async def run():
+        core.loop = asyncio.get_running_loop()
+        core.schedule_prefetch()
+        assert set(core.prefetch_tokens) == {tracks[1].id}
+        # Already running downloads are not started again
+        core.schedule_prefetch()
+        while core.prefetch_tokens:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert len(downloader.queries) == 1
+    assert tracks[1].media == "a.mp3" and tracks[2].is_pending
+
+
+def test_schedule_prefetch_does_nothing_without_lazy_downloads():
+    tracks = [pending_track()]
+    core = make_core(None, FakeDownloader(), tracks, lazy_downloads=False)
+    core.schedule_prefetch()
+    assert core.prefetch_tokens == {}
+
+
+def test_stop_cancels_only_downloads_of_queued_tracks():
+    core = make_core(None, FakeDownloader())
+    search = core._start_task(1, 0)
+    prefetch_token = core._start_task(1, 0)
+    progressive_token = core._start_task(2, 0)
+    core.prefetch_tokens[10] = prefetch_token
+    core.progressive_tokens[11] = progressive_token
+    assert core.cancel_downloads() == 2
+    assert prefetch_token.cancelled and progressive_token.cancelled
+    assert not search.cancelled
+
+
+def test_deleted_progressive_track_is_not_reported():
+    track = Song("growing.mp3", "Title", "", 60, 1)
+    core = make_core(None, FakeDownloader(), [track])
+    notified = []
+    core._notify_user = lambda user_id, text: notified.append(user_id)
+    token = core._start_task(track.user_id, 0)
+    core.progressive_tokens[track.id] = token
+
+    async def run():
+        download = asyncio.get_running_loop().create_future()
+        core.queueManager.remove_track(track.id)
+        token.cancel()
+        download.set_exception(RuntimeError("cancelled"))
+        core._progressive_download_done(track, token, download)
+
+    asyncio.run(run())
+    assert notified == [] and core.progressive_tokens == {} and core.download_tokens == {}
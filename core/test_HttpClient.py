@@ -0,0 +1,105 @@
+import asyncio
+import configparser
+
+import pytest
+
+from core.HttpClient import CircuitBreaker, HostGuard, TokenBucket, is_host_failure
+
+
+def make_guard(**options):
+    config = configparser.ConfigParser()
+    config.read_dict({"http": options})
+    return HostGuard(config)
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker("test-opens", failures=3, reset_timeout=30)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    breaker.success()
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert 0 < breaker.retry_after() <= 30
+
+
+def test_breaker_lets_one_probe_through_when_half_open():
+    breaker = CircuitBreaker("test-probe", failures=1, reset_timeout=0)
+    breaker.failure()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_released_probe_is_given_again():
+    breaker = CircuitBreaker("test-release", failures=1, reset_timeout=0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_cancelled_rate_limit_wait_releases_probe():
+    guard = make_guard(host_rate="1", host_burst="1", breaker_failures="1", breaker_reset="0")
+    guard.failure("cancelled.example")
+
+    async def run():
+        # Uses up the only token, so the probe has to wait for the next one
+        guard.limiter.reserve("cancelled.example")
+        task = asyncio.ensure_future(guard.acquire("cancelled.example"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert not guard.breaker("cancelled.example").probing
+    assert guard.breaker("cancelled.example").allow()
+
+
+def test_failing_host_is_skipped():
+    guard = make_guard(breaker_failures="2", breaker_reset="30")
+    guard.failure("failing.example")
+    assert asyncio.run(guard.acquire("failing.example"))
+    guard.failure("failing.example")
+    assert not asyncio.run(guard.acquire("failing.example"))
+    assert not guard.acquire_sync("failing.example")
+    assert guard.acquire_sync("other.example")
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+    assert TokenBucket(rate=0, burst=1).reserve() == 0
+
+
+def test_host_failure_statuses():
+    assert is_host_failure(503) and is_host_failure(429)
+    assert not is_host_failure(404) and not is_host_failure(200)
+
+
+def test_shared_client_takes_settings_of_the_first_config(monkeypatch):
+    from core import HttpClient as module
+    monkeypatch.setattr(module, "_shared_client", None)
+    default = module.get_http_client()
+    assert default.timeout == (5.0, 30.0)
+
+    config = configparser.ConfigParser()
+    config.read_dict({"http": {"connect_timeout": "2", "read_timeout": "7"}})
+    configured = module.get_http_client(config)
+    assert configured is not default and configured.timeout == (2.0, 7.0)
+    assert module.get_http_client() is configured
+    assert module.get_http_client(configparser.ConfigParser()) is configured
@@ -0,0 +1,58 @@
+import configparser
+
+import pytest
+
+from core.QueueManager import QueueManager
+
+
+@pytest.fixture(scope="module")
+def queue_manager(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("queue")
+    (directory / "fallback").mkdir()
+    config = configparser.ConfigParser()
+    config.read_dict({"queue_manager": {"queue_file": str(directory / "queue.json"),
+                                        "fallback_media_dir": str(directory / "fallback")}})
+    # Metrics are registered once per process, so the manager is shared and emptied for every test
+    return QueueManager(config)
+
+
+@pytest.fixture
+def manager(queue_manager):
+    queue_manager.queue = []
+    queue_manager.playlists = {-1: []}
+    queue_manager.backlog = []
+    return queue_manager
+
+
+def add(manager, user_id, path=None):
+    """
+    :param path: file of the track, None for a pending track
+    """
+    if path is not None:
+        path.write_bytes(b"\0")
+        path = str(path)
+    track = manager.add_track(path, path or "pending", "", 60, user_id, source={"kind": "text", "query": "q"})
+    if not manager.is_in_queue(user_id):
+        manager.add_to_queue(user_id)
+    return track
+
+
+def test_pending_track_keeps_its_place(manager, tmp_path):
+    pending = add(manager, 1)
+    ready = add(manager, 2, tmp_path / "b.mp3")
+    assert manager.get_first_track() is ready
+    assert manager.pop_first_track() is ready
+    assert manager.get_first_track() is None
+    assert manager.pop_first_track() is None
+
+    pending.media = str(tmp_path / "b.mp3")
+    assert manager.get_first_track() is pending
+    assert manager.pop_first_track() is pending
+
+
+def test_pending_tracks_are_listed_for_prefetch(manager, tmp_path):
+    first = add(manager, 1)
+    second = add(manager, 2, tmp_path / "b.mp3")
+    third = add(manager, 1)
+    assert manager.get_queue_tracks(0, 2) == [first, second]
+    assert manager.get_queue_tracks() == [first, second, third]
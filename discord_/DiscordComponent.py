@@ -3,17 +3,22 @@ import asyncio
 
 import concurrent.futures
 from concurrent.futures import CancelledError
-from typing import Optional
+from typing import Dict, Optional
 
 import discord
 import logging
+import os
 import traceback
 
 import peewee
 
 from core.AbstractFrontend import AbstractFrontend, FrontendUserInfo
 from core.AbstractRadioEmitter import AbstractRadioEmitter
+from core.GrowingFile import open_growing_media
+from core.Loudness import get_loudness_analyzer
+from core.Transcoder import get_transcoder
 from core.models import Song
+from discord_.VoiceFanout import OpusFanout
 from discord_.jinja_env import env
 
 from core.Core import UserBanned, UserRequestQuotaReached, DownloadFailed, PermissionDenied, Core
@@ -70,6 +75,9 @@ choice_emoji = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣"
 
 # noinspection PyMissingConstructor
 class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
+    _default_opus_bitrate = 128  # kbps
+    _default_voice_buffer = 50  # packets of 20 ms
+
     def __init__(self, config, discord_client: discord.Client):
         """
         :param configparser.ConfigParser config:
@@ -106,7 +114,12 @@ class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
                                                 "\n".join([self.command_prefix + k for k in self.commands]))
 
         self.startup_notifications = {}
-        self.voice_channel: Optional[discord.VoiceClient] = None
+        # Voice clients by guild id, all of them play the same stream
+        self.voice_clients: Dict[int, discord.VoiceClient] = {}
+        self.waiting_track: Optional[Song] = None
+        self.fanout = OpusFanout(self.config.getint("discord", "voice_buffer", fallback=self._default_voice_buffer))
+        # Pipe of a track which is still being downloaded
+        self.media_pipe = None
 
         # noinspection PyArgumentList
         # self.mon_tg_updates = Counter('dj_tg_updates', 'Telegram updates counter')
@@ -156,7 +169,6 @@ class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
                 voice_channel = self.bot.get_channel(guild_channel.voice_channel_id)
                 if voice_channel is not None:
                     await self.join_voice(voice_channel)
-                    break
         self.switch_track(self.core.get_current_song())
 
     async def greet_guilds(self):
@@ -342,8 +354,6 @@ class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
             self.logger.info(f'guild {message.guild.name} updated voice channel: {message.channel.name}')
 
             await message.channel.send(f'Теперь буду петь в {voice_channel.name}')
-            if self.voice_channel is not None:
-                await self.voice_channel.disconnect()
             await self.join_voice(voice_channel)
         else:
             await message.channel.send(f'You have no power here! He-he')
@@ -382,6 +392,7 @@ class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
         if self.discord_starting_task is not None:
             self.discord_starting_task.cancel()
         self.thread_pool.shutdown()
+        self.fanout.cleanup()
         self.logger.info("Polling have been stopped")
 
     def accept_user(self, core_user_id: int) -> bool:
@@ -437,18 +448,62 @@ class DiscordComponent(AbstractFrontend, AbstractRadioEmitter):
         await channel.send(f"{discord_user.mention()} Песня добавлена в очередь: {global_position}")
 
     def stop(self):
-        self.voice_channel.stop()
+        self.waiting_track = None
+        self.fanout.set_source(None)
+        self._close_media_pipe()
+
+    def _close_media_pipe(self):
+        if self.media_pipe is not None:
+            self.media_pipe.close()
+            self.media_pipe = None
 
     def switch_track(self, track: Song):
-        if self.voice_channel is not None:
-            # todo: change to discord.FFmpegOpusAudio
-            if self.voice_channel.is_playing():
-                self.voice_channel.stop()
-            self.voice_channel.play(discord.FFmpegPCMAudio(track.media))
+        if not self.voice_clients:
+            # Nobody to play to, the track is started when a voice client joins
+            self.waiting_track = track
+            return
+        self.waiting_track = None
+        # The track is read once for all voice clients
+        self.fanout.set_source(None)
+        self._close_media_pipe()
+        fd = open_growing_media(track.media)
+        opus_media = None if fd is not None else get_transcoder(self.config).get_opus_media(track.media)
+        # Opus is always produced by ffmpeg, discord.py only sends the packets
+        bitrate = self.config.getint("discord", "opus_bitrate", fallback=self._default_opus_bitrate)
+        if opus_media is not None:
+            # Opus packets are sent as they are, without decoding
+            self.fanout.set_source(discord.FFmpegOpusAudio(opus_media, codec="copy"))
+        elif fd is None:
+            gain = get_loudness_analyzer(self.config).get_gain(track.media)
+            # FFmpeg decodes the track anyway, so the gain costs nothing extra
+            options = None if gain is None else "-af volume=%.2fdB" % gain
+            self.fanout.set_source(discord.FFmpegOpusAudio(track.media, bitrate=bitrate, options=options))
+        else:
+            # Track is still being downloaded
+            self.media_pipe = os.fdopen(fd, "rb")
+            self.fanout.set_source(discord.FFmpegOpusAudio(self.media_pipe, bitrate=bitrate, pipe=True))
 
     async def join_voice(self, voice_channel: discord.VoiceChannel):
-        self.voice_channel = await voice_channel.connect()
-        # self.voice_channels[voice_channel] = voice_protocol
+        guild_id = voice_channel.guild.id
+        previous = self.voice_clients.pop(guild_id, None)
+        if previous is not None:
+            await previous.disconnect()
+        voice_client = await voice_channel.connect()
+        self.voice_clients[guild_id] = voice_client
+        # Client plays the shared stream until it disconnects
+        voice_client.play(self.fanout.add_listener(guild_id),
+                          after=lambda _error: self._forget_voice_client(guild_id, voice_client))
+        self.logger.info("Playing in %s of %s, %d voice client(s)", voice_channel.name, voice_channel.guild.name,
+                         len(self.voice_clients))
+        if self.waiting_track is not None:
+            self.switch_track(self.waiting_track)
+
+    def _forget_voice_client(self, guild_id, voice_client: discord.VoiceClient):
+        # Called from the player's thread
+        def forget():
+            if self.voice_clients.get(guild_id) is voice_client:
+                del self.voice_clients[guild_id]
+        self.core.loop.call_soon_threadsafe(forget)
 
 
 
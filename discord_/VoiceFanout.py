@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+import discord
+from discord.opus import OPUS_SILENCE
+from prometheus_client import Counter, Gauge
+
+# noinspection PyArgumentList
+mon_voice_clients = Gauge('dj_discord_voice_clients', 'Voice clients fed with the stream')
+# noinspection PyArgumentList
+mon_dropped_packets = Counter('dj_discord_dropped_packets', 'Opus packets dropped for slow voice clients')
+
+_FRAME_DURATION = 0.02  # seconds, discord.py sends one Opus packet per 20 ms
+
+
+class FanoutListener(discord.AudioSource):
+    """
+    Voice client's view of the shared stream: packets queued for it by the fan-out.
+    It never ends, silence is sent while there is nothing to play
+    """
+
+    def __init__(self, fanout: "OpusFanout", key, buffer_packets):
+        self.fanout = fanout
+        self.key = key
+        self.packets: Deque[bytes] = deque(maxlen=buffer_packets)
+
+    def push(self, packet):
+        if len(self.packets) == self.packets.maxlen:
+            # Client can't keep up, its oldest packet is dropped
+            mon_dropped_packets.inc()
+        self.packets.append(packet)
+
+    def read(self) -> bytes:
+        try:
+            return self.packets.popleft()
+        except IndexError:
+            return OPUS_SILENCE
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self.fanout.remove_listener(self)
+
+
+class OpusFanout:
+    """
+    Reads Opus packets of the current track once, at real-time pace, in its own thread, and hands them
+    to any number of voice clients, each through its own bounded buffer. A voice client costs only
+    its socket writes, done by the client's player thread
+    """
+
+    def __init__(self, buffer_packets):
+        """
+        :param int buffer_packets: packets kept for a voice client before the oldest ones are dropped
+        """
+        self.logger = logging.getLogger("discord.fanout")
+        self.buffer_packets = buffer_packets
+        self.listeners: Dict[object, FanoutListener] = {}
+        self.source: Optional[discord.AudioSource] = None
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+
+        mon_voice_clients.set_function(lambda: len(self.listeners))
+
+    def add_listener(self, key) -> FanoutListener:
+        """
+        :param key: one listener per key, e.g. per guild; an old listener with the same key is replaced
+        :return: audio source to play in a voice client
+        """
+        listener = FanoutListener(self, key, self.buffer_packets)
+        with self.lock:
+            self.listeners[key] = listener
+        self._start()
+        return listener
+
+    def remove_listener(self, listener: FanoutListener):
+        with self.lock:
+            if self.listeners.get(listener.key) is listener:
+                del self.listeners[listener.key]
+
+    def set_source(self, source: Optional[discord.AudioSource]):
+        """
+        Switches all listeners to the source, the previous one is cleaned up
+        :param source: Opus source, None to play silence
+        """
+        with self.lock:
+            previous, self.source = self.source, source
+            for listener in self.listeners.values():
+                # Rest of the previous track is not played
+                listener.packets.clear()
+        if previous is not None:
+            previous.cleanup()
+        self._start()
+
+    def _start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="discord-fanout", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        frames = 0
+        while self.running:
+            with self.lock:
+                source = self.source
+            if source is not None:
+                try:
+                    packet = source.read()
+                except (OSError, ValueError) as e:
+                    # Source was cleaned up while being read
+                    self.logger.debug("Unable to read the source: %s", e)
+                    packet = b""
+                with self.lock:
+                    if source is self.source:
+                        if packet:
+                            for listener in self.listeners.values():
+                                listener.push(packet)
+                        else:
+                            # End of the track, listeners play silence until the next one
+                            self.source = None
+                            source.cleanup()
+            frames += 1
+            delay = start + frames * _FRAME_DURATION - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                self.logger.warning("Fan-out is %.1f seconds late, pace is reset", -delay)
+                start, frames = time.perf_counter(), 0
+
+    def cleanup(self):
+        self.running = False
+        with self.lock:
+            source, self.source = self.source, None
+        if source is not None:
+            source.cleanup()
@@ -1,11 +1,11 @@
 import os
 import logging
 
-from core.AbstractDownloader import AbstractDownloader, MediaIsTooLong, MediaIsTooBig
+from core.AbstractDownloader import AbstractAsyncDownloader, MediaIsTooLong, MediaIsTooBig
 from utils import remove_links
 
 
-class FileDownloader(AbstractDownloader):
+class FileDownloader(AbstractAsyncDownloader):
     name = "file downloader"
 
     def __init__(self, config):
@@ -19,7 +19,10 @@ class FileDownloader(AbstractDownloader):
     def is_acceptable(self, kind, query):
         return kind == "file"
 
-    def download(self, query, user_message=lambda text: True):
+    def describe(self, kind, query):
+        return remove_links(query["title"]).strip(), remove_links(query["artist"]).strip(), query["duration"]
+
+    async def download(self, query, user_message=lambda text: True, token=None):
         file_id = query["id"]
         duration = query["duration"]
         file_size = query["size"]
@@ -50,11 +53,12 @@ class FileDownloader(AbstractDownloader):
         tg_api_url = self.config.get("telegram", "api_url", fallback="https://api.telegram.org/")
         bot_token = self.config.get("telegram", "token")
 
-        self.get_file(
+        await self.get_file(
             url=tg_api_url + 'file/bot{0}/{1}'.format(bot_token, file_info.file_path),
             file_path=file_path,
             file_size=file_size,
             percent_callback=lambda p: user_message("Скачиваем [%d%%]...\n%s" % (int(p), title)),
+            token=token,
         )
 
         self.logger.debug("Download complete #" + str(file_id))
@@ -1,15 +1,18 @@
 import os
-import requests
-from time import sleep
+import datetime
 import lxml.html
 import hashlib
 import logging
+from urllib.parse import urlparse
 
 from user_agent import generate_user_agent
 
-from core.AbstractDownloader import AbstractDownloader, DownloaderException, MediaIsTooLong, MediaIsTooBig, \
-    BadReturnStatus, NothingFound, ApiError
-from utils import sanitize_file_name
+from core.AbstractDownloader import AbstractAsyncDownloader, DownloaderException, MediaIsTooLong, MediaIsTooBig, \
+    BadReturnStatus, NothingFound, ApiError, UrlOrNetworkProblem
+from core.HttpClient import NETWORK_ERRORS
+from downloaders.HtmlExtractor import SearchPageExtractor
+from downloaders.models import HtmlSearchResult, db as downloader_cache_db
+from utils import sanitize_file_name, LRUCache
 
 # #DEBUG requests
 # try:
@@ -27,15 +30,29 @@ from utils import sanitize_file_name
 # requests_log.propagate = True
 
 
-class HtmlDownloader(AbstractDownloader):
+class HtmlDownloader(AbstractAsyncDownloader):
     name = "html downloader"
 
+    _default_result_ttl = 7 * 24 * 3600  # seconds
+
     def __init__(self, config):
         super().__init__(config)
         self.logger = logging.getLogger("tg_dj.downloader.html")
         self.logger.setLevel(self.config.get("downloader_html", "verbosity", fallback="warning").upper())
-        self.songs_cache = {}
         self.skip_head = self.config.get("downloader_html", "skip_head", fallback=True)
+        self.resolved_urls = LRUCache(
+            self.config.getint("downloader_html", "resolved_url_cache_size", fallback=1000),
+            self.config.getint("downloader_html", "resolved_url_ttl", fallback=3600),
+        )
+        site = urlparse(self.config.get("downloader_html", "base_uri", fallback="")).hostname
+        if site is not None:
+            # Replaces a fixed pause between requests to the site
+            self.host_guard.limiter.configure(
+                site,
+                self.config.getfloat("downloader_html", "host_rate", fallback=1),
+                self.config.getint("downloader_html", "host_burst", fallback=2),
+            )
+        self.search_extractor = None
 
     def is_acceptable(self, kind, query):
         return kind == "search" or kind == "search_result"
@@ -51,7 +68,95 @@ class HtmlDownloader(AbstractDownloader):
             "Pragma": "no-cache"
         }
 
-    def search(self, query, user_message=lambda text: True, limit=1000):
+    def get_result_ttl(self):
+        return datetime.timedelta(seconds=self.config.getint("downloader_html", "result_ttl",
+                                                             fallback=self._default_result_ttl))
+
+    def store_results(self, songs):
+        """
+        Remembers search results, so they can be downloaded by id even after a restart
+        """
+        now = datetime.datetime.now()
+        with downloader_cache_db.atomic():
+            for s in songs:
+                HtmlSearchResult.insert(
+                    result_id=s["result_id"],
+                    title=s["title"],
+                    artist=s["artist"],
+                    duration=s["duration"],
+                    link=s["link"],
+                    updated=now,
+                ).on_conflict_replace().execute()
+            HtmlSearchResult.delete().where(HtmlSearchResult.updated <= now - self.get_result_ttl()).execute()
+
+    def describe(self, kind, query):
+        if kind != "search_result":
+            return None
+        song = self.get_result(query["id"])
+        if song is None:
+            return None
+        return song["title"], song["artist"], song["duration"]
+
+    def get_result(self, result_id):
+        try:
+            result = HtmlSearchResult.get(
+                HtmlSearchResult.result_id == result_id,
+                HtmlSearchResult.updated > datetime.datetime.now() - self.get_result_ttl(),
+            )
+        except HtmlSearchResult.DoesNotExist:
+            return None
+        return {
+            "title": result.title,
+            "artist": result.artist,
+            "duration": result.duration,
+            "link": result.link,
+        }
+
+    async def _fetch_page(self, url, headers):
+        try:
+            response = await self._request("GET", url, headers=headers)
+            try:
+                if response.status != 200:
+                    raise BadReturnStatus(response.status)
+                return await response.text()
+            finally:
+                response.release()
+        except NETWORK_ERRORS as e:
+            raise UrlOrNetworkProblem(e)
+
+    def get_search_extractor(self):
+        if self.search_extractor is None:
+            self.search_extractor = SearchPageExtractor({
+                "title": self.config.get("downloader_html", "search_page_xpath_titles"),
+                "artist": self.config.get("downloader_html", "search_page_xpath_artists"),
+                "duration": self.config.get("downloader_html", "search_page_xpath_durations"),
+                "rating": self.config.get("downloader_html", "search_page_xpath_ratings"),
+                "link": self.config.get("downloader_html", "search_page_xpath_page_links"),
+            })
+        return self.search_extractor
+
+    async def _extract_page(self, url, headers, token):
+        """
+        Parses the search page while it is being received
+        """
+        extractor = self.get_search_extractor()
+        try:
+            response = await self._request("GET", url, headers=headers)
+            try:
+                if response.status != 200:
+                    raise BadReturnStatus(response.status)
+                extraction = extractor.start(response.charset)
+                async for chunk in response.content.iter_chunked(self._chunk_size):
+                    if token is not None:
+                        token.check()
+                    extraction.feed(chunk)
+                return extraction.close()
+            finally:
+                response.release()
+        except NETWORK_ERRORS as e:
+            raise UrlOrNetworkProblem(e)
+
+    async def search(self, query, user_message=lambda text: True, limit=1000, token=None):
         self.logger.debug("Search query: " + query)
 
         if len(query.strip()) == 0:
@@ -62,21 +167,8 @@ class HtmlDownloader(AbstractDownloader):
 
         self.logger.debug("Getting data from " + base_uri + " with query " + query)
         headers = self.get_headers()
-        search_request = requests.get((base_uri + search_uri).format(query), headers=headers)
-        if search_request.status_code != 200:
-            raise BadReturnStatus(search_request.status_code)
-
-        tree = lxml.html.fromstring(search_request.text)
-
-        titles = tree.xpath(self.config.get("downloader_html", "search_page_xpath_titles"))
-        artists = tree.xpath(self.config.get("downloader_html", "search_page_xpath_artists"))
-        durations = tree.xpath(self.config.get("downloader_html", "search_page_xpath_durations"))
-        ratings = tree.xpath(self.config.get("downloader_html", "search_page_xpath_ratings"))
-        links = tree.xpath(self.config.get("downloader_html", "search_page_xpath_page_links"))
-
-        songs = []
-        for el in zip(titles, artists, durations, ratings, links):
-            songs.append(dict(zip(("title", "artist", "duration", "rating", "link"), el)))
+        # Whole page is read, results are limited only after they are sorted by rating
+        songs = await self._extract_page((base_uri + search_uri).format(query), headers, token)
 
         for s in songs:
             time_parts = s["duration"].split(":")
@@ -95,9 +187,10 @@ class HtmlDownloader(AbstractDownloader):
             raise NothingFound()
 
         ret = []
+        stored = []
         for s in songs:
             song_id = hashlib.sha1(str(s["link"]).encode("utf-8")).hexdigest()
-            self.songs_cache[song_id] = s
+            stored.append(dict(s, result_id=song_id))
 
             ret.append({
                 "id": song_id,
@@ -109,35 +202,23 @@ class HtmlDownloader(AbstractDownloader):
             if len(ret) >= limit:
                 break
 
+        self.store_results(stored)
         return ret
 
-    def download(self, query, user_message=lambda text: True):
+    async def download(self, query, user_message=lambda text: True, token=None):
         result_id = query["id"]
         self.logger.debug("Downloading result #" + str(result_id))
 
-        base_uri = self.config.get("downloader_html", "base_uri")
-        download_xpath = self.config.get("downloader_html", "download_page_xpath")
         media_dir = self.config.get("downloader", "media_dir", fallback="media")
 
-        try:
-            song = self.songs_cache[result_id]
-        except KeyError:
+        song = self.get_result(result_id)
+        if song is None:
             self.logger.error("No search cache entry for id " + result_id)
             raise DownloaderException("Внутренняя ошибка (запрошенная песня отсутствует в кэше поиска)")
 
         if song["duration"] > self.config.getint("downloader", "max_duration", fallback=self._default_max_duration):
             raise MediaIsTooLong(song["duration"])
 
-        headers = self.get_headers()
-        search_request = requests.get((base_uri + song["link"]), headers=headers)
-        if search_request.status_code != 200:
-            raise BadReturnStatus(search_request.status_code)
-        tree = lxml.html.fromstring(search_request.text)
-        right_part: str = tree.xpath(download_xpath)[0]
-        # if right_part.startswith("//"):
-        #     right_part = right_part[1:]
-        download_uri = base_uri + right_part
-
         file_name = sanitize_file_name("html-" + str(result_id) + '.mp3')
         file_path = os.path.join(os.getcwd(), media_dir, file_name)
 
@@ -152,40 +233,81 @@ class HtmlDownloader(AbstractDownloader):
         self.logger.info("Downloading song #" + result_id)
         user_message("Скачиваем...\n%s — %s" % (song["artist"], song["title"]))
 
-        file_size = None
+        # Only a link taken from the cache may be stale, a freshly resolved one is not resolved again
+        from_cache = self.resolved_urls.get(result_id) is not None
+        try:
+            await self._download_resolved(result_id, song, file_path, user_message, token)
+        except BadReturnStatus:
+            if not from_cache:
+                raise
+            self.resolved_urls.pop(result_id)
+            # Resolved link may have expired, resolve it once again
+            self.logger.info("Cached download link for #%s failed, resolving again" % result_id)
+            await self._download_resolved(result_id, song, file_path, user_message, token)
 
-        if not self.skip_head:
-            response_head = requests.head(
-                download_uri,
-                headers=self.get_headers(),
-                allow_redirects=True,
-                stream=True,
-            )
-            if response_head.status_code != 200:
-                raise BadReturnStatus(response_head.status_code)
-            try:
-                file_size = int(response_head.headers['content-length'])
-            except KeyError as e:
-                self.logger.error("No header \"content-length\". More information below\n" + str(e))
-                raise ApiError
-            if file_size > 1000000 * self.config.getint("downloader", "max_file_size", fallback=self._default_max_size):
-                raise MediaIsTooBig(file_size)
+        self.logger.debug("Download completed #" + str(result_id))
 
-            sleep(1)
+        self.touch_without_creation(file_path)
+
+        self.logger.debug("File stored in path: " + file_path)
 
-        self.get_file(
+        return file_path, song["title"], song["artist"], song["duration"]
+
+    async def _download_resolved(self, result_id, song, file_path, user_message, token):
+        download_uri, file_size = await self.resolve_download(result_id, song)
+        await self.get_file(
             url=download_uri,
             file_path=file_path,
             file_size=file_size,
             percent_callback=lambda p: user_message("Скачиваем [%d%%]...\n%s — %s"
                                                     % (int(p), song["artist"], song["title"])),
             headers=self.get_headers(),
+            token=token,
         )
 
-        self.logger.debug("Download completed #" + str(result_id))
+    async def resolve_download(self, result_id, song):
+        """
+        Finds the media link on the track page and, unless skip_head is set, its size.
+        Results are cached for resolved_url_ttl seconds
+        :return: (download uri, file size or None)
+        """
+        resolved = self.resolved_urls.get(result_id)
+        if resolved is not None:
+            self.logger.debug("Download link for #%s is taken from cache" % result_id)
+            return resolved
 
-        self.touch_without_creation(file_path)
+        base_uri = self.config.get("downloader_html", "base_uri")
+        download_xpath = self.config.get("downloader_html", "download_page_xpath")
 
-        self.logger.debug("File stored in path: " + file_path)
+        headers = self.get_headers()
+        page = await self._fetch_page(base_uri + song["link"], headers)
+        tree = lxml.html.fromstring(page)
+        right_part: str = tree.xpath(download_xpath)[0]
+        # if right_part.startswith("//"):
+        #     right_part = right_part[1:]
+        download_uri = base_uri + right_part
 
-        return file_path, song["title"], song["artist"], song["duration"]
+        file_size = None
+
+        if not self.skip_head:
+            try:
+                response_head = await self._request(
+                    "HEAD", download_uri,
+                    headers=self.get_headers(),
+                    allow_redirects=True,
+                )
+            except NETWORK_ERRORS as e:
+                raise UrlOrNetworkProblem(e)
+            response_head.release()
+            if response_head.status != 200:
+                raise BadReturnStatus(response_head.status)
+            try:
+                file_size = int(response_head.headers['content-length'])
+            except KeyError as e:
+                self.logger.error("No header \"content-length\". More information below\n" + str(e))
+                raise ApiError
+            if file_size > 1000000 * self.config.getint("downloader", "max_file_size", fallback=self._default_max_size):
+                raise MediaIsTooBig(file_size)
+
+        self.resolved_urls.set(result_id, (download_uri, file_size))
+        return download_uri, file_size
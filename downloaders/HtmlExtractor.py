@@ -0,0 +1,253 @@
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+import lxml.etree
+import lxml.html
+
+
+def split_xpath(expression) -> Optional[List[Tuple[str, str]]]:
+    """
+    Splits an absolute location path into (separator, step) pairs
+    :return: None if the expression is not a plain location path (unions, functions, relative paths)
+    """
+    expression = expression.strip()
+    if not expression.startswith("/"):
+        return None
+    tokens = []
+    depth = 0
+    quote = None
+    i = 0
+    step_start = None
+    separator = None
+    while i < len(expression):
+        c = expression[i]
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif depth == 0 and (c == "|" or c == "(" and i == step_start):
+            return None
+        elif c in "[(":
+            depth += 1
+        elif c in "])":
+            depth -= 1
+        elif depth == 0 and c == "/":
+            if step_start is not None:
+                tokens.append((separator, expression[step_start:i]))
+            separator = "//" if expression.startswith("//", i) else "/"
+            i += len(separator)
+            step_start = i
+            continue
+        i += 1
+    if step_start is None or step_start >= len(expression) or quote is not None or depth != 0:
+        return None
+    tokens.append((separator, expression[step_start:]))
+    return tokens
+
+
+def join_xpath(tokens, relative=False):
+    path = "".join(separator + step for separator, step in tokens)
+    return "." + path if relative else path
+
+
+class SearchPageExtractor:
+    """
+    Extracts search results from a page with the configured field expressions.
+
+    When all expressions share a common prefix it is used to select one node per result and the rest
+    of each expression is evaluated relative to that node, so a missing field drops only its own row.
+    The prefix is trusted only if it selects at least as many nodes as any field expression does, otherwise
+    it is a container of the results and every expression is evaluated over the page as before.
+    If the prefix is a single `//tag` or `//tag[@attr="value"]` step, the page is parsed incrementally.
+    """
+
+    _simple_step = re.compile(r'^(?P<tag>[\w-]+)(\[@(?P<attr>[\w-]+)=(?P<q>["\'])(?P<value>.*?)(?P=q)\])?$')
+
+    def __init__(self, fields: Dict[str, str]):
+        """
+        :param fields: result key -> absolute XPath expression
+        """
+        self.logger = logging.getLogger("tg_dj.downloader.html")
+        self.fields = fields
+
+        self.column_xpaths = {name: lxml.etree.XPath(expression) for name, expression in fields.items()}
+        self.item_xpath = None
+        self.field_xpaths = {}
+        self.stream_tag = None
+        self.stream_attr = None
+
+        tokens = {name: split_xpath(expression) for name, expression in fields.items()}
+        if all(tokens.values()):
+            common = self._common_prefix(list(tokens.values()))
+            if common > 0:
+                self.item_xpath = lxml.etree.XPath(join_xpath(next(iter(tokens.values()))[:common]))
+                self.field_xpaths = {name: lxml.etree.XPath(join_xpath(t[common:], relative=True))
+                                     for name, t in tokens.items()}
+                self._setup_streaming(next(iter(tokens.values()))[:common],
+                                      [t[common:] for t in tokens.values()])
+
+        if self.item_xpath is None:
+            self.logger.warning("Search page expressions have no common prefix, rows may be misaligned")
+
+    @staticmethod
+    def _common_prefix(paths):
+        common = 0
+        shortest = min(len(p) for p in paths)
+        # Each field needs at least one step of its own
+        while common < shortest - 1 and all(p[common] == paths[0][common] for p in paths):
+            common += 1
+        return common
+
+    def _setup_streaming(self, item_tokens, relative_tokens):
+        if len(item_tokens) != 1 or item_tokens[0][0] != "//":
+            return
+        match = self._simple_step.match(item_tokens[0][1])
+        if match is None:
+            return
+        # Streaming only sees the item subtree, so fields must not look outside of it
+        for tokens in relative_tokens:
+            for _, step in tokens:
+                if step.startswith("..") or "::" in step:
+                    return
+        self.stream_tag = match.group("tag")
+        self.stream_attr = (match.group("attr"), match.group("value")) if match.group("attr") else None
+
+    @property
+    def streaming(self):
+        return self.stream_tag is not None
+
+    def start(self, encoding=None):
+        """
+        :return: extraction to feed the page into
+        """
+        if self.streaming:
+            return _StreamingExtraction(self, encoding)
+        return _BufferedExtraction(self, encoding)
+
+    @staticmethod
+    def _value(result):
+        if isinstance(result, list):
+            if len(result) == 0:
+                return None
+            result = result[0]
+        if isinstance(result, lxml.etree._Element):
+            return result.text_content() if hasattr(result, "text_content") else "".join(result.itertext())
+        return str(result)
+
+    def extract_item(self, node, counts=None):
+        """
+        :param dict counts: field name -> matched nodes, incremented with the matches in this item
+        :return: dict of field values or None if any field is missing
+        """
+        row = {}
+        for name, xpath in self.field_xpaths.items():
+            result = xpath(node)
+            if counts is not None:
+                counts[name] = counts.get(name, 0) + (len(result) if isinstance(result, list) else 1)
+            row[name] = self._value(result)
+        for name, value in row.items():
+            if value is None:
+                self.logger.debug("Search result without %s skipped", name)
+                return None
+        return row
+
+    def extract_columns(self, tree):
+        """
+        Evaluates every expression over the whole page and pairs the n-th values of all of them
+        """
+        columns = [[str(v) for v in xpath(tree)] for xpath in self.column_xpaths.values()]
+        return [dict(zip(self.column_xpaths.keys(), values)) for values in zip(*columns)]
+
+    def items_match(self, items, counts) -> bool:
+        """
+        :param int items: nodes selected by the item expression
+        :param counts: field name -> nodes matched by its expression
+        :return: False if the item expression selects a container of several results
+        """
+        if items >= max(counts.values(), default=0):
+            return True
+        self.logger.debug("Item expression selects %d nodes for %s fields, evaluating fields over the page",
+                          items, max(counts.values()))
+        return False
+
+    def extract_tree(self, tree):
+        if self.item_xpath is None:
+            return self.extract_columns(tree)
+        nodes = self.item_xpath(tree)
+        counts = {name: len(xpath(tree)) for name, xpath in self.column_xpaths.items()}
+        if not self.items_match(len(nodes), counts):
+            return self.extract_columns(tree)
+        rows = []
+        for node in nodes:
+            row = self.extract_item(node)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def is_item(self, element):
+        if element.tag != self.stream_tag:
+            return False
+        return self.stream_attr is None or element.get(self.stream_attr[0]) == self.stream_attr[1]
+
+
+def _parse_page(chunks, encoding):
+    page = chunks[0][:0].join(chunks)
+    parser = lxml.html.HTMLParser(encoding=encoding) if isinstance(page, bytes) else None
+    return lxml.html.fromstring(page, parser=parser)
+
+
+class _BufferedExtraction:
+    def __init__(self, extractor: SearchPageExtractor, encoding):
+        self.extractor = extractor
+        self.encoding = encoding
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        if len(self.chunks) == 0:
+            return []
+        return self.extractor.extract_tree(_parse_page(self.chunks, self.encoding))
+
+
+class _StreamingExtraction:
+    def __init__(self, extractor: SearchPageExtractor, encoding):
+        self.extractor = extractor
+        self.encoding = encoding
+        self.parser = lxml.etree.HTMLPullParser(events=("end",), tag=extractor.stream_tag, encoding=encoding)
+        self.rows = []
+        self.items = 0
+        self.counts = {}
+        # Kept in case the item expression turns out to select containers
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.parser.feed(data)
+        self._read_events()
+
+    def _read_events(self):
+        for _, element in self.parser.read_events():
+            if not self.extractor.is_item(element):
+                continue
+            self.items += 1
+            row = self.extractor.extract_item(element, self.counts)
+            if row is not None:
+                self.rows.append(row)
+            # Processed results are not needed anymore
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def close(self):
+        try:
+            self.parser.close()
+        except lxml.etree.XMLSyntaxError:
+            pass
+        self._read_events()
+        if len(self.chunks) == 0 or self.extractor.items_match(self.items, self.counts):
+            return self.rows
+        return self.extractor.extract_columns(_parse_page(self.chunks, self.encoding))
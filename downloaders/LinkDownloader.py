@@ -1,16 +1,19 @@
 import os
-import requests
+import asyncio
 import re
 import logging
 
 from urllib import parse
 
-from core.AbstractDownloader import AbstractDownloader, UrlOrNetworkProblem, MediaIsTooLong, MediaIsTooBig, \
-    MediaSizeUnspecified, BadReturnStatus, UnappropriateArgument
+from core.AbstractDownloader import AbstractAsyncDownloader, MediaIsTooLong, UnappropriateArgument, BadReturnStatus, \
+    MediaIsTooBig, UrlOrNetworkProblem
+from core.HttpClient import NETWORK_ERRORS
+from downloaders.PlaylistParser import is_playlist_url, parse_playlist
 from utils import get_mp3_info, sanitize_file_name, remove_links
 
 
-class LinkDownloader(AbstractDownloader):
+class LinkDownloader(AbstractAsyncDownloader):
+    _max_playlist_size = 1000000  # bytes
 
     def __init__(self, config):
         super().__init__(config)
@@ -37,7 +40,7 @@ class LinkDownloader(AbstractDownloader):
                 return match.group(0)
         return False
 
-    def download(self, query, user_message=lambda text: True):
+    def get_url(self, query):
         url = None
         match = self.mp3_dns_regex.search(query)
         if match:
@@ -47,8 +50,43 @@ class LinkDownloader(AbstractDownloader):
             url = match.group(0)
         if url is None:
             raise UnappropriateArgument()
+        return url
+
+    def is_playlist(self, kind, query):
+        url = self.is_acceptable(kind, query)
+        return bool(url) and is_playlist_url(url)
+
+    async def expand(self, query, token=None):
+        """
+        Fetches an M3U or PLS file and returns its entries
+        """
+        url = self.get_url(query)
+        if "://" not in url:
+            url = "http://" + url
+        self.logger.debug("Fetching playlist: " + url)
+        try:
+            response = await self._request("GET", url, allow_redirects=True)
+            try:
+                if response.status != 200:
+                    raise BadReturnStatus(response.status)
+                data = b""
+                async for chunk in response.content.iter_chunked(self._chunk_size):
+                    if token is not None:
+                        token.check()
+                    data += chunk
+                    if len(data) > self._max_playlist_size:
+                        raise MediaIsTooBig(len(data))
+                text = data.decode(response.charset or "utf-8", errors="replace")
+            finally:
+                response.release()
+        except NETWORK_ERRORS as e:
+            raise UrlOrNetworkProblem(e)
+        return parse_playlist(text, str(response.url))
 
-        self.logger.debug("Sending HEAD to url: " + url)
+    async def download(self, query, user_message=lambda text: True, token=None):
+        url = self.get_url(query)
+
+        self.logger.debug("Downloading url: " + url)
 
         media_dir = self.config.get("downloader", "media_dir", fallback="media")
 
@@ -56,8 +94,10 @@ class LinkDownloader(AbstractDownloader):
         file_name = sanitize_file_name(parse.unquote(url).split("/")[-1] + ".mp3")
         file_path = os.path.join(file_dir, file_name)
 
+        loop = asyncio.get_event_loop()
+
         if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            title, artist, duration = get_mp3_info(file_path)
+            title, artist, duration = await loop.run_in_executor(None, get_mp3_info, file_path)
             title = remove_links(title)
             artist = remove_links(artist)
             return file_path, title, artist, duration
@@ -65,33 +105,22 @@ class LinkDownloader(AbstractDownloader):
         user_message("Скачиваем...")
         self.logger.debug("Querying URL")
 
-        try:
-            response_head = requests.head(url, allow_redirects=True)
-        except requests.exceptions.ConnectionError as e:
-            raise UrlOrNetworkProblem(e)
-        if response_head.status_code != 200:
-            raise BadReturnStatus(response_head.status_code)
-        try:
-            file_size = int(response_head.headers['content-length'])
-        except KeyError:
-            self.logger.error("No content-length header. Headers: %s", str(response_head.headers))
-            raise MediaSizeUnspecified()
-        if file_size > 1000000 * self.config.getint("downloader", "max_file_size", fallback=self._default_max_size):
-            raise MediaIsTooBig()
-
-        self.get_file(
+        # Size and duration limits are enforced by get_file while streaming
+        max_duration = self.config.getint("downloader", "max_duration", fallback=self._default_max_duration)
+        await self.get_file(
             url=url,
             file_path=file_path,
-            file_size=file_size,
             percent_callback=lambda p: user_message("Скачиваем [%d%%]...\n" % int(p)),
+            max_duration=max_duration,
+            token=token,
         )
 
-        title, artist, duration = get_mp3_info(file_path)
+        title, artist, duration = await loop.run_in_executor(None, get_mp3_info, file_path)
         title = remove_links(title)
         artist = remove_links(artist)
-        if duration > self.config.getint("downloader", "max_duration", fallback=self._default_max_duration):
+        if duration > max_duration:
             os.unlink(file_path)
-            raise MediaIsTooLong()
+            raise MediaIsTooLong(duration)
 
         self.touch_without_creation(file_path)
 
@@ -1,13 +1,22 @@
+import asyncio
 import concurrent.futures
+import functools
 import logging
+import math
 import os
 import time
 from collections import OrderedDict
-from typing import Dict, List
-from prometheus_client import Gauge, Summary
+from typing import Dict, List, Optional, Set, Tuple
+from prometheus_client import Counter, Gauge, Summary
+from unidecode import unidecode
 
-from core.AbstractDownloader import AbstractDownloader, DownloaderException, UrlOrNetworkProblem, UrlProblem, \
-    MediaIsTooLong, MediaIsTooBig, MediaSizeUnspecified, BadReturnStatus, NothingFound, ApiError, NotAccepted
+from core.AbstractDownloader import AbstractDownloader, AbstractAsyncDownloader, DownloaderException, UrlOrNetworkProblem, UrlProblem, \
+    MediaIsTooLong, MediaIsTooBig, MediaSizeUnspecified, BadReturnStatus, NothingFound, ApiError, NotAccepted, \
+    SourceUnavailable, DownloadCancelled, DeadlineExceeded, CancellationToken, is_partial_file
+from core.Loudness import get_loudness_analyzer
+from core.Transcoder import get_transcoder, is_derived_file, derived_files
+from downloaders.PlaylistParser import is_playlist_text, parse_playlist
+from utils import LRUCache
 
 # noinspection PyArgumentList
 mon_downloads_in_progress = Gauge('dj_downloads_in_progress', 'Downloads in progress')
@@ -15,9 +24,14 @@ mon_downloads_in_progress = Gauge('dj_downloads_in_progress', 'Downloads in prog
 mon_searches_in_progress = Gauge('dj_searches_in_progress', 'Searches in progress')
 mon_download_duration = Summary('dj_download_duration', 'Time spent in downloading', ['handler'])
 mon_search_duration = Summary('dj_search_duration', 'Time spent in search', ['handler'])
+# noinspection PyArgumentList
+mon_search_cache_hits = Counter('dj_search_cache_hits', 'Searches answered from the search cache')
 
 
 class MasterDownloader:
+    _duplicate_duration_delta = 3  # seconds
+    _default_bulk_max_items = 100
+
     def __init__(self, config, downloaders: List[AbstractDownloader]):
         """
         :param configparser.ConfigParser config:
@@ -28,8 +42,20 @@ class MasterDownloader:
 
         self.handlers = OrderedDict([(d.get_name(), d) for d in downloaders])
 
+        # Only blocking downloaders (pytube) run here, asyncio-native ones are awaited on the loop
         self.thread_pool = concurrent.futures.ThreadPoolExecutor()
+        # Single worker keeps progress messages of a download in order
+        self.callback_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.core = None
+        # Tokens of downloads and searches in flight
+        self.tokens: Set[CancellationToken] = set()
+        self.loudness = get_loudness_analyzer(config)
+        self.transcoder = get_transcoder(config)
+
+        self.search_cache = LRUCache(
+            self.config.getint("downloader", "search_cache_size", fallback=256),
+            self.config.getint("downloader", "search_cache_ttl", fallback=600),
+        )
 
         media_dir = self.config.get("downloader", "media_dir", fallback="media")
         if not os.path.exists(media_dir):
@@ -39,8 +65,19 @@ class MasterDownloader:
         self.core = core
 
     def cleanup(self):
-        pass
-        # TODO: Delete incomplete downloads
+        for token in list(self.tokens):
+            token.cancel()
+        self.transcoder.cleanup()
+        self.loudness.cleanup()
+
+        media_dir = self.config.get("downloader", "media_dir", fallback="media")
+        for f in os.listdir(media_dir):
+            if is_partial_file(f):
+                try:
+                    os.unlink(os.path.join(media_dir, f))
+                    self.logger.info("Incomplete download have been deleted: " + f)
+                except OSError:
+                    pass
 
     def _filter_storage(self):
         media_dir = self.config.get("downloader", "media_dir", fallback="media")
@@ -49,7 +86,8 @@ class MasterDownloader:
         files_dir = os.path.join(os.getcwd(), media_dir)
 
         files = [os.path.join(files_dir, f) for f in os.listdir(files_dir) if
-                 os.path.isfile(os.path.join(files_dir, f)) and not f.startswith(".")]
+                 os.path.isfile(os.path.join(files_dir, f)) and not f.startswith(".")
+                 and not is_partial_file(f) and not is_derived_file(f)]
 
         files.sort(key=lambda x: -os.path.getmtime(x))
         self.logger.debug("Number of files: %d / %d", len(files), files_storage_limit)
@@ -58,99 +96,373 @@ class MasterDownloader:
             return
         files_to_delete = files[files_storage_limit:]
         for file in files_to_delete:
+            # Transcoded copies go together with their original
+            for derived in derived_files(file):
+                os.unlink(derived)
             os.unlink(file)
             self.logger.info("File have been deleted: " + file)
 
-    @mon_downloads_in_progress.track_inprogress()
-    def thread_download(self, kind, query, callback):
+    def _run_handler(self, downloader: AbstractDownloader, method: str, *args, **kwargs):
+        """
+        Returns an awaitable: coroutine for asyncio-native downloaders, thread pool future for blocking ones
+        """
+        if isinstance(downloader, AbstractAsyncDownloader):
+            return getattr(downloader, method)(*args, **kwargs)
+        return self.core.loop.run_in_executor(
+            self.thread_pool, functools.partial(getattr(downloader, method), *args, **kwargs))
+
+    async def _run_cancellable(self, token: CancellationToken, downloader: AbstractDownloader, method: str,
+                               *args, **kwargs):
+        """
+        Runs a downloader method until it finishes, the token is cancelled or its deadline passes.
+        Native coroutines are cancelled at once, blocking downloaders stop on their next token check
+        """
+        future = asyncio.ensure_future(self._run_handler(downloader, method, *args, token=token, **kwargs))
+        loop = self.core.loop
+
+        def cancel():
+            loop.call_soon_threadsafe(future.cancel)
+
+        token.add_callback(cancel)
+        try:
+            return await asyncio.wait_for(future, token.remaining())
+        except asyncio.TimeoutError:
+            if not token.expired:
+                raise
+            token.cancel()
+            raise DeadlineExceeded()
+        except asyncio.CancelledError:
+            if not token.cancelled or token.expired:
+                raise
+            raise DownloadCancelled()
+        finally:
+            token.remove_callback(cancel)
 
+    def off_loop(self, callback):
+        # Frontend callbacks may block on synchronous APIs, so they never run on the event loop
+        def wrapper(text):
+            self.callback_pool.submit(callback, text)
+        return wrapper
+
+    def _get_handlers(self, kind, query) -> Dict[str, AbstractDownloader]:
         if kind == "search_result":
             dl_name = query["downloader"]
-            handlers = {dl_name: self.handlers[dl_name]}
-        else:
-            handlers = self.handlers
-
-        accepted = False
-        for handler_name in handlers:
-            downloader = handlers[handler_name]
-            if not downloader.is_acceptable(kind, query):
-                continue
+            return {dl_name: self.handlers[dl_name]}
+        return self.handlers
 
-            accepted = True
-            try:
-                self.logger.info(f"Downloading: {query}")
-                start_time = time.time()
-                result = downloader.download(query, user_message=callback)
-                end_time = time.time()
-                mon_download_duration.labels(handler_name).observe(end_time - start_time)
-                self.logger.info(f"Downloaded: {query}")
-                self._filter_storage()
-                return result
-            except MediaIsTooLong as e:
-                callback("Трек слишком длинный (" + str(e.args[0]) + " секунд)")
-            except MediaIsTooBig as e:
-                callback("Трек слишком много весит ( > " + ("%.2f" % (e.args[0] / 1000000)) + " MB)")
-            except MediaSizeUnspecified:
-                callback("Трек не будет загружен, так как не удаётся определить его размер")
-            except BadReturnStatus as e:
-                callback("Сервер недоступен (код ответа: " + str(e.args[0]) + ")\nПопробуйте повторить позже")
-            except ApiError:
-                callback("Сервер недоступен (ошибка API)\nПопробуйте повторить позже")
-            except (UrlOrNetworkProblem, UrlProblem):
-                callback("Не удаётся выполнить запрос к серверу (ошибка сети или адреса)\n"
-                         "Попробуйте повторить позже")
-            except NothingFound:
-                callback("Ничего не нашел по этому запросу :(")
-            except DownloaderException as e:
-                callback(str(e.args[0]))
-            except Exception as e:
-                self.logger.error(str(e))
-                raise e
-            break
-        if not accepted:
-            raise NotAccepted()
-
-    @mon_searches_in_progress.track_inprogress()
-    def thread_search(self, query, callback, limit):
+    def is_acceptable(self, kind, query) -> bool:
+        return any(d.is_acceptable(kind, query) for d in self._get_handlers(kind, query).values())
+
+    def describe(self, kind, query) -> Optional[Tuple[str, str, int]]:
+        """
+        Title, artist and duration of the track from the first downloader which knows them without downloading
+        """
+        for downloader in self._get_handlers(kind, query).values():
+            if downloader.is_acceptable(kind, query):
+                return downloader.describe(kind, query)
+        return None
+
+    def split_links(self, text) -> List[str]:
+        """
+        Words of a message which are downloadable links
+        """
+        return [word for word in text.split() if self.is_acceptable("text", word)]
+
+    def is_bulk(self, text) -> bool:
+        """
+        True if the message asks for several tracks: a pasted M3U or PLS playlist, a link to a playlist
+        or several links
+        """
+        if is_playlist_text(text):
+            return True
+        links = self.split_links(text)
+        if len(links) > 1:
+            return True
+        return len(links) == 1 and any(d.is_playlist("text", links[0]) for d in self.handlers.values())
+
+    async def expand(self, text, callback, token=None) -> List[str]:
+        """
+        Turns a bulk message into text queries of single tracks, in their order. Playlists which
+        can't be fetched are reported and skipped
+        :param CancellationToken token: allows to cancel fetching of playlists and limit its time
+        """
+        callback = self.off_loop(callback)
+        token = token or CancellationToken()
+        limit = self.config.getint("downloader", "bulk_max_items", fallback=self._default_bulk_max_items)
+
+        if is_playlist_text(text):
+            return parse_playlist(text)[:limit]
+
+        queries = []
+        self.tokens.add(token)
+        try:
+            for link in self.split_links(text):
+                if len(queries) >= limit:
+                    break
+                downloader = next((d for d in self.handlers.values() if d.is_playlist("text", link)), None)
+                if downloader is None:
+                    queries.append(link)
+                    continue
+                try:
+                    queries += await self._run_cancellable(token, downloader, "expand", link)
+                except (DownloadCancelled, DeadlineExceeded):
+                    raise
+                except DownloaderException as e:
+                    self.logger.warning("Playlist %s skipped: %s" % (link, repr(e)))
+                    callback("Не удалось получить список треков:\n%s" % link)
+        finally:
+            self.tokens.discard(token)
+        return queries[:limit]
+
+    async def flush_callbacks(self):
+        """
+        Waits until the callbacks of finished downloads have been called
+        """
+        await asyncio.wrap_future(self.callback_pool.submit(lambda: None))
+
+    async def download(self, kind, query, callback, token=None):
+        """
+        :param CancellationToken token: allows to cancel the download and limit its time
+        """
+        self.logger.info("Download action")
+        callback = self.off_loop(callback)
+        token = token or CancellationToken()
+
+        handlers = self._get_handlers(kind, query)
+
+        self.tokens.add(token)
+        try:
+            with mon_downloads_in_progress.track_inprogress():
+                accepted = False
+                for handler_name in handlers:
+                    downloader = handlers[handler_name]
+                    if not downloader.is_acceptable(kind, query):
+                        continue
+
+                    accepted = True
+                    try:
+                        self.logger.info(f"Downloading: {query}")
+                        start_time = time.time()
+                        result = await self._run_cancellable(token, downloader, "download", query,
+                                                             user_message=callback)
+                        end_time = time.time()
+                        mon_download_duration.labels(handler_name).observe(end_time - start_time)
+                        self.logger.info(f"Downloaded: {query}")
+                        self._filter_storage()
+                        if result is not None:
+                            self.loudness.schedule(result[0])
+                            self.transcoder.schedule(result[0])
+                        return result
+                    except MediaIsTooLong as e:
+                        callback("Трек слишком длинный (" + str(e.args[0]) + " секунд)")
+                    except MediaIsTooBig as e:
+                        callback("Трек слишком много весит ( > " + ("%.2f" % (e.args[0] / 1000000)) + " MB)")
+                    except MediaSizeUnspecified:
+                        callback("Трек не будет загружен, так как не удаётся определить его размер")
+                    except BadReturnStatus as e:
+                        callback("Сервер недоступен (код ответа: " + str(e.args[0]) + ")\nПопробуйте повторить позже")
+                    except ApiError:
+                        callback("Сервер недоступен (ошибка API)\nПопробуйте повторить позже")
+                    except SourceUnavailable as e:
+                        callback("Сервер временно недоступен\nПопробуйте повторить через %d сек."
+                                 % max(1, math.ceil(e.args[1])))
+                    except (UrlOrNetworkProblem, UrlProblem):
+                        callback("Не удаётся выполнить запрос к серверу (ошибка сети или адреса)\n"
+                                 "Попробуйте повторить позже")
+                    except NothingFound:
+                        callback("Ничего не нашел по этому запросу :(")
+                    except DownloadCancelled:
+                        self.logger.info(f"Download cancelled: {query}")
+                        callback("Загрузка отменена")
+                    except DeadlineExceeded:
+                        self.logger.warning(f"Download timed out: {query}")
+                        callback("Загрузка заняла слишком много времени\nПопробуйте повторить позже")
+                    except DownloaderException as e:
+                        callback(str(e.args[0]))
+                    except Exception as e:
+                        self.logger.error(str(e))
+                        raise e
+                    break
+                if not accepted:
+                    raise NotAccepted()
+        finally:
+            self.tokens.discard(token)
+
+    async def search(self, query, callback, limit, token=None):
+        """
+        :param CancellationToken token: allows to cancel the search and limit its time
+        """
+        self.logger.info("Search action")
+        callback = self.off_loop(callback)
+        token = token or CancellationToken()
         results_limit = self.config.getint("downloader", "search_max_results", fallback=10)
 
-        for dwnld_name in self.handlers:
-            downloader = self.handlers[dwnld_name]
-            arg = downloader.is_acceptable("search", query)
-            if not arg:
+        cache_key = (self._normalize_search_field(query), limit)
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            self.logger.debug("Search results for \"%s\" are taken from cache", query)
+            mon_search_cache_hits.inc()
+            # Frontends annotate results, so each caller gets its own copies
+            return [dict(r) for r in cached]
+
+        search_results = None
+        self.tokens.add(token)
+        try:
+            with mon_searches_in_progress.track_inprogress():
+                if self.config.get("downloader", "search_mode", fallback="first") == "federated":
+                    try:
+                        search_results = await self._federated_search(query, callback, limit, token)
+                    except DownloadCancelled:
+                        self.logger.info("Search for \"%s\" cancelled", query)
+                else:
+                    for dwnld_name in self.handlers:
+                        downloader = self.handlers[dwnld_name]
+                        arg = downloader.is_acceptable("search", query)
+                        if not arg:
+                            continue
+                        if token.cancelled or token.expired:
+                            break
+                        search_results = await self._search_source(dwnld_name, downloader, query, callback, limit,
+                                                                   token)
+                        if search_results is not None:
+                            break
+        finally:
+            self.tokens.discard(token)
+
+        if search_results is None:
+            return None
+        search_results = search_results[0:min(results_limit, len(search_results))]
+        if len(search_results) > 0:
+            self.search_cache.set(cache_key, [dict(r) for r in search_results])
+        return search_results
+
+    async def _search_source(self, dwnld_name, downloader, query, callback, limit, token, report_errors=True):
+        """
+        :return: results marked with the downloader name, [] if nothing found, None if the source failed
+        """
+        error_callback = callback if report_errors else lambda text: True
+        try:
+            start_time = time.time()
+            search_results = await self._run_cancellable(
+                token, downloader, "search",
+                query,
+                user_message=callback,
+                limit=limit
+            )
+            end_time = time.time()
+            mon_search_duration.labels(dwnld_name).observe(end_time - start_time)
+
+            for r in search_results:
+                r["downloader"] = dwnld_name
+
+            return search_results
+
+        except BadReturnStatus as e:
+            error_callback("Сервер недоступен (код ответа: " + str(e.args[0]) + ")\nПопробуйте повторить позже")
+        except ApiError:
+            error_callback("Сервер недоступен (ошибка API)\nПопробуйте повторить позже")
+        except SourceUnavailable as e:
+            # Skipped at once, so the next source is asked without waiting for a failing one
+            error_callback("Сервер временно недоступен\nПопробуйте повторить через %d сек." % max(1, math.ceil(e.args[1])))
+        except (UrlOrNetworkProblem, UrlProblem):
+            error_callback("Не удаётся выполнить запрос к серверу (ошибка сети или адреса)\n"
+                           "Попробуйте повторить позже")
+        except NothingFound:
+            return []
+        except DownloadCancelled:
+            self.logger.info("Search for \"%s\" cancelled", query)
+            return None
+        except DeadlineExceeded:
+            error_callback("Поиск занял слишком много времени\nПопробуйте повторить позже")
+        except Exception as e:
+            self.logger.error(str(e))
+            raise e
+        self.logger.warning("Search source %s failed for query \"%s\"", dwnld_name, query)
+        return None
+
+    async def _federated_search(self, query, callback, limit, token: CancellationToken):
+        """
+        Queries all search-capable downloaders at once. Answers are collected until search_grace seconds after
+        the first non-empty one (a source never gets more than search_source_timeout), then merged
+        :return: merged results, None if no source can search the query or all of them failed
+        :raise DownloadCancelled: the token was cancelled
+        """
+        source_timeout = self.config.getfloat("downloader", "search_source_timeout", fallback=10)
+        grace = self.config.getfloat("downloader", "search_grace", fallback=1)
+
+        # Every source gets its own token, so that a slow one is stopped without stopping the others
+        tasks: Dict[asyncio.Future, Tuple[str, CancellationToken]] = {}
+        for dwnld_name, downloader in self.handlers.items():
+            if not downloader.is_acceptable("search", query):
                 continue
-            try:
-                search_results = downloader.search(
-                    query,
-                    user_message=callback,
-                    limit=limit
-                )
-                start_time = time.time()
-                search_results = search_results[0:min(results_limit, len(search_results))]
-                end_time = time.time()
-                mon_search_duration.labels(dwnld_name).observe(end_time - start_time)
-
-                for r in search_results:
-                    r["downloader"] = dwnld_name
-
-                return search_results
-
-            except BadReturnStatus as e:
-                callback("Сервер недоступен (код ответа: " + str(e.args[0]) + ")\nПопробуйте повторить позже")
-            except ApiError:
-                callback("Сервер недоступен (ошибка API)\nПопробуйте повторить позже")
-            except (UrlOrNetworkProblem, UrlProblem):
+            remaining = token.remaining()
+            source_token = CancellationToken(source_timeout if remaining is None else min(source_timeout, remaining))
+            token.add_callback(source_token.cancel)
+            task = asyncio.ensure_future(self._search_source(dwnld_name, downloader, query, callback, limit,
+                                                             source_token, report_errors=False))
+            tasks[task] = (dwnld_name, source_token)
+        if not tasks:
+            # Same as the first mode: no source can search this query
+            return None
+
+        answers = []
+        failed = 0
+        pending = set(tasks)
+        grace_end = None
+        try:
+            while pending:
+                timeout = None if grace_end is None else max(0.0, grace_end - time.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    search_results = task.result()
+                    if search_results is None:
+                        failed += 1
+                    elif search_results:
+                        answers.append(search_results)
+                        if grace_end is None:
+                            grace_end = time.time() + grace
+        finally:
+            for task in pending:
+                self.logger.info("Search source %s is too slow, skipping it", tasks[task][0])
+                # Blocking sources stop on their next token check
+                tasks[task][1].cancel()
+                task.cancel()
+            for _dwnld_name, source_token in tasks.values():
+                token.remove_callback(source_token.cancel)
+
+        if token.cancelled and not token.expired:
+            raise DownloadCancelled()
+        if failed == len(tasks):
+            if token.expired:
+                callback("Поиск занял слишком много времени\nПопробуйте повторить позже")
+            else:
                 callback("Не удаётся выполнить запрос к серверу (ошибка сети или адреса)\nПопробуйте повторить позже")
-            except NothingFound:
-                return []
-            except Exception as e:
-                self.logger.error(str(e))
-                raise e
+            return None
 
-    async def download(self, kind, query, callback):
-        self.logger.info("Download action")
-        return await self.core.loop.run_in_executor(self.thread_pool, self.thread_download, kind, query, callback)
+        return self._merge_search_results(answers)
 
-    async def search(self, query, callback, limit):
-        self.logger.info("Search action")
-        return await self.core.loop.run_in_executor(self.thread_pool, self.thread_search, query, callback, limit)
+    @staticmethod
+    def _normalize_search_field(value) -> str:
+        return " ".join("".join(c if c.isalnum() else " " for c in unidecode(str(value or "")).lower()).split())
+
+    def _merge_search_results(self, answers: List[List[Dict]]) -> List[Dict]:
+        """
+        Interleaves answers by their own ranking, fastest source first, dropping results which have the same
+        normalized artist and title and a duration within a few seconds of an earlier one
+        """
+        merged = []
+        seen: Dict[Tuple[str, str], List[int]] = {}
+        for rank in range(max((len(a) for a in answers), default=0)):
+            for answer in answers:
+                if rank >= len(answer):
+                    continue
+                result = answer[rank]
+                key = (self._normalize_search_field(result["artist"]), self._normalize_search_field(result["title"]))
+                durations = seen.setdefault(key, [])
+                if any(abs(d - result["duration"]) <= self._duplicate_duration_delta for d in durations):
+                    continue
+                durations.append(result["duration"])
+                merged.append(result)
+        return merged
@@ -0,0 +1,60 @@
+import re
+from typing import List, Optional
+from urllib.parse import urljoin, urlparse
+
+
+_pls_entry = re.compile(r"^File\d+\s*=\s*(?P<url>.+)$", flags=re.IGNORECASE)
+_playlist_extensions = (".m3u", ".m3u8", ".pls")
+
+
+def is_playlist_url(url) -> bool:
+    """
+    True if the URL points to an M3U or PLS file
+    """
+    if "://" not in url:
+        url = "http://" + url
+    return urlparse(url).path.lower().endswith(_playlist_extensions)
+
+
+def is_playlist_text(text) -> bool:
+    """
+    True if the text itself is an M3U or PLS playlist, e.g. pasted into a message
+    """
+    first_line = text.lstrip().split("\n", 1)[0].strip().lower()
+    return first_line == "#extm3u" or first_line == "[playlist]"
+
+
+def parse_playlist(text, base_url=None) -> List[str]:
+    """
+    Extracts entries of an M3U or PLS playlist in their order
+    :param base_url: URL of the playlist, relative entries are resolved against it
+    :return: http(s) URLs, local paths are skipped
+    """
+    if "#EXT-X-" in text:
+        # HLS stream, its entries are segments of one track
+        return []
+    entries = []
+    pls = text.lstrip().lower().startswith("[playlist]")
+    for line in text.splitlines():
+        line = line.strip()
+        if pls:
+            match = _pls_entry.match(line)
+            if match is None:
+                continue
+            entry = match.group("url").strip()
+        else:
+            if not line or line.startswith("#"):
+                continue
+            entry = line
+        url = _resolve(entry, base_url)
+        if url is not None:
+            entries.append(url)
+    return entries
+
+
+def _resolve(entry, base_url) -> Optional[str]:
+    if base_url is not None:
+        entry = urljoin(base_url, entry)
+    if urlparse(entry).scheme not in ("http", "https"):
+        return None
+    return entry
@@ -1,55 +1,147 @@
 import re
 import os
-import time
+import datetime
 import traceback
 import logging
 import html
 from urllib.error import HTTPError
 
-from pytube import YouTube
+from pytube import YouTube, Playlist
 
 from core.AbstractDownloader import AbstractDownloader, UrlProblem, MediaIsTooLong, MediaIsTooBig, BadReturnStatus, \
-    UnappropriateArgument, ApiError
+    UnappropriateArgument, ApiError, UrlOrNetworkProblem, DownloadProgress, DownloaderException, PARTIAL_SUFFIX
+from core.HttpClient import is_host_failure
+from downloaders.models import YoutubeVideo
 from utils import sanitize_file_name, remove_links
 
 
 class YoutubeDownloader(AbstractDownloader):
     name = "YouTube downloader"
 
+    _default_metadata_ttl = 7 * 24 * 3600  # seconds
+    _default_bulk_max_items = 100
+    # pytube makes its own requests, so the host guard is applied to the whole operation
+    _guarded_host = "www.youtube.com"
+
     def __init__(self, config):
         super().__init__(config)
         self.logger = logging.getLogger("tg_dj.downloader.youtube")
         self.logger.setLevel(self.config.get("downloader_youtube", "verbosity", fallback="warning").upper())
         self.yt_regex = re.compile(r"((?:https?://)?(?:www\.)?(?:m\.)?youtube\.com/watch\?v=[a-zA-Z0-9_-]{11})|((?:https?://)?(?:www\.)?(?:m\.)?youtu\.be/[a-zA-Z0-9_-]{11})", flags=re.IGNORECASE)
-
-        self.download_status = {}
+        self.playlist_regex = re.compile(r"(?:https?://)?(?:www\.)?(?:m\.)?youtube\.com/playlist\?list=[a-zA-Z0-9_-]+", flags=re.IGNORECASE)
 
     def get_name(self):
         return "yt"
 
     def is_acceptable(self, kind, query):
         if kind == "text":
-            match = self.yt_regex.search(query)
+            match = self.yt_regex.search(query) or self.playlist_regex.search(query)
             if match:
                 return match.group(0)
         return False
 
-    def video_download_progress(self, stream=None, _chunk=None, _file_handle=None, remaining=None):
-        for video_id in self.download_status:
-            stat = self.download_status[video_id]
-            if stream != stat["stream"]:
-                continue
+    def is_playlist(self, kind, query):
+        return kind == "text" and self.playlist_regex.search(query) is not None
 
-            new_time = time.time()
-            if new_time <= stat["last_update"] + 3:
-                break
+    def expand(self, query, token=None):
+        """
+        :return: links to the videos of a playlist, at most bulk_max_items of them
+        """
+        match = self.playlist_regex.search(query)
+        if not match:
+            raise UnappropriateArgument()
+        url = match.group(0)
+        limit = self.config.getint("downloader", "bulk_max_items", fallback=self._default_bulk_max_items)
 
-            stat["last_update"] = new_time
-            file_size = stat["file_size"]
-            percent = 100 * (file_size - remaining) / file_size
-            stat["user_message"]("Скачиваем [%d%%]...\n%s" % (percent, stat["title"]))
+        self.logger.info("Getting playlist: " + url)
+        self.guard_sync(self._guarded_host)
+        video_urls = []
+        try:
+            for video_url in Playlist(url).video_urls:
+                if token is not None:
+                    token.check()
+                video_urls.append(video_url)
+                if len(video_urls) >= limit:
+                    break
+        except HTTPError as e:
+            traceback.print_exc()
+            self._report_http_error(e)
+            raise BadReturnStatus(e.code)
+        except OSError as e:
+            traceback.print_exc()
+            self.host_guard.failure(self._guarded_host)
+            raise UrlOrNetworkProblem(e)
+        except DownloaderException:
+            self.host_guard.release(self._guarded_host)
+            raise
+        except Exception:
+            # Playlist is private or could not be parsed, which tells nothing about the host
+            traceback.print_exc()
+            self.host_guard.release(self._guarded_host)
+            raise ApiError()
+        except BaseException:
+            self.host_guard.release(self._guarded_host)
+            raise
+        self.host_guard.success(self._guarded_host)
+        return video_urls
+
+    def get_metadata_ttl(self):
+        return datetime.timedelta(seconds=self.config.getint("downloader_youtube", "metadata_ttl",
+                                                             fallback=self._default_metadata_ttl))
+
+    def get_cached_video(self, video_id):
+        """
+        :return: fresh metadata of an already downloaded video or None
+        """
+        try:
+            video = YoutubeVideo.get(
+                YoutubeVideo.video_id == video_id,
+                YoutubeVideo.updated > datetime.datetime.now() - self.get_metadata_ttl(),
+            )
+        except YoutubeVideo.DoesNotExist:
+            return None
+        if not self.is_in_cache(video.file_path):
+            return None
+        return video
+
+    def describe(self, kind, query):
+        match = self.yt_regex.search(query)
+        if kind != "text" or not match:
+            return None
+        cached = self.get_cached_video(match.group(0)[-11:])
+        if cached is None:
+            return None
+        return cached.title, "", cached.length
+
+    def store_video(self, video_id, title, length, file_size, file_path):
+        YoutubeVideo.insert(
+            video_id=video_id,
+            title=title,
+            length=length,
+            file_size=file_size,
+            file_path=file_path,
+            updated=datetime.datetime.now(),
+        ).on_conflict_replace().execute()
+        YoutubeVideo.delete().where(YoutubeVideo.updated <= datetime.datetime.now() - self.get_metadata_ttl()).execute()
+
+    @staticmethod
+    def _remove_partial(file_dir, part_name):
+        for name in os.listdir(file_dir):
+            if name.startswith(part_name):
+                os.unlink(os.path.join(file_dir, name))
+
+    def _report_http_error(self, e):
+        if is_host_failure(e.code):
+            self.host_guard.failure(self._guarded_host)
+        else:
+            self.host_guard.success(self._guarded_host)
+
+    def download(self, query, user_message=lambda text: True, token=None):
+        """
+        :param CancellationToken token: checked between steps and on every chunk pytube reports
+        """
+        check = token.check if token is not None else lambda: None
 
-    def download(self, query, user_message=lambda text: True):
         match = self.yt_regex.search(query)
         if match:
             url = match.group(0)
@@ -57,16 +149,41 @@ class YoutubeDownloader(AbstractDownloader):
             raise UnappropriateArgument()
 
         self.logger.info("Getting url: " + url)
+
+        # Both URL forms end with the video id
+        cached = self.get_cached_video(url[-11:])
+        if cached is not None:
+            self.logger.debug("Loading from metadata cache: " + cached.file_path)
+            self.touch_without_creation(cached.file_path)
+            return cached.file_path, cached.title, "", cached.length
+
         user_message("Загружаем информацию о видео...")
+        check()
 
         media_dir = self.config.get("downloader", "media_dir", fallback="media")
 
+        self.guard_sync(self._guarded_host)
         try:
-            video = YouTube(url, on_progress_callback=self.video_download_progress)
+            video = YouTube(url)
             stream = video.streams.filter(only_audio=True).first()
+        except HTTPError as e:
+            traceback.print_exc()
+            self._report_http_error(e)
+            raise BadReturnStatus(e.code)
+        except OSError as e:
+            traceback.print_exc()
+            self.host_guard.failure(self._guarded_host)
+            raise UrlOrNetworkProblem(e)
         except Exception:
+            # Video is unavailable, private, age restricted or could not be parsed,
+            # which tells nothing about the host
             traceback.print_exc()
+            self.host_guard.release(self._guarded_host)
             raise ApiError()
+        except BaseException:
+            self.host_guard.release(self._guarded_host)
+            raise
+        self.host_guard.success(self._guarded_host)
         video_id = video.video_id
         video_details = video.player_config_args.get('player_response', {}).get('videoDetails', {})
         if video_id is None:
@@ -80,11 +197,22 @@ class YoutubeDownloader(AbstractDownloader):
 
         video_title = remove_links(video_title)
 
+        # Size may need a request of its own
+        self.guard_sync(self._guarded_host)
         try:
             file_size = int(stream.filesize)
         except HTTPError as e:
             traceback.print_exc()
+            self._report_http_error(e)
             raise BadReturnStatus(e.code)
+        except OSError as e:
+            traceback.print_exc()
+            self.host_guard.failure(self._guarded_host)
+            raise UrlOrNetworkProblem(e)
+        except BaseException:
+            self.host_guard.release(self._guarded_host)
+            raise
+        self.host_guard.success(self._guarded_host)
         if file_size > 1000000 * self.config.getint("downloader", "max_file_size", fallback=self._default_max_size):
             raise MediaIsTooBig()
 
@@ -96,18 +224,10 @@ class YoutubeDownloader(AbstractDownloader):
         if seconds > self.config.getint("downloader", "max_duration", fallback=self._default_max_duration):
             raise MediaIsTooLong()
 
-        self.download_status[str(video_id)] = {
-            "start_time": time.time(),
-            "last_update": time.time(),
-            "file_size": file_size,
-            "stream": stream,
-            "title": video_title,
-            "user_message": user_message,
-        }
-
         file_path = os.path.join(file_dir, file_name) + ".mp4"
         if self.is_in_cache(file_path):
             self.logger.debug("Loading from cache: " + file_path)
+            self.store_video(video_id, video_title, seconds, file_size, file_path)
             return file_path, video_title, "", seconds
 
         if not os.path.exists(file_dir):
@@ -117,12 +237,44 @@ class YoutubeDownloader(AbstractDownloader):
         self.logger.info("Downloading audio from video: " + video_id)
         user_message("Скачиваем...\n%s" % video_title)
 
+        progress = DownloadProgress(lambda p: user_message("Скачиваем [%d%%]...\n%s" % (p, video_title)), file_size)
+
+        def on_progress(_stream, _chunk, *args):
+            # Raising here interrupts pytube's chunk loop
+            check()
+            # Bytes remaining is the last argument in every pytube version
+            progress.update(file_size - args[-1])
+
+        video.register_on_progress_callback(on_progress)
+
+        check()
+        self.guard_sync(self._guarded_host)
+        part_name = file_name + PARTIAL_SUFFIX
         try:
-            stream.download(output_path=file_dir, filename=file_name)
+            # Some pytube versions append the extension themselves, so rely on the returned path
+            part_path = stream.download(output_path=file_dir, filename=part_name)
         except HTTPError as e:
             traceback.print_exc()
+            self._report_http_error(e)
+            self._remove_partial(file_dir, part_name)
             raise BadReturnStatus(e.code)
+        except OSError:
+            self.host_guard.failure(self._guarded_host)
+            self._remove_partial(file_dir, part_name)
+            raise
+        except BaseException:
+            self.host_guard.release(self._guarded_host)
+            self._remove_partial(file_dir, part_name)
+            raise
+        self.host_guard.success(self._guarded_host)
+
+        part_size = os.path.getsize(part_path)
+        if part_size != file_size:
+            os.unlink(part_path)
+            raise UrlOrNetworkProblem("Incomplete download: %d of %d bytes" % (part_size, file_size))
+        os.replace(part_path, file_path)
         self.touch_without_creation(file_path)
+        self.store_video(video_id, video_title, seconds, file_size, file_path)
 
         self.logger.debug("File stored in path: " + file_path)
 
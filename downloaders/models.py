@@ -0,0 +1,33 @@
+import datetime
+
+import peewee
+
+db = peewee.SqliteDatabase("db/downloader_cache.db")
+
+
+class BaseModel(peewee.Model):
+    class Meta:
+        database = db
+
+
+class YoutubeVideo(BaseModel):
+    video_id = peewee.CharField(unique=True)
+    title = peewee.TextField()
+    length = peewee.IntegerField()
+    file_size = peewee.IntegerField()
+    file_path = peewee.TextField()
+    updated = peewee.DateTimeField(default=datetime.datetime.now)
+
+
+class HtmlSearchResult(BaseModel):
+    result_id = peewee.CharField(unique=True)
+    title = peewee.TextField()
+    artist = peewee.TextField()
+    duration = peewee.IntegerField()
+    link = peewee.TextField()
+    updated = peewee.DateTimeField(default=datetime.datetime.now)
+
+
+db.connect()
+# Cache tables were added after the first release, deployments created before them get them here
+db.create_tables([YoutubeVideo, HtmlSearchResult], safe=True)
@@ -0,0 +1,28 @@
+import asyncio
+import configparser
+
+from downloaders.HtmlDownloader import HtmlDownloader
+
+
+def make_downloader(rows):
+    config = configparser.ConfigParser()
+    config.read_dict({"downloader_html": {"base_uri": "http://example.com", "search_page_uri": "/search?q={}"}})
+    downloader = HtmlDownloader(config)
+
+    async def extract_page(url, headers, token):
+        return [dict(row) for row in rows]
+
+    downloader._extract_page = extract_page
+    downloader.store_results = lambda songs: None
+    return downloader
+
+
+def test_limit_is_applied_after_rating_sort():
+    downloader = make_downloader([
+        {"title": "Low", "artist": "A", "duration": "1:00", "rating": "5", "link": "/low"},
+        {"title": "Top", "artist": "B", "duration": "2:05", "rating": "1,2K", "link": "/top"},
+        {"title": "Mid", "artist": "C", "duration": "0:30", "rating": "300", "link": "/mid"},
+    ])
+    results = asyncio.run(downloader.search("query", limit=2))
+    assert [r["title"] for r in results] == ["Top", "Mid"]
+    assert results[0]["duration"] == 125
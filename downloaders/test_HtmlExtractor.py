@@ -0,0 +1,70 @@
+from downloaders.HtmlExtractor import SearchPageExtractor, split_xpath
+
+TABLE_PAGE = b"""<html><body>
+<table id="r">
+<tr><td>First</td><td><a href="/1">link</a></td></tr>
+<tr><td>Second</td><td><a href="/2">link</a></td></tr>
+</table>
+</body></html>"""
+
+TABLE_FIELDS = {
+    "title": '//table[@id="r"]//td[1]/text()',
+    "link": '//table[@id="r"]//td[2]/a/@href',
+}
+
+DIV_PAGE = b"""<html><body>
+<div class="item" data-name="First"><a href="/1">link</a></div>
+<div class="item" data-name="No link"></div>
+<div class="item" data-name="Third"><a href="/3">link</a></div>
+</body></html>"""
+
+DIV_FIELDS = {
+    "title": '//div[@class="item"]/@data-name',
+    "link": '//div[@class="item"]/a/@href',
+}
+
+
+def extract(fields, page, chunk_size=16):
+    extraction = SearchPageExtractor(fields).start("utf-8")
+    for i in range(0, len(page), chunk_size):
+        extraction.feed(page[i:i + chunk_size])
+    return extraction.close()
+
+
+def test_split_xpath():
+    assert split_xpath('//div[@a="/"]/span') == [("//", 'div[@a="/"]'), ("/", "span")]
+    assert split_xpath("//a | //b") is None
+    assert split_xpath("a/b") is None
+
+
+def test_container_prefix_falls_back_to_fields():
+    # Common prefix selects the table, not its rows
+    extractor = SearchPageExtractor(TABLE_FIELDS)
+    assert extractor.streaming
+    expected = [{"title": "First", "link": "/1"}, {"title": "Second", "link": "/2"}]
+    assert extract(TABLE_FIELDS, TABLE_PAGE) == expected
+    assert extract(TABLE_FIELDS, TABLE_PAGE, chunk_size=len(TABLE_PAGE)) == expected
+
+
+def test_container_prefix_falls_back_to_fields_buffered():
+    fields = {
+        "title": '/html/body/table[@id="r"]//td[1]/text()',
+        "link": '/html/body/table[@id="r"]//td[2]/a/@href',
+    }
+    assert not SearchPageExtractor(fields).streaming
+    assert extract(fields, TABLE_PAGE) == [{"title": "First", "link": "/1"}, {"title": "Second", "link": "/2"}]
+
+
+def test_missing_field_drops_only_its_row():
+    expected = [{"title": "First", "link": "/1"}, {"title": "Third", "link": "/3"}]
+    assert extract(DIV_FIELDS, DIV_PAGE) == expected
+
+    fields = {name: expression.replace("//div", "/html/body/div") for name, expression in DIV_FIELDS.items()}
+    assert not SearchPageExtractor(fields).streaming
+    assert extract(fields, DIV_PAGE) == expected
+
+
+def test_all_results_are_extracted():
+    page = b"<html><body>" + b"".join(b'<div class="item" data-name="%d"><a href="/%d">x</a></div>' % (i, i)
+                                       for i in range(50)) + b"</body></html>"
+    assert [row["title"] for row in extract(DIV_FIELDS, page)] == [str(i) for i in range(50)]
@@ -0,0 +1,161 @@
+import asyncio
+import configparser
+import threading
+import time
+
+from core.AbstractDownloader import AbstractAsyncDownloader, AbstractDownloader, CancellationToken, UrlOrNetworkProblem
+from downloaders.MasterDownloader import MasterDownloader
+
+
+def make_config(**options):
+    config = configparser.ConfigParser()
+    config.read_dict({"downloader": dict({"search_mode": "federated", "search_grace": "0.2",
+                                          "search_source_timeout": "0.5"}, **options)})
+    return config
+
+
+class FakeCore:
+    def __init__(self, loop):
+        self.loop = loop
+
+
+class AsyncSource(AbstractAsyncDownloader):
+    def __init__(self, config, name, results=None, error=None, delay=0.0):
+        super().__init__(config)
+        self.name = name
+        self.results = results or []
+        self.error = error
+        self.delay = delay
+
+    def get_name(self):
+        return self.name
+
+    def is_acceptable(self, kind, query):
+        return kind == "search"
+
+    async def search(self, query, user_message=lambda text: True, limit=1000, token=None):
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return [dict(r) for r in self.results]
+
+
+class BlockingSource(AbstractDownloader):
+    """Searches in a thread until its token stops it"""
+
+    def __init__(self, config, name):
+        super().__init__(config)
+        self.name = name
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+
+    def get_name(self):
+        return self.name
+
+    def is_acceptable(self, kind, query):
+        return kind == "search"
+
+    def search(self, query, user_message=lambda text: True, limit=1000, token=None):
+        self.started.set()
+        # Gives up on its own after a while, so that a token which is never cancelled doesn't hang the tests
+        give_up = time.monotonic() + 5
+        try:
+            while time.monotonic() < give_up:
+                token.check()
+                time.sleep(0.01)
+            raise UrlOrNetworkProblem("never stopped")
+        finally:
+            self.stopped.set()
+
+
+def result(artist, title, duration, result_id):
+    return {"artist": artist, "title": title, "duration": duration, "id": result_id}
+
+
+def run_search(config, sources, token=None, cancel_after=None):
+    messages = []
+
+    async def run():
+        master = MasterDownloader(config, sources)
+        master.bind_core(FakeCore(asyncio.get_running_loop()))
+        if cancel_after is not None:
+            asyncio.get_running_loop().call_later(cancel_after, token.cancel)
+        results = await master.search("query", messages.append, 10, token)
+        await master.flush_callbacks()
+        return results
+
+    return asyncio.run(run()), messages
+
+
+def test_answers_of_two_sources_are_merged_without_duplicates():
+    config = make_config()
+    first = AsyncSource(config, "first", [result("Artist", "Song", 200, "1"), result("Other", "Tune", 100, "2")])
+    second = AsyncSource(config, "second", [result("artist", "Song!", 202, "3"), result("Third", "Track", 50, "4")],
+                         delay=0.05)
+    results, messages = run_search(config, [first, second])
+    assert [(r["downloader"], r["id"]) for r in results] == [("first", "1"), ("first", "2"), ("second", "4")]
+    assert messages == []
+
+
+def test_failed_source_does_not_hide_the_other():
+    config = make_config()
+    failing = AsyncSource(config, "failing", error=UrlOrNetworkProblem("down"))
+    working = AsyncSource(config, "working", [result("Artist", "Song", 200, "1")])
+    results, messages = run_search(config, [failing, working])
+    assert [r["id"] for r in results] == ["1"]
+    assert messages == []
+
+
+def test_slow_source_is_stopped_on_timeout():
+    config = make_config(search_source_timeout="0.3", search_grace="5")
+    slow = BlockingSource(config, "slow")
+    fast = AsyncSource(config, "fast", [result("Artist", "Song", 200, "1")])
+    started = time.monotonic()
+    results, messages = run_search(config, [slow, fast])
+    assert [r["id"] for r in results] == ["1"]
+    assert time.monotonic() - started < 2
+    assert slow.stopped.wait(1)
+
+
+def test_source_skipped_after_grace_is_stopped():
+    config = make_config(search_source_timeout="5", search_grace="0.1")
+    slow = BlockingSource(config, "slow")
+    fast = AsyncSource(config, "fast", [result("Artist", "Song", 200, "1")])
+    results, messages = run_search(config, [slow, fast])
+    assert [r["id"] for r in results] == ["1"]
+    assert slow.stopped.wait(1)
+
+
+def test_cancelled_search_is_not_reported_as_network_error():
+    config = make_config(search_source_timeout="5")
+    first, second = BlockingSource(config, "first"), BlockingSource(config, "second")
+    token = CancellationToken()
+    results, messages = run_search(config, [first, second], token, cancel_after=0.2)
+    assert results is None
+    assert messages == []
+    assert first.stopped.wait(1) and second.stopped.wait(1)
+
+
+def test_all_sources_failed():
+    config = make_config()
+    sources = [AsyncSource(config, "first", error=UrlOrNetworkProblem("down")),
+               AsyncSource(config, "second", error=UrlOrNetworkProblem("down"))]
+    results, messages = run_search(config, sources)
+    assert results is None
+    assert len(messages) == 1 and messages[0].startswith("Не удаётся выполнить запрос")
+
+
+def test_search_deadline_is_reported():
+    config = make_config(search_source_timeout="5")
+    sources = [BlockingSource(config, "first"), BlockingSource(config, "second")]
+    results, messages = run_search(config, sources, CancellationToken(0.2))
+    assert results is None
+    assert len(messages) == 1 and messages[0].startswith("Поиск занял слишком много времени")
+
+
+def test_no_source_accepts_the_query():
+    config = make_config()
+    source = AsyncSource(config, "first")
+    source.is_acceptable = lambda kind, query: False
+    results, messages = run_search(config, [source])
+    assert results is None
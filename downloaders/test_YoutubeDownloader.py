@@ -0,0 +1,54 @@
+import configparser
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from core.AbstractDownloader import ApiError, BadReturnStatus, UrlOrNetworkProblem
+from core.HttpClient import HostGuard
+from downloaders import YoutubeDownloader as module
+
+URL = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+
+
+def make_downloader(monkeypatch, error):
+    config = configparser.ConfigParser()
+    config.read_dict({"http": {"breaker_failures": "1"}})
+    downloader = module.YoutubeDownloader(config)
+    downloader.host_guard = HostGuard(config)
+    downloader.get_cached_video = lambda video_id: None
+
+    def youtube(url):
+        raise error
+
+    monkeypatch.setattr(module, "YouTube", youtube)
+    monkeypatch.setattr(module.traceback, "print_exc", lambda: None)
+    return downloader
+
+
+def breaker(downloader):
+    return downloader.host_guard.breaker(downloader._guarded_host)
+
+
+@pytest.mark.parametrize("error", [KeyError("videoDetails"), ValueError("age restricted")])
+def test_video_errors_do_not_count_against_host(monkeypatch, error):
+    downloader = make_downloader(monkeypatch, error)
+    for _ in range(3):
+        with pytest.raises(ApiError):
+            downloader.download(URL)
+    assert breaker(downloader).failures == 0
+    assert breaker(downloader).allow()
+
+
+def test_network_errors_count_against_host(monkeypatch):
+    downloader = make_downloader(monkeypatch, URLError("timed out"))
+    with pytest.raises(UrlOrNetworkProblem):
+        downloader.download(URL)
+    assert breaker(downloader).state == breaker(downloader).OPEN
+
+
+@pytest.mark.parametrize("code,opened", [(503, True), (404, False)])
+def test_http_errors_count_only_for_server_failures(monkeypatch, code, opened):
+    downloader = make_downloader(monkeypatch, HTTPError(URL, code, "error", {}, None))
+    with pytest.raises(BadReturnStatus):
+        downloader.download(URL)
+    assert (breaker(downloader).state == breaker(downloader).OPEN) == opened
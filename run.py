@@ -15,6 +15,7 @@ from downloaders.HtmlDownloader import HtmlDownloader
 from downloaders.LinkDownloader import LinkDownloader
 from downloaders.YoutubeDownloader import YoutubeDownloader
 from VLC.VLCRadioEmitter import VLCStreamer
+from FFmpeg.FFmpegRadioEmitter import FFmpegStreamer
 from downloaders.MasterDownloader import MasterDownloader
 from telegram.TelegramFrontend import TgFrontend
 from discord_.DiscordComponent import DiscordComponent
@@ -71,9 +72,16 @@ downloader = MasterDownloader(config, [
             HtmlDownloader(config),
             LinkDownloader(config),
         ])
-# modules = [DiscordComponent(config, discord.Client(loop=main_loop)), TgFrontend(config)]
-modules = [DiscordComponent(config, discord.Client(loop=main_loop)), StatusWebServer(config)]
+if config.getboolean("discord", "sharded", fallback=False):
+    # One connection per shard, chosen by Discord, for bots in many guilds
+    shard_count = config.getint("discord", "shard_count", fallback=0)
+    discord_client = discord.AutoShardedClient(loop=main_loop, shard_count=shard_count or None)
+else:
+    discord_client = discord.Client(loop=main_loop)
+# modules = [DiscordComponent(config, discord_client), TgFrontend(config)]
+modules = [DiscordComponent(config, discord_client), StatusWebServer(config)]
 # modules = [VLCStreamer(config), TgFrontend(config)]
+# modules = [FFmpegStreamer(config), StatusWebServer(config), TgFrontend(config)]
 
 core = Core(config, components=modules, downloader=downloader, loop=main_loop)
 
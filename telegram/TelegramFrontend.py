@@ -62,6 +62,8 @@ db.connect()
 
 # noinspection PyMissingConstructor
 class TgFrontend(AbstractFrontend):
+    _max_message_length = 4096  # characters
+
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger('tg_dj.bot')
@@ -398,6 +400,10 @@ class TgFrontend(AbstractFrontend):
             self._update_or_send_text_message(user, reply, progress_msg)
 
         try:
+            bulk = await self.core.bulk_download_action(user.core_id, text, progress_callback=progress_callback)
+            if bulk is not None:
+                self._send_bulk_added_message(user, reply, *bulk)
+                return
             song, lp, gp = await self.core.download_action(user.core_id, text=text, progress_callback=progress_callback)
             self._send_song_added_message(user, reply, gp, song)
         except NotAccepted:
@@ -643,6 +649,12 @@ class TgFrontend(AbstractFrontend):
         message_text = env.get_template("song_added_msg_text.tmpl").render(**data)
         self._update_or_send_text_message(user, reply, message_text)
 
+    def _send_bulk_added_message(self, user: TgUser, reply: telebot.types.Message, added, failed):
+        message_text = env.get_template("bulk_added_msg_text.tmpl").render(added=added, failed=failed)
+        if len(message_text) > self._max_message_length:
+            message_text = message_text[:self._max_message_length - 1] + "…"
+        self._update_or_send_text_message(user, reply, message_text)
+
     def _send_error(self, user, message):
         self._send_text_message(user, message)
 
@@ -0,0 +1,122 @@
+import random
+
+from utils import find_mp3_frame, id3v2_size, parse_mp3_frame_header, probe_duration
+
+# MPEG-1 layer III, 128 kbps, 44100 Hz, stereo: 417 bytes, 1152 samples
+FRAME_HEADER = b"\xff\xfb\x90\x00"
+FRAME_LENGTH = 417
+FRAME_SECONDS = 1152 / 44100
+SIDE_INFO = 32
+
+
+def mp3_frame(payload=b""):
+    return FRAME_HEADER + payload + bytes(FRAME_LENGTH - 4 - len(payload))
+
+
+def id3_tag(size=100):
+    return b"ID3\x04\x00\x00" + bytes([0, 0, size >> 7, size & 0x7F]) + bytes(size)
+
+
+def xing_frame(tag=b"Xing", frames=1000, flags=0x01):
+    payload = bytes(SIDE_INFO) + tag + flags.to_bytes(4, "big")
+    if flags & 0x01:
+        payload += frames.to_bytes(4, "big")
+    return mp3_frame(payload)
+
+
+def vbri_frame(frames=1000):
+    payload = bytes(32) + b"VBRI" + bytes(10) + frames.to_bytes(4, "big")
+    return mp3_frame(payload)
+
+
+def mp4_head(timescale=1000, duration=90000):
+    mvhd_payload = bytes(4) + bytes(8) + timescale.to_bytes(4, "big") + duration.to_bytes(4, "big") + bytes(80)
+    mvhd = (8 + len(mvhd_payload)).to_bytes(4, "big") + b"mvhd" + mvhd_payload
+    moov = (8 + len(mvhd)).to_bytes(4, "big") + b"moov" + mvhd
+    ftyp = (16).to_bytes(4, "big") + b"ftypisom" + bytes(4)
+    return ftyp + moov
+
+
+def test_parse_frame_header():
+    header = parse_mp3_frame_header(FRAME_HEADER, 0)
+    assert header["version"] == 1 and header["layer"] == 3
+    assert header["bitrate"] == 128000 and header["sample_rate"] == 44100
+    assert header["length"] == FRAME_LENGTH
+    assert parse_mp3_frame_header(b"\xff\xfb\xf0\x00", 0) is None
+
+
+def test_find_frame_needs_the_next_frame():
+    data = bytes(10) + mp3_frame() + mp3_frame()[:10]
+    assert find_mp3_frame(data) == (10, parse_mp3_frame_header(data, 10))
+    # The next frame would start past the end of the data
+    assert find_mp3_frame(bytes(10) + mp3_frame()) == (None, None)
+    assert find_mp3_frame(bytes(10) + mp3_frame(), partial=True)[0] == 10
+
+
+def test_find_frame_needs_the_same_stream():
+    # MPEG-2 frame after an MPEG-1 one
+    assert find_mp3_frame(mp3_frame() + b"\xff\xf3\x90\x00" + bytes(100)) == (None, None)
+
+
+def test_id3v2_size():
+    assert id3v2_size(id3_tag(300)) == 310
+    assert id3v2_size(mp3_frame()) == 0
+
+
+def test_cbr_mp3():
+    head = mp3_frame() * 4
+    assert probe_duration(head, 100 * FRAME_LENGTH) == 100 * FRAME_LENGTH * 8 / 128000
+    assert probe_duration(head) is None
+
+
+def test_cbr_mp3_after_id3_tag():
+    head = id3_tag(100) + mp3_frame() * 2
+    assert probe_duration(head, 110 + 100 * FRAME_LENGTH) == 100 * FRAME_LENGTH * 8 / 128000
+
+
+def test_xing_mp3():
+    head = id3_tag() + xing_frame(frames=1000) + mp3_frame()
+    assert probe_duration(head, 10 ** 9) == 1000 * FRAME_SECONDS
+
+
+def test_info_mp3_without_frame_count_is_cbr():
+    head = xing_frame(tag=b"Info", flags=0) + mp3_frame()
+    assert probe_duration(head, 10 * FRAME_LENGTH) == 10 * FRAME_LENGTH * 8 / 128000
+
+
+def test_xing_mp3_without_frame_count():
+    assert probe_duration(xing_frame(flags=0) + mp3_frame(), 10 ** 9) is None
+
+
+def test_truncated_xing_mp3():
+    head = xing_frame(frames=1000) + mp3_frame()
+    for length in range(SIDE_INFO + 4, SIDE_INFO + 16):
+        assert probe_duration(head[:length], 10 ** 9) is None
+
+
+def test_vbri_mp3():
+    head = vbri_frame(frames=500) + mp3_frame()
+    assert probe_duration(head, 10 ** 9) == 500 * FRAME_SECONDS
+
+
+def test_mp4():
+    assert probe_duration(mp4_head(1000, 90000)) == 90
+    assert probe_duration(mp4_head()[:40]) is None
+
+
+def test_other_formats_are_not_probed():
+    # Frames of other containers may contain bytes which look like MPEG audio frames
+    frames = mp3_frame() * 3
+    for magic in (b"OggS\x00\x02", b"fLaC\x00\x00", b"\x1a\x45\xdf\xa3\x01\x00"):
+        assert probe_duration(magic + bytes(100) + frames, 10 ** 9) is None
+
+
+def test_frames_in_the_middle_of_unknown_data():
+    assert probe_duration(b"\x00\x01" * 1000 + mp3_frame() * 3, 10 ** 9) is None
+
+
+def test_random_data():
+    rng = random.Random(1)
+    for _ in range(50):
+        head = b"\x00" + bytes(rng.getrandbits(8) for _ in range(4096))
+        assert probe_duration(head, 10 ** 9) is None
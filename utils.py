@@ -1,4 +1,7 @@
 import os
+import threading
+import time
+from collections import OrderedDict
 from mutagen.mp3 import MP3
 from unidecode import unidecode
 from urlextract import URLExtract
@@ -14,6 +17,45 @@ def make_endless_unfailable(func):
     return wrapper
 
 
+class LRUCache:
+    """Thread-safe mapping holding at most max_size entries, each for at most ttl seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                return default
+            if expires < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            try:
+                return self.data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def __len__(self):
+        return len(self.data)
+
+
 def remove_links(text):
     if text is None:
         return None
@@ -58,3 +100,186 @@ def sanitize_file_name(file_name):
 
     file_name = unidecode(file_name)
     return ''.join([c if c in valid_chars else "_" for c in file_name])
+
+
+# kbps by bitrate index for (MPEG-1, layer), (MPEG-2/2.5, layer)
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Hz by sample rate index for MPEG-1, MPEG-2, MPEG-2.5
+_MP3_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+
+def parse_mp3_frame_header(data, pos):
+    """
+    :return: dict with frame parameters or None if there is no valid MPEG audio frame header at pos
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((data[pos + 1] >> 3) & 0x03)
+    layer = {1: 3, 2: 2, 3: 1}.get((data[pos + 1] >> 1) & 0x03)
+    bitrate_index = data[pos + 2] >> 4
+    sample_rate_index = (data[pos + 2] >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = 1000 * _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index]
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    mono = (data[pos + 3] >> 6) == 3
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if version == 1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return {
+        "version": version,
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples": samples,
+        "length": length,
+        "mono": mono,
+    }
+
+
+def find_mp3_frame(data, start=0, partial=False):
+    """
+    :param partial: also accept a frame which data ends in before the next frame can be checked,
+                    for streams which are read further
+    :return: (position, header) of the first frame which is followed by another valid frame of the same
+             stream, or (None, None)
+    """
+    pos = data.find(b"\xff", start)
+    while pos != -1:
+        header = parse_mp3_frame_header(data, pos)
+        if header is not None:
+            next_pos = pos + header["length"]
+            if next_pos + 4 > len(data):
+                if partial:
+                    return pos, header
+            else:
+                next_header = parse_mp3_frame_header(data, next_pos)
+                if next_header is not None and all(next_header[key] == header[key]
+                                                   for key in ("version", "layer", "sample_rate")):
+                    return pos, header
+        pos = data.find(b"\xff", pos + 1)
+    return None, None
+
+
+def id3v2_size(data):
+    """
+    :return: length of the ID3v2 tag at the start of data, 0 if there is none
+    """
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _probe_mp3_duration(head, total_size):
+    audio_start = id3v2_size(head)
+    if audio_start >= len(head):
+        return None
+
+    pos, header = find_mp3_frame(head, audio_start)
+    if pos is None or audio_start == 0 and pos != 0:
+        # Without a tag only a file which starts with frames is taken for an MP3
+        return None
+
+    # Xing/Info header lives right after the side information, VBRI at a fixed offset
+    if header["version"] == 1:
+        xing_pos = pos + 4 + (17 if header["mono"] else 32)
+    else:
+        xing_pos = pos + 4 + (9 if header["mono"] else 17)
+    tag = bytes(head[xing_pos:xing_pos + 4])
+    if tag in (b"Xing", b"Info"):
+        if len(head) < xing_pos + 12:
+            return None
+        flags = int.from_bytes(head[xing_pos + 4:xing_pos + 8], "big")
+        if flags & 0x01:
+            frames = int.from_bytes(head[xing_pos + 8:xing_pos + 12], "big")
+            return frames * header["samples"] / header["sample_rate"]
+        if tag == b"Xing":
+            # Variable bitrate without a frame count, the bitrate of the first frame tells nothing
+            return None
+    elif head[pos + 36:pos + 40] == b"VBRI":
+        if len(head) < pos + 54:
+            return None
+        frames = int.from_bytes(head[pos + 50:pos + 54], "big")
+        return frames * header["samples"] / header["sample_rate"]
+
+    if total_size is not None:
+        # Constant bitrate
+        return (total_size - pos) * 8 / header["bitrate"]
+    return None
+
+
+def _iter_mp4_boxes(data, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size = int.from_bytes(data[pos:pos + 4], "big")
+        box_type = bytes(data[pos + 4:pos + 8])
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = int.from_bytes(data[pos + 8:pos + 16], "big")
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+
+def _probe_mp4_duration(head):
+    for box_type, payload, box_end in _iter_mp4_boxes(head, 0, len(head)):
+        if box_type != b"moov":
+            continue
+        for child_type, child, child_end in _iter_mp4_boxes(head, payload, min(box_end, len(head))):
+            if child_type != b"mvhd" or child_end > len(head):
+                continue
+            if head[child] == 1:
+                timescale = int.from_bytes(head[child + 20:child + 24], "big")
+                duration = int.from_bytes(head[child + 24:child + 32], "big")
+            else:
+                timescale = int.from_bytes(head[child + 12:child + 16], "big")
+                duration = int.from_bytes(head[child + 16:child + 20], "big")
+            if timescale == 0:
+                return None
+            return duration / timescale
+    return None
+
+
+# Formats which are not probed, their bytes may look like MPEG audio frames
+_OTHER_MAGICS = (b"OggS", b"fLaC", b"\x1a\x45\xdf\xa3", b"RIFF")
+
+
+def probe_duration(head, total_size=None):
+    """
+    Estimates media duration in seconds from the first bytes of a file: Xing/VBRI headers or bitrate
+    of an MP3 which starts with an ID3 tag or two consecutive frames, mvhd box of an MP4 with leading moov.
+    Returns None if the head is not enough or the format is not known
+    :param bytes head: beginning of the file
+    :param int total_size: full file size, needed for constant bitrate MP3
+    """
+    if head[4:8] == b"ftyp":
+        return _probe_mp4_duration(head)
+    if bytes(head[:4]) in _OTHER_MAGICS:
+        return None
+    return _probe_mp3_duration(head, total_size)
@@ -0,0 +1,310 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import tornado.web
+from prometheus_client import Counter
+
+from utils import parse_mp3_frame_header
+from web.StreamRelay import StreamRelay
+
+# noinspection PyArgumentList
+mon_hls_segments = Counter('dj_hls_segments', 'HLS segments written', ['mount'])
+
+PLAYLIST_NAME = "index.m3u8"
+
+_PTS_WRAP = 1 << 33
+_PTS_RATE = 90000
+_TS_PACKET = 188
+
+
+def _syncsafe(value) -> bytes:
+    return bytes([(value >> 21) & 0x7F, (value >> 14) & 0x7F, (value >> 7) & 0x7F, value & 0x7F])
+
+
+def _id3_frame(frame_id, data) -> bytes:
+    return frame_id.encode() + _syncsafe(len(data)) + b"\x00\x00" + data
+
+
+def make_id3_tag(pts, title=None) -> bytes:
+    """
+    ID3v2.4 tag which starts a packed audio segment: its timestamp and, as timed metadata, the track title
+    """
+    frames = _id3_frame("PRIV", b"com.apple.streaming.transportStreamTimestamp\x00"
+                        + (pts % _PTS_WRAP).to_bytes(8, "big"))
+    if title:
+        frames += _id3_frame("TIT2", b"\x03" + title.encode() + b"\x00")
+    return b"ID3\x04\x00\x00" + _syncsafe(len(frames)) + frames
+
+
+def parse_ts_pts(packet) -> Optional[int]:
+    """
+    :return: PTS of the PES which starts in the TS packet, None if no PES with PTS starts there
+    """
+    if len(packet) != _TS_PACKET or packet[0] != 0x47 or not packet[1] & 0x40:
+        return None
+    pos = 4
+    if packet[3] & 0x20:
+        pos += 1 + packet[4]
+    if not packet[3] & 0x10 or pos + 14 > _TS_PACKET:
+        return None
+    if packet[pos:pos + 3] != b"\x00\x00\x01" or not 0xC0 <= packet[pos + 3] <= 0xEF or not packet[pos + 7] & 0x80:
+        return None
+    b = packet[pos + 9:pos + 14]
+    return ((b[0] >> 1) & 0x07) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+
+
+def _ts_pid(packet) -> int:
+    return (packet[1] & 0x1F) << 8 | packet[2]
+
+
+def _parse_pat(packet) -> Optional[int]:
+    """
+    :return: PID of the first program's PMT
+    """
+    if not packet[1] & 0x40 or not packet[3] & 0x10:
+        return None
+    pos = 4 + (1 + packet[4] if packet[3] & 0x20 else 0)
+    pos += 1 + packet[pos]  # pointer field
+    section_length = (packet[pos + 1] & 0x0F) << 8 | packet[pos + 2]
+    end = min(pos + 3 + section_length - 4, _TS_PACKET)
+    pos += 8
+    while pos + 4 <= end:
+        program = packet[pos] << 8 | packet[pos + 1]
+        if program != 0:
+            return (packet[pos + 2] & 0x1F) << 8 | packet[pos + 3]
+        pos += 4
+    return None
+
+
+class _Segment:
+    def __init__(self, sequence, file_name, duration, date, discontinuity):
+        self.sequence = sequence
+        self.file_name = file_name
+        self.duration = duration
+        self.date: datetime.datetime = date
+        self.discontinuity = discontinuity
+
+
+class HlsSegmenter:
+    """
+    Cuts the stream of a relay into HLS segments with a sliding playlist, written to a directory
+    (preferably on tmpfs) which is served as static files, so that any HTTP cache can serve listeners.
+    MP3 streams are cut into packed audio segments, MPEG-TS streams at PES boundaries of the audio.
+    Track changes are announced in the playlist as date ranges and, for MP3, in the ID3 tags of segments
+    """
+
+    _max_gap = 10  # target durations; a larger jump of timestamps is a restart of the source
+
+    def __init__(self, relay: StreamRelay, directory, segment_duration, playlist_size):
+        """
+        :param relay: relay of the stream, in mp3 or ts format
+        :param str directory: where the segments and the playlist are written to
+        :param float segment_duration: target duration of segments in seconds
+        :param int playlist_size: segments in the playlist
+        """
+        if relay.format not in ("mp3", "ts"):
+            raise ValueError("HLS needs an mp3 or ts stream, not %s" % relay.format)
+        self.logger = logging.getLogger("tg_dj.web.hls")
+        self.relay = relay
+        self.directory = directory
+        self.segment_duration = segment_duration
+        self.playlist_size = playlist_size
+        self.extension = relay.format
+
+        self.segments: Deque[_Segment] = deque()
+        self.sequence = 0
+        self.buffer = bytearray()
+        # Timestamp (seconds) and wall clock time at the start of the segment being cut
+        self.segment_start: Optional[float] = None
+        self.segment_date: Optional[datetime.datetime] = None
+        self.discontinuity = False
+        # MP3: seconds of audio since the start, TS: last PTS and the PAT and PMT for every segment
+        self.position = 0.0
+        self.last_timestamp: Optional[float] = None
+        self.pat: Optional[bytes] = None
+        self.pmt_pid: Optional[int] = None
+        self.pmt: Optional[bytes] = None
+        # Track changes: date, id, title
+        self.track_marks: List[Tuple[datetime.datetime, int, str]] = []
+        self.task: Optional[asyncio.Future] = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("segment_") or file_name == PLAYLIST_NAME:
+                os.unlink(os.path.join(self.directory, file_name))
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    def cleanup(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def set_track(self, track_id, title):
+        """
+        Marks a track change at the live position
+        """
+        self.track_marks.append((datetime.datetime.now(datetime.timezone.utc), track_id, title))
+
+    async def _run(self):
+        seq = self.relay.next_seq
+        while True:
+            await self.relay.wait(seq)
+            if seq < self.relay.first_seq:
+                # Fell behind the relay's buffer
+                self.discontinuity = True
+            frames, seq = self.relay.read(seq)
+            for frame in frames:
+                self._add(frame)
+
+    def _timestamp(self, frame) -> Optional[float]:
+        """
+        :return: timestamp in seconds if a segment can start with the frame
+        """
+        if self.extension == "mp3":
+            header = parse_mp3_frame_header(frame, 0)
+            timestamp = self.position
+            self.position += header["samples"] / header["sample_rate"]
+            return timestamp
+        pid = _ts_pid(frame)
+        if pid == 0:
+            self.pat = frame
+            self.pmt_pid = _parse_pat(frame)
+            return None
+        if pid == self.pmt_pid:
+            self.pmt = frame
+            return None
+        pts = parse_ts_pts(frame)
+        if pts is None:
+            return None
+        if self.last_timestamp is None:
+            return pts / _PTS_RATE
+        # PTS wraps around every ~26.5 hours
+        delta = ((pts - round(self.last_timestamp * _PTS_RATE)) % _PTS_WRAP) / _PTS_RATE
+        if delta > _PTS_WRAP / _PTS_RATE / 2:
+            delta -= _PTS_WRAP / _PTS_RATE
+        return self.last_timestamp + delta
+
+    def _add(self, frame):
+        timestamp = self._timestamp(frame)
+        if timestamp is not None:
+            if self.last_timestamp is not None and \
+                    not 0 <= timestamp - self.last_timestamp < self._max_gap * self.segment_duration:
+                self.logger.debug("Stream timestamps jumped from %.3f to %.3f", self.last_timestamp, timestamp)
+                # Source was restarted
+                self._finish_segment(self.last_timestamp)
+                self.discontinuity = True
+            self.last_timestamp = timestamp
+            if self.segment_start is None:
+                self._start_segment(timestamp)
+            elif timestamp - self.segment_start >= self.segment_duration:
+                self._finish_segment(timestamp)
+                self._start_segment(timestamp)
+        if self.segment_start is not None:
+            self.buffer += frame
+
+    def _start_segment(self, timestamp):
+        self.segment_start = timestamp
+        self.segment_date = datetime.datetime.now(datetime.timezone.utc)
+        if self.extension == "mp3":
+            title = self.track_marks[-1][2] if self.track_marks else None
+            self.buffer = bytearray(make_id3_tag(round(timestamp * _PTS_RATE), title))
+        else:
+            self.buffer = bytearray((self.pat or b"") + (self.pmt or b""))
+
+    def _finish_segment(self, timestamp):
+        if self.segment_start is None:
+            return
+        duration = timestamp - self.segment_start
+        self.segment_start = None
+        if duration <= 0:
+            # Nothing to play: no sequence number is used, so stale files are still found by number,
+            # and a discontinuity is kept for the next segment
+            return
+        segment = _Segment(self.sequence, "segment_%d.%s" % (self.sequence, self.extension), duration,
+                           self.segment_date, self.discontinuity)
+        self.sequence += 1
+        self.discontinuity = False
+        self._write(segment.file_name, bytes(self.buffer))
+        self.segments.append(segment)
+        mon_hls_segments.labels(self.relay.mount).inc()
+
+        while len(self.segments) > self.playlist_size:
+            # Files are kept a bit longer than they are listed, for clients which have just read the playlist
+            removed = self.segments.popleft()
+            stale = "segment_%d.%s" % (removed.sequence - self.playlist_size, self.extension)
+            try:
+                os.unlink(os.path.join(self.directory, stale))
+            except FileNotFoundError:
+                pass
+        self._write(PLAYLIST_NAME, self._make_playlist().encode())
+
+    def _write(self, file_name, data):
+        path = os.path.join(self.directory, file_name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        # Readers never see a partial file
+        os.replace(path + ".tmp", path)
+
+    def _make_playlist(self) -> str:
+        first = self.segments[0]
+        # Mark of the track playing at the start of the playlist and the later ones
+        marks = [mark for mark in self.track_marks if mark[0] > first.date]
+        earlier = [mark for mark in self.track_marks if mark[0] <= first.date]
+        if earlier:
+            marks.insert(0, earlier[-1])
+        self.track_marks = marks
+
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:%d" % math.ceil(max(s.duration for s in self.segments)),
+            "#EXT-X-MEDIA-SEQUENCE:%d" % first.sequence,
+        ]
+        for segment in self.segments:
+            if segment.discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append("#EXT-X-PROGRAM-DATE-TIME:" + segment.date.isoformat(timespec="milliseconds"))
+            for date, track_id, title in marks:
+                if date <= segment.date + datetime.timedelta(seconds=segment.duration) \
+                        and (segment is first or date > segment.date):
+                    # Quoted strings of attributes can't contain quotes or line breaks
+                    title = title.replace('"', "'").replace("\n", " ").replace("\r", " ")
+                    lines.append('#EXT-X-DATERANGE:ID="track-%d-%d",START-DATE="%s",X-TITLE="%s"'
+                                 % (track_id, date.timestamp(), date.isoformat(timespec="milliseconds"), title))
+            lines.append("#EXTINF:%.3f," % segment.duration)
+            lines.append(segment.file_name)
+        return "\n".join(lines) + "\n"
+
+
+# noinspection PyAbstractClass
+class HlsFileHandler(tornado.web.StaticFileHandler):
+    """
+    Serves segments and the playlist; segments never change and may be cached for long,
+    the playlist only for a fraction of a segment
+    """
+
+    _content_types = {
+        ".m3u8": "application/vnd.apple.mpegurl",
+        ".mp3": "audio/mpeg",
+        ".ts": "video/mp2t",
+    }
+
+    def initialize(self, path, default_filename=None, playlist_max_age=1):
+        super().initialize(path, default_filename)
+        self.playlist_max_age = playlist_max_age
+
+    def get_content_type(self):
+        return self._content_types.get(os.path.splitext(self.absolute_path)[1], "application/octet-stream")
+
+    def set_extra_headers(self, path):
+        self.set_header("Access-Control-Allow-Origin", "*")
+        if path.endswith(".m3u8"):
+            self.set_header("Cache-Control", "public, max-age=%d" % self.playlist_max_age)
+        else:
+            self.set_header("Cache-Control", "public, max-age=86400, immutable")
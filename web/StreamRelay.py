@@ -0,0 +1,316 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import tornado.iostream
+import tornado.web
+from prometheus_client import Counter, Gauge
+
+from core.HttpClient import get_async_http_client, NETWORK_ERRORS
+from utils import find_mp3_frame, parse_mp3_frame_header
+
+# noinspection PyArgumentList
+mon_relay_listeners = Gauge('dj_relay_listeners', 'Listeners of the stream relay', ['mount'])
+# noinspection PyArgumentList
+mon_relay_bytes_served = Counter('dj_relay_bytes_served', 'Bytes sent to listeners of the stream relay', ['mount'])
+# noinspection PyArgumentList
+mon_relay_skips = Counter('dj_relay_skips', 'Times a slow listener was moved ahead to the live position', ['mount'])
+
+CONTENT_TYPES = {
+    "mp3": "audio/mpeg",
+    "ts": "video/mp2t",
+    "ogg": "audio/ogg",
+    "raw": "application/octet-stream",
+}
+
+
+class FrameSplitter:
+    """
+    Cuts a byte stream into whole frames (MPEG audio frames, TS packets or Ogg pages),
+    so that listeners can join at any frame boundary. Ogg header pages are kept for late joiners
+    """
+
+    _ts_packet = 188
+    _raw_chunk = 4096
+
+    def __init__(self, stream_format):
+        if stream_format not in CONTENT_TYPES:
+            raise ValueError("Unknown stream format: %s" % stream_format)
+        self.format = stream_format
+        self.buffer = bytearray()
+        self.headers: List[bytes] = []
+
+    def reset(self):
+        self.buffer = bytearray()
+
+    def feed(self, data) -> List[bytes]:
+        self.buffer += data
+        split = getattr(self, "_split_" + self.format)
+        frames = []
+        while True:
+            frame = split()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _take(self, start, length) -> Optional[bytes]:
+        if start > 0:
+            del self.buffer[:start]
+        if len(self.buffer) < length:
+            return None
+        frame = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return frame
+
+    def _split_mp3(self) -> Optional[bytes]:
+        header = parse_mp3_frame_header(self.buffer, 0)
+        start = 0
+        if header is None:
+            start, header = find_mp3_frame(self.buffer, partial=True)
+            if start is None:
+                # Keep a possible beginning of a header
+                del self.buffer[:max(0, len(self.buffer) - 3)]
+                return None
+        return self._take(start, header["length"])
+
+    def _split_ts(self) -> Optional[bytes]:
+        start = 0
+        size = self._ts_packet
+        while start < len(self.buffer) and not (
+                self.buffer[start] == 0x47
+                and (start + size >= len(self.buffer) or self.buffer[start + size] == 0x47)):
+            start += 1
+        return self._take(start, size)
+
+    def _split_ogg(self) -> Optional[bytes]:
+        start = self.buffer.find(b"OggS")
+        if start == -1:
+            del self.buffer[:max(0, len(self.buffer) - 3)]
+            return None
+        if len(self.buffer) < start + 27:
+            return None
+        segments = self.buffer[start + 26]
+        if len(self.buffer) < start + 27 + segments:
+            return None
+        length = 27 + segments + sum(self.buffer[start + 27:start + 27 + segments])
+        page = self._take(start, length)
+        if page is not None:
+            if page[5] & 0x02:
+                # Beginning of a new logical stream, its headers replace the old ones
+                self.headers = []
+            if int.from_bytes(page[6:14], "little") == 0:
+                self.headers.append(page)
+        return page
+
+    def _split_raw(self) -> Optional[bytes]:
+        if not self.buffer:
+            return None
+        return self._take(0, min(len(self.buffer), self._raw_chunk))
+
+
+class StreamRelay:
+    """
+    Reads the emitter's output once and serves it to any number of HTTP listeners.
+    Whole frames are kept in a ring buffer of at most buffer_size bytes which all listeners read from;
+    a new listener gets `burst` bytes of the most recent frames at once so that playback starts immediately.
+    Methods must be called on the event loop
+    """
+
+    def __init__(self, mount, stream_format, buffer_size, burst, rendition=None):
+        """
+        :param str mount: URL path the stream is served at
+        :param str stream_format: one of CONTENT_TYPES
+        :param int buffer_size: bytes kept for listeners
+        :param int burst: bytes sent to a new listener at once
+        :param str rendition: bitrate of the stream if it is a lower-bitrate copy of the main one, e.g. "64k"
+        """
+        self.logger = logging.getLogger("tg_dj.web.relay")
+        self.mount = mount
+        self.rendition = rendition
+        self.format = stream_format
+        self.content_type = CONTENT_TYPES[stream_format]
+        self.buffer_size = buffer_size
+        self.burst = min(burst, buffer_size)
+        self.splitter = FrameSplitter(stream_format)
+
+        self.frames: Deque[bytes] = deque()
+        self.first_seq = 0  # sequence number of self.frames[0]
+        self.size = 0
+        self.listeners = 0
+        self.new_frames: Optional[asyncio.Future] = None
+        self.source_task: Optional[asyncio.Future] = None
+
+        mon_relay_listeners.labels(mount).set_function(lambda: self.listeners)
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self.frames)
+
+    @property
+    def headers(self) -> List[bytes]:
+        return self.splitter.headers
+
+    def feed(self, data):
+        """
+        Adds a piece of the source stream
+        """
+        self.publish(self.splitter.feed(data))
+
+    def publish(self, frames: List[bytes]):
+        """
+        Adds whole frames
+        """
+        if not frames:
+            return
+        for frame in frames:
+            self.frames.append(frame)
+            self.size += len(frame)
+        while self.size > self.buffer_size and len(self.frames) > 1:
+            self.size -= len(self.frames.popleft())
+            self.first_seq += 1
+        if self.new_frames is not None and not self.new_frames.done():
+            self.new_frames.set_result(None)
+
+    def reset(self):
+        """
+        Source was restarted, an unfinished frame is dropped
+        """
+        self.splitter.reset()
+
+    def burst_start(self) -> int:
+        """
+        :return: sequence number to start a new listener from
+        """
+        seq = self.next_seq
+        size = 0
+        for frame in reversed(self.frames):
+            if size + len(frame) > self.burst:
+                break
+            size += len(frame)
+            seq -= 1
+        return seq
+
+    def read(self, seq) -> Tuple[List[bytes], int]:
+        """
+        :return: frames from seq on and the sequence number to read next; a listener which fell
+                 behind the buffer is moved to the live position
+        """
+        if seq < self.first_seq:
+            mon_relay_skips.labels(self.mount).inc()
+            seq = self.burst_start()
+        start = seq - self.first_seq
+        frames = list(itertools.islice(self.frames, start, None))
+        return frames, self.next_seq
+
+    async def wait(self, seq):
+        """
+        Waits until there are frames after seq
+        """
+        while self.next_seq <= seq:
+            if self.new_frames is None or self.new_frames.done():
+                self.new_frames = asyncio.get_event_loop().create_future()
+            await asyncio.shield(self.new_frames)
+
+    def start_source(self, url, reconnect_delay):
+        self.source_task = asyncio.ensure_future(self.run_source(url, reconnect_delay))
+
+    async def run_source(self, url, reconnect_delay):
+        """
+        Pulls the stream from the emitter's HTTP output, reconnecting while it is not available
+        """
+        client = get_async_http_client()
+        while True:
+            try:
+                response = await client.get(url)
+                try:
+                    if response.status != 200:
+                        self.logger.debug("Stream source answered %d", response.status)
+                    else:
+                        self.logger.info("Relaying %s to %s", url, self.mount)
+                        async for data in response.content.iter_any():
+                            self.feed(data)
+                finally:
+                    response.release()
+            except NETWORK_ERRORS as e:
+                self.logger.debug("Stream source is not available: %s", repr(e))
+            self.reset()
+            await asyncio.sleep(reconnect_delay)
+
+    def cleanup(self):
+        if self.source_task is not None:
+            self.source_task.cancel()
+
+
+# noinspection PyAbstractClass,PyAttributeOutsideInit
+class StreamHandler(tornado.web.RequestHandler):
+
+    def initialize(self, **kwargs):
+        self.relay: StreamRelay = kwargs.get("relay")
+
+    async def get(self):
+        relay = self.relay
+        self.set_header("Content-Type", relay.content_type)
+        self.set_header("Cache-Control", "no-cache, no-store")
+
+        relay.listeners += 1
+        bytes_served = mon_relay_bytes_served.labels(relay.mount)
+        try:
+            for header in relay.headers:
+                self.write(header)
+                bytes_served.inc(len(header))
+            seq = relay.burst_start()
+            while True:
+                frames, seq = relay.read(seq)
+                # Frame objects are shared by all listeners
+                for frame in frames:
+                    self.write(frame)
+                    bytes_served.inc(len(frame))
+                await self.flush()
+                await relay.wait(seq)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            relay.listeners -= 1
+
+
+_relays: Dict[str, StreamRelay] = {}
+
+
+def register_relay(relay: StreamRelay):
+    _relays[relay.mount] = relay
+
+
+def get_relay(mount) -> Optional[StreamRelay]:
+    """
+    :return: relay serving the mount, emitters publish to it directly instead of over HTTP
+    """
+    return _relays.get(mount)
+
+
+def rendition_mount(mount, rendition) -> str:
+    """
+    :return: URL path of a rendition of the stream served at mount
+    """
+    return mount.rstrip("/") + "/" + rendition
+
+
+def parse_bitrate(rendition) -> int:
+    """
+    :return: bits per second of a bitrate written the ffmpeg way, e.g. "64k"
+    """
+    multipliers = {"k": 1000, "m": 1000000}
+    rendition = rendition.strip().lower()
+    if rendition[-1:] in multipliers:
+        return int(float(rendition[:-1]) * multipliers[rendition[-1]])
+    return int(rendition)
+
+
+def get_renditions(mount) -> List[StreamRelay]:
+    """
+    :return: relays serving renditions of the stream at mount, from the lowest bitrate
+    """
+    relays = [relay for relay in _relays.values()
+              if relay.rendition is not None and relay.mount == rendition_mount(mount, relay.rendition)]
+    return sorted(relays, key=lambda relay: parse_bitrate(relay.rendition))
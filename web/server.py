@@ -1,15 +1,21 @@
 import os
 import json
+import tempfile
 import time
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import asyncio
 import logging
+from typing import List
+
 from prometheus_client import Gauge
 
 from core.AbstractComponent import AbstractComponent
 from core.models import Song
+from web.HlsSegmenter import HlsFileHandler, HlsSegmenter
+from web.StreamRelay import StreamRelay, StreamHandler, get_renditions, parse_bitrate, register_relay, \
+    rendition_mount
 
 
 # noinspection PyAbstractClass,PyAttributeOutsideInit
@@ -64,10 +70,18 @@ class MainHandler(tornado.web.RequestHandler):
         song, progress = self.server.get_current_state()
         self.render(os.path.join(os.path.dirname(__file__), "index.html"), song_info=song, song_progress=progress,
                     stream_url=self.server.stream_url + '?ts=' + str(time.time()), ws_url=self.server.ws_url,
+                    stream_renditions=self.server.get_stream_renditions(),
                     telegram_bot_name=self.server.telegram_bot_name)
 
 
 class StatusWebServer(AbstractComponent):
+    _default_relay_buffer_size = 1048576  # bytes
+    _default_relay_burst = 65536  # bytes
+    _default_relay_reconnect = 2  # seconds
+    _default_stream_bitrate = "320k"
+    _default_hls_segment_duration = 6.0  # seconds
+    _default_hls_playlist_size = 6  # segments
+
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger("tg_dj.web")
@@ -78,10 +92,50 @@ class StatusWebServer(AbstractComponent):
             "debug": False,
         }
 
-        app = tornado.web.Application([
+        handlers = [
             (r"/", MainHandler, dict(server=self)),
             (r'/ws', WebSocketHandler, dict(server=self)),
-        ], **settings)
+        ]
+
+        self.relay = None
+        self.renditions: List[StreamRelay] = []
+        if self.config.getboolean("web_server", "relay_enabled", fallback=False):
+            relay_format = self.config.get("web_server", "relay_format", fallback="ts")
+            buffer_size = self.config.getint("web_server", "relay_buffer_size",
+                                             fallback=self._default_relay_buffer_size)
+            burst = self.config.getint("web_server", "relay_burst", fallback=self._default_relay_burst)
+            self.relay = StreamRelay(self.config.get("web_server", "relay_mount", fallback="/stream"),
+                                     relay_format, buffer_size, burst)
+            register_relay(self.relay)
+            # Lower-bitrate copies of the stream, each at <relay_mount>/<bitrate>
+            for rendition in self.config.get("web_server", "relay_renditions", fallback="").split(","):
+                rendition = rendition.strip()
+                if not rendition:
+                    continue
+                register_relay(StreamRelay(rendition_mount(self.relay.mount, rendition),
+                                           relay_format, buffer_size, burst, rendition=rendition))
+            self.renditions = get_renditions(self.relay.mount)
+            for relay in [self.relay] + self.renditions:
+                handlers.append((relay.mount, StreamHandler, dict(relay=relay)))
+
+        self.hls_segmenter = None
+        if self.relay is not None and self.config.getboolean("web_server", "hls_enabled", fallback=False):
+            # Memory-backed file system keeps segments off the disk
+            default_directory = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                             "tg_dj_hls")
+            segment_duration = self.config.getfloat("web_server", "hls_segment_duration",
+                                                    fallback=self._default_hls_segment_duration)
+            self.hls_segmenter = HlsSegmenter(
+                self.relay,
+                self.config.get("web_server", "hls_directory", fallback=default_directory),
+                segment_duration,
+                self.config.getint("web_server", "hls_playlist_size", fallback=self._default_hls_playlist_size),
+            )
+            handlers.append((self.config.get("web_server", "hls_mount", fallback="/hls").rstrip("/") + r"/(.*)",
+                             HlsFileHandler, dict(path=self.hls_segmenter.directory,
+                                                  playlist_max_age=max(1, int(segment_duration / 2)))))
+
+        app = tornado.web.Application(handlers, **settings)
 
         app.listen(
             port=self.config.getint("web_server", "listen_port", fallback=8080),
@@ -106,6 +160,37 @@ class StatusWebServer(AbstractComponent):
     def bind_core(self, core):
         self.core = core
         self.core.add_state_update_callback(self.update_state)
+        reconnect_delay = self.config.getfloat("web_server", "relay_reconnect",
+                                               fallback=self._default_relay_reconnect)
+        relay_source = self.config.get("web_server", "relay_source", fallback="")
+        if self.relay is not None and relay_source:
+            self.relay.start_source(relay_source, reconnect_delay)
+        rendition_source = self.config.get("web_server", "relay_rendition_source", fallback="")
+        if rendition_source:
+            for relay in self.renditions:
+                relay.start_source(rendition_source.replace("{rendition}", relay.rendition), reconnect_delay)
+        if self.hls_segmenter is not None:
+            self.hls_segmenter.start()
+
+    def cleanup(self):
+        for relay in self.renditions + [self.relay]:
+            if relay is not None:
+                relay.cleanup()
+        if self.hls_segmenter is not None:
+            self.hls_segmenter.cleanup()
+
+    def get_stream_renditions(self) -> List[dict]:
+        """
+        :return: URLs and bitrates of renditions of the stream from the lowest bitrate, the main stream is the last
+        """
+        if not self.renditions:
+            return []
+        renditions = [{"url": rendition_mount(self.stream_url, relay.rendition),
+                       "bitrate": parse_bitrate(relay.rendition)} for relay in self.renditions]
+        renditions.append({"url": self.stream_url,
+                           "bitrate": parse_bitrate(self.config.get("web_server", "stream_bitrate",
+                                                                    fallback=self._default_stream_bitrate))})
+        return renditions
 
     def get_current_state(self):
         track = self.core.get_current_song()
@@ -116,6 +201,8 @@ class StatusWebServer(AbstractComponent):
 
     def update_state(self, track: Song):
         if track is not None:
+            if self.hls_segmenter is not None:
+                self.hls_segmenter.set_track(track.id, track.full_title())
             self.broadcast_update(track.to_dict())
         else:
             self.broadcast_stop()
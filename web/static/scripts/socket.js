@@ -26,12 +26,10 @@ window.init = function(){
             song_start_el.value = Date.now();
         }, 3000);
 
-        if (audio_el.paused || audio_el.buffered.length === 0) {
-            start_time = (new Date()).getTime();
-            source_el.src = source_url + "?ts=" + Date.now();
-            audio_el.load();
+        // The stream goes on between tracks, it is reopened only if it was broken
+        if (audio_el.ended || audio_el.error !== null || audio_el.networkState === audio_el.NETWORK_NO_SOURCE) {
+            play_url(source_url);
             audio_el.play();
-            console.log(source_el.src);
         }
         check_lag();
     }
@@ -120,6 +118,82 @@ window.init = function(){
         return time_elapsed - buf_size;
     }
 
+    // Renditions are picked by the rate the relay's burst of recent audio is downloaded at
+    var measure_bytes = 65536;
+    var measure_time = 3;  // seconds
+    var bitrate_margin = 1.5;
+    var max_stalls = 3;
+    var stalls = [];
+    var rendition_index = null;
+
+    function measure_throughput(url, callback) {
+        var controller = new AbortController();
+        fetch(url + "?ts=" + Date.now(), {signal: controller.signal, cache: "no-store"}).then(function(response) {
+            var reader = response.body.getReader();
+            var started = performance.now();
+            var received = 0;
+            function pump() {
+                return reader.read().then(function(result) {
+                    var elapsed = (performance.now() - started) / 1000;
+                    if (!result.done) received += result.value.length;
+                    if (result.done || received >= measure_bytes || elapsed >= measure_time) {
+                        controller.abort();
+                        callback(received * 8 / Math.max(elapsed, 0.001));
+                        return;
+                    }
+                    return pump();
+                });
+            }
+            return pump();
+        }).catch(function() {
+            callback(0);
+        });
+    }
+
+    function play_url(url) {
+        start_time = (new Date()).getTime();
+        initial_lag = null;
+        source_el.src = url + "?ts=" + Date.now();
+        audio_el.preload = "auto";
+        audio_el.load();
+        console.log(source_el.src);
+    }
+
+    function play_rendition(index) {
+        rendition_index = index;
+        source_url = stream_renditions[index].url;
+        play_url(source_url);
+    }
+
+    function choose_rendition() {
+        if (stream_renditions.length < 2) {
+            play_url(source_url);
+            return;
+        }
+        // The last rendition is the main stream
+        measure_throughput(stream_renditions[stream_renditions.length - 1].url, function(throughput) {
+            console.log("Throughput: " + Math.round(throughput / 1000) + " kbps");
+            var index = 0;
+            while (index + 1 < stream_renditions.length
+                   && stream_renditions[index + 1].bitrate * bitrate_margin <= throughput) {
+                index++;
+            }
+            play_rendition(index);
+        });
+    }
+
+    audio_el.addEventListener("waiting", function() {
+        // Playback keeps stalling, the connection is too slow for this rendition
+        var now = Date.now();
+        stalls = stalls.filter(function(time) { return now - time < 60000; });
+        stalls.push(now);
+        if (stalls.length >= max_stalls && rendition_index !== null && rendition_index > 0) {
+            stalls = [];
+            console.log("Too many stalls, switching to a lower bitrate");
+            play_rendition(rendition_index - 1);
+        }
+    });
+
     function get_cookie(name) {
         var matches = document.cookie.match(new RegExp(
             "(?:^|; )" + name.replace(/([\.$?*|{}\(\)\[\]\\\/\+^])/g, '\\$1') + "=([^;]*)"
@@ -138,4 +212,6 @@ window.init = function(){
     }
 
     window.set_volume = set_volume;
+
+    choose_rendition();
 };